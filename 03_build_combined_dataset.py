@@ -1,12 +1,17 @@
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+import numpy as np
 import pandas as pd
-from ocean_pta_training import Environment
-from typing import List
+import pyarrow as pa
+import pyarrow.feather as feather
+from ocean_pta_training import Environment, configs, ConfigKeys
+from ocean_pta_training.port_dictionary import PortDictionary, load_port_dictionary
+from ocean_pta_training.route_extraction.constants import OUTPUT_TRAINING_FILE_SUBDIR
+from ocean_pta_training.route_extraction.od_aggregates import is_moving
 
-OD_EXTRACTS_FILE_DIR = "/Users/Andrewlanders/projects/ocean_pta/ocean-pta-training/output/od_extracts"
-DATA_DIR = "/Users/Andrewlanders/projects/ocean_pta/ocean-pta-training/output"
-COMBINED_DATA_FILE_NAME = "all_od_extracts.feather"
+DEFAULT_READ_WORKERS = 4
 
 logger = logging.getLogger(f"{__name__}")
 
@@ -15,6 +20,10 @@ od_extract_selected_columns = [
     'is_moving', 'Speed', 'num_intermediate_ports', 'week', 'month',
     'elapsed_time', 'journey_percent', 'remaining_lead_time',
 ]
+# Columns read from each OD extract: the selected columns that are not derived, and those they are derived from
+od_extract_read_columns = [
+    c for c in od_extract_selected_columns if c not in ('is_moving', 'month')
+] + ['NavStatus']
 od_extract_columns_map = {
     'TimePosition': 'time_position',
     'Latitude': 'latitude',
@@ -25,57 +34,154 @@ od_extract_columns_map = {
 
 
 def main():
-    """Concatenate individual O-D extracts"""
-    combined_data = pd.DataFrame()
-
-    # Prepare the imported dataset, and concatenate it to combined_data
-    for file_name in list_od_extract_file_names():
-        file_path = os.path.join(OD_EXTRACTS_FILE_DIR, file_name)
-        logger.info(f"Opening OD data extract from file {file_path}")
-        this_od_extract = pd.read_feather(file_path)
-        logger.info("...performing data preparation...")
-        this_od_extract = prepare_od_extract_data(this_od_extract)
-        logger.info("...concatenating this data to the combined dataset.")
-        combined_data = pd.concat(
-            [combined_data, this_od_extract],
-            ignore_index=True
-        )
-
-    # Print a sample of rows to the terminal
-    logger.info(f"First rows:\n{combined_data.head()}\n")
-    logger.info(f"Last rows:\n{combined_data.tail()}\n")
-
+    """
+    Concatenate individual O-D extracts. The extracts are read and prepared by a pool of threads,
+    and written to the combined dataset file one at a time, in file name order. They are written to
+    a temporary file, which replaces the combined dataset only once every extract is written.
+    """
+    port_dictionary = load_port_dictionary()
+    od_extracts_dir = get_od_extracts_dir()
+    file_names = list_od_extract_file_names(od_extracts_dir)
+    column_types = get_widened_column_types(od_extracts_dir, file_names)
     combined_data_file_path = os.environ.get(Environment.Vars.PATH_TO_COMBINED_OD_DATA)
-    logger.info(f"Writing the combined dataset to file at path: {combined_data_file_path}")
-    combined_data.to_feather(combined_data_file_path)
-
+    logger.info(
+        f"Combining {len(file_names)} OD data extracts from {od_extracts_dir} "
+        f"into the combined dataset at path: {combined_data_file_path}"
+    )
 
-def list_od_extract_file_names() -> List[str]:
-    """Returns a list containing the names of all OD extract files."""
-    return [
-        x for x in os.listdir(OD_EXTRACTS_FILE_DIR) if x.endswith(".feather")
-    ]
+    temp_file_path = f"{combined_data_file_path}.tmp"
+    writer: Optional[pa.RecordBatchFileWriter] = None
+    schema: Optional[pa.Schema] = None
+    n_rows = 0
+    last_od_extract = None
+    try:
+        for file_name, od_extract in read_od_extracts(od_extracts_dir, file_names, port_dictionary, column_types):
+            logger.info(f"...writing {len(od_extract.index)} rows of {file_name} to the combined dataset.")
+            table = pa.Table.from_pandas(od_extract, preserve_index=False)
+            if writer is None:
+                # Print a sample of rows to the terminal
+                logger.info(f"First rows:\n{od_extract.head()}\n")
+                schema = table.schema
+                writer = pa.ipc.new_file(
+                    temp_file_path, schema,
+                    options=pa.ipc.IpcWriteOptions(compression="lz4")
+                )
+            writer.write_table(table.cast(schema))
+            n_rows += len(od_extract.index)
+            last_od_extract = od_extract
+    except Exception:
+        # Leave the previous combined dataset in place, rather than one holding only the extracts written so far
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+    if writer is None:
+        logger.warning(f"No OD data extract in {od_extracts_dir}: writing an empty combined dataset")
+        empty_df = pd.DataFrame(columns=od_extract_selected_columns).rename(columns=od_extract_columns_map)
+        feather.write_feather(empty_df, temp_file_path)
+        os.replace(temp_file_path, combined_data_file_path)
+        return
+    writer.close()
+    os.replace(temp_file_path, combined_data_file_path)
+    logger.info(f"Last rows:\n{last_od_extract.tail()}\n")
+    logger.info(f"Wrote {n_rows} rows to the combined dataset at path: {combined_data_file_path}")
+
+
+def get_od_extracts_dir() -> str:
+    """
+    Directory of the OD extracts: COMBINED_DATASET.od_extracts_dir in the config,
+    or else the route extractor's training files under $PATH_TO_OUTPUT_DIRECTORY
+    """
+    od_extracts_dir = (configs.get(ConfigKeys.COMBINED_DATASET) or {}).get(ConfigKeys.OD_EXTRACTS_DIR)
+    if od_extracts_dir:
+        return od_extracts_dir
+    return os.path.join(os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY), OUTPUT_TRAINING_FILE_SUBDIR)
+
+
+def get_num_read_workers() -> int:
+    """Number of threads reading OD extracts (COMBINED_DATASET.read_workers in the config)"""
+    num_workers = (configs.get(ConfigKeys.COMBINED_DATASET) or {}).get(ConfigKeys.READ_WORKERS)
+    return max(1, int(num_workers if num_workers is not None else DEFAULT_READ_WORKERS))
+
+
+def list_od_extract_file_names(od_extracts_dir: str) -> List[str]:
+    """Returns a sorted list containing the names of all OD extract files."""
+    return sorted(
+        x for x in os.listdir(od_extracts_dir) if x.endswith(".feather")
+    )
 
 
-def prepare_od_extract_data(od_extract: pd.DataFrame) -> pd.DataFrame:
+def get_widened_column_types(od_extracts_dir: str, file_names: List[str]) -> Dict[str, np.dtype]:
+    """
+    Numeric columns read from the OD extracts whose type differs between extracts (e.g. int64 in one, and float64
+    with NaN in another), and the type every extract is cast to: float64 if any extract holds floats, as pd.concat
+    would widen them, and int64 otherwise. Only the schema of each file is read.
+    """
+    file_types = {}
+    for file_name in file_names:
+        with pa.memory_map(os.path.join(od_extracts_dir, file_name)) as source:
+            schema = pa.ipc.open_file(source).schema
+        for column in od_extract_read_columns:
+            if column in schema.names:
+                file_types.setdefault(column, set()).add(schema.field(column).type)
+    column_types = {}
+    for column, types in file_types.items():
+        if len(types) > 1 and all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+            column_types[column] = np.dtype(np.float64 if any(pa.types.is_floating(t) for t in types) else np.int64)
+    if column_types:
+        logger.info(f"Columns whose type differs between OD extracts, and their combined type: {column_types}")
+    return column_types
+
+
+def read_od_extracts(od_extracts_dir: str, file_names: List[str],
+                     port_dictionary: PortDictionary, column_types: Dict[str, np.dtype]) -> Iterator:
+    """
+    Yields (file name, prepared OD extract) in file name order. Extracts are read and prepared in
+    a pool of threads, at most twice as many as there are threads ahead of the one yielded, so that
+    only a few extracts are held in memory at a time.
+    """
+    num_workers = get_num_read_workers()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for i, file_name in enumerate(file_names):
+            futures[i] = executor.submit(
+                read_od_extract, os.path.join(od_extracts_dir, file_name), port_dictionary, column_types
+            )
+            if i >= 2 * num_workers:
+                yield from yield_od_extract(futures, file_names, i - 2 * num_workers)
+        for j in sorted(futures):
+            yield from yield_od_extract(futures, file_names, j)
+
+
+def yield_od_extract(futures: dict, file_names: List[str], i: int) -> Iterator:
+    od_extract = futures.pop(i).result()
+    if od_extract.empty:
+        logger.info(f"...{file_names[i]} has no rows.")
+        return
+    yield file_names[i], od_extract
+
+
+def read_od_extract(file_path: str, port_dictionary: PortDictionary,
+                    column_types: Dict[str, np.dtype]) -> pd.DataFrame:
+    logger.info(f"Opening OD data extract from file {file_path}")
+    od_extract = feather.read_table(file_path, columns=od_extract_read_columns, memory_map=True).to_pandas()
+    # The same column types in every extract, so that each is written with the combined dataset's schema
+    od_extract = od_extract.astype(column_types)
+    return prepare_od_extract_data(od_extract, port_dictionary)
+
+
+def prepare_od_extract_data(od_extract: pd.DataFrame, port_dictionary: PortDictionary) -> pd.DataFrame:
     """Add additional features and select columns"""
-    stopped_vessel_moving_status = ['aground', 'moored', 'at anchor']
-    stopped_minimum_speed = 0.5
-    # Add binary flag: is the vessel currently moving?
-    od_extract['is_stopped'] = od_extract.apply(
-        lambda row: (
-            1 if row['NavStatus'] in stopped_vessel_moving_status and row['Speed'] <= stopped_minimum_speed
-            else 0
-        ),
-        axis=1
-    )
-    od_extract['is_moving'] = od_extract['is_stopped'].apply(
-        lambda x: 0 if x == 1 else 1
-    )
+    # Add binary flag: is the vessel currently moving? (the same flag as in the extractor's OD aggregates)
+    od_extract['is_moving'] = is_moving(od_extract['NavStatus'], od_extract['Speed'])
     # Add month number as an alternative (possibly less noisy?) encoding for seasonality effects.
-    od_extract['month'] = od_extract['TimePosition'].apply(
-        lambda x: x.to_pydatetime().month
-    )
+    od_extract['month'] = od_extract['TimePosition'].dt.month
+    # Encode OD with the shared dictionary, so that every extract has the same categories
+    # and the combined column stays categorical
+    od_extract['OD'] = port_dictionary.encode_ods(od_extract['OD'])
+
     # Subset columns
     od_extract = od_extract[od_extract_selected_columns]
 
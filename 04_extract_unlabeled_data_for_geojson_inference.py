@@ -1,7 +1,10 @@
 import logging
+import numpy as np
 import pandas as pd
 import os
-from ocean_pta_training import Environment
+from typing import Optional, Tuple
+from ocean_pta_training import Environment, Journeys, configs, ConfigKeys
+from ocean_pta_training.geo import haversine
 
 logger = logging.getLogger(f"{__name__}")
 
@@ -35,34 +38,95 @@ def flag_for_remaining_distance_label(movements_df: pd.DataFrame):
     """
     Flag a subset of the data to be processed by geojson inference to calculate
     the shortest ocean route and the point-of-interest flags associated with that route.
+
+    Each journey (a run of rows with the same IMO, OD and unique_route_id) is flagged at its
+    first record, then at the first record at least HOURS_BETWEEN_REMAINING_DISTANCE_LABELS
+    (or, if configured, km_between_labels travelled) after the previously flagged one, up to
+    max_labels_per_journey records (see get_label_cadence).
     """
-    remaining_distance_flag = pd.Series(False, index=movements_df.index)
-    remaining_distance_flag.loc[0] = True
-    elapsed_time = movements_df['elapsed_time']
-    imo = movements_df['IMO']
-    od = movements_df['OD']
-    route_id = movements_df['unique_route_id']
-    this_imo = imo.loc[0]
-    this_od = od.loc[0]
-    this_route_id = route_id.loc[0]
-    days_between = HOURS_BETWEEN_REMAINING_DISTANCE_LABELS/24
-    ref_time = 0
-    for i in range(len(movements_df.index)):
-        if imo.loc[i] != this_imo or od.loc[i] != this_od or route_id.loc[i] != this_route_id:
-            remaining_distance_flag.loc[i] = True
-            this_imo = imo.loc[i]
-            this_od = od.loc[i]
-            this_route_id = route_id.loc[i]
-            ref_time = elapsed_time.loc[i]
-        elif elapsed_time.loc[i] - ref_time >= days_between:
-            remaining_distance_flag.loc[i] = True
-            this_imo = imo.loc[i]
-            this_od = od.loc[i]
-            this_route_id = route_id.loc[i]
-            ref_time = elapsed_time.loc[i]
+    journeys = Journeys.from_frame(
+        movements_df,
+        key_columns=['IMO', 'OD', 'unique_route_id'],
+        columns=['elapsed_time', 'latitude', 'longitude'],
+        check_contiguous=False
+    )
+    hours_between, km_between, max_labels = get_label_cadence()
+    days_between = hours_between/24 if hours_between is not None else None
+    elapsed_time = journeys['elapsed_time'].astype(np.float64)
+    distance_travelled = get_distance_travelled(journeys) if km_between is not None else None
+
+    first_reference = journeys.first('elapsed_time').astype(np.float64) if len(journeys) else np.zeros(0)
+    if len(journeys) and days_between is not None and not first_reference[0] >= days_between:
+        # The scan of the first journey starts from a reference time of 0, not its first elapsed time
+        first_reference[0] = 0
+    remaining_distance_flag = journeys.sample(
+        elapsed_time, days_between, distance_travelled, km_between, max_labels, first_reference
+    )
+
+    # Journeys whose records are not in elapsed time order are scanned one record at a time
+    is_in_order = journeys.diff('elapsed_time') >= 0
+    is_in_order[journeys.starts] = True
+    is_sorted = journeys.reduce(is_in_order, np.logical_and)
+    for i in np.flatnonzero(~is_sorted):
+        start, end = journeys.offsets[i], journeys.offsets[i + 1]
+        flagged = sample_journey(
+            elapsed_time[start:end], first_reference[i], days_between,
+            None if distance_travelled is None else distance_travelled[start:end], km_between, max_labels
+        )
+        remaining_distance_flag[start:end] = False
+        remaining_distance_flag[start + flagged] = True
 
     movements_df['remaining_distance_flag'] = remaining_distance_flag
 
+def get_label_cadence() -> Tuple[Optional[float], Optional[float], Optional[int]]:
+    """
+    Hours and km between flagged records, and maximum number of flagged records per journey
+    (GEOJSON_INFERENCE.hours_between_labels, km_between_labels and max_labels_per_journey in the config;
+    None: not used). Hours default to HOURS_BETWEEN_REMAINING_DISTANCE_LABELS.
+    """
+    geojson_configs = configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}
+    hours_between = geojson_configs.get(ConfigKeys.HOURS_BETWEEN_LABELS, HOURS_BETWEEN_REMAINING_DISTANCE_LABELS)
+    km_between = geojson_configs.get(ConfigKeys.KM_BETWEEN_LABELS)
+    max_labels = geojson_configs.get(ConfigKeys.MAX_LABELS_PER_JOURNEY)
+    return (
+        float(hours_between) if hours_between is not None else None,
+        float(km_between) if km_between is not None else None,
+        int(max_labels) if max_labels is not None else None
+    )
+
+def get_distance_travelled(journeys: Journeys) -> np.ndarray:
+    """Cumulative great-circle distance (km) from the first record of each journey"""
+    latlon = np.column_stack([journeys['latitude'], journeys['longitude']]).astype(np.float64)
+    step = np.zeros(journeys.n_pings)
+    if journeys.n_pings > 1:
+        step[1:] = np.nan_to_num(haversine(latlon[1:], latlon[:-1]))
+    step[journeys.starts] = 0
+    return np.cumsum(step)
+
+def sample_journey(elapsed_time: np.ndarray, ref_time: float, days_between: Optional[float],
+                   distance_travelled: Optional[np.ndarray] = None, km_between: Optional[float] = None,
+                   max_labels: Optional[int] = None) -> np.ndarray:
+    """
+    Positions of the records of one journey to flag: the first one, then each record at least
+    days_between (or km_between) after the previously flagged one (the first one is compared with ref_time).
+    """
+    if max_labels is not None and max_labels <= 0:
+        return np.zeros(0, dtype=np.int64)
+    flagged = [0]
+    ref_distance = distance_travelled[0] if distance_travelled is not None else None
+    for j in range(1, len(elapsed_time)):
+        if max_labels is not None and len(flagged) >= max_labels:
+            break
+        if (
+            (days_between is not None and elapsed_time[j] - ref_time >= days_between) or
+            (km_between is not None and distance_travelled[j] - ref_distance >= km_between)
+        ):
+            flagged.append(j)
+            ref_time = elapsed_time[j]
+            if distance_travelled is not None:
+                ref_distance = distance_travelled[j]
+    return np.array(flagged, dtype=np.int64)
+
 def calculate_time_delta(row, movements_df):
     """
     Calculate the time delta since the last observation,
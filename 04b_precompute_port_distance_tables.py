@@ -0,0 +1,49 @@
+import logging
+import os
+import pandas as pd
+from ocean_pta_training import Environment
+from ocean_pta_training.port_dictionary import load_port_dictionary
+from ocean_pta_training.geojson_inference import (
+    PortDistanceTables, get_distance_tables_dir, get_network, get_poi_list
+)
+
+logger = logging.getLogger(f"{__name__}")
+
+
+def main():
+    """
+    Precompute, for every destination port of the extracted ODs, the ocean distance from each network node
+    and the points of interest on the way, so that 05_label_data_with_geojson_inference.py can label
+    records with a table lookup instead of a shortest-path search.
+    """
+    logger.info("Precomputing node-to-port distance tables...")
+    ports_latlon = load_destination_ports_latlon()
+    logger.info(f"...{len(ports_latlon)} destination ports")
+    poi_names, poi_latlon = get_poi_list()
+    tables = PortDistanceTables.build(get_network(), poi_names, poi_latlon, ports_latlon)
+    tables_dir = get_distance_tables_dir()
+    logger.info(f"...saving {len(tables.target_nodes)} distance tables to {tables_dir}")
+    tables.save(tables_dir)
+
+
+def load_destination_ports_latlon() -> dict:
+    """
+    Latitude and longitude of the destination port of every OD in the port dictionary,
+    from the ports file
+    """
+    ports_data_file_path = os.environ.get(Environment.Vars.PATH_TO_PORTS_FILE)
+    ports_data = pd.read_csv(ports_data_file_path).drop_duplicates('locode', keep='last').set_index('locode')
+    port_dictionary = load_port_dictionary()
+    destination_ports = sorted({port_dictionary.ports[code] for code in port_dictionary.od_destination_codes() if code >= 0})
+    missing_ports = [port for port in destination_ports if port not in ports_data.index]
+    if missing_ports:
+        logger.warning(f"...no lat/lon in the ports file for {len(missing_ports)} destination ports: {missing_ports}")
+    return {
+        port: (ports_data.loc[port, 'lat'], ports_data.loc[port, 'lon'])
+        for port in destination_ports
+        if port in ports_data.index and pd.notna(ports_data.loc[port, 'lat']) and pd.notna(ports_data.loc[port, 'lon'])
+    }
+
+
+if __name__ == "__main__":
+    main()
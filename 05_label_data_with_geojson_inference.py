@@ -1,9 +1,18 @@
 import logging
+import multiprocessing
 import os
+import time
+from collections import defaultdict
 
+import numpy as np
 import pandas as pd
-from ocean_pta_training import Environment
-from ocean_pta_training.geojson_inference import calculate_shortest_path
+from ocean_pta_training import Environment, configs, ConfigKeys, Journeys
+from ocean_pta_training.port_dictionary import load_port_dictionary, OD_SEPARATOR
+from ocean_pta_training.geojson_inference import (
+    calculate_shortest_path, load_distance_tables, load_path_cache, save_path_cache, preload_network,
+    LabelingCheckpoint, get_labeling_shards_dir, calculate_interpolated_labels,
+    LabelCache, load_label_cache, save_label_cache, get_h3_cells
+)
 
 BATCH_SIZE = 10000
 ROWS_LIMIT = None
@@ -13,9 +22,14 @@ POINTS_OF_INTEREST = [
 ]
 FEATURE_COLUMNS = ['ocean_distance', 'source_to_network_dist', 'network_to_dest_dist']
 FEATURE_COLUMNS = FEATURE_COLUMNS + POINTS_OF_INTEREST
+JOURNEY_KEY_COLUMNS = ['IMO', 'OD', 'unique_route_id']
 
 logger = logging.getLogger(f"{__name__}")
 
+# Set in the main process before the worker processes are forked, which inherit them
+_worker_distance_tables = None
+_worker_path_cache = None
+
 
 def main():
     try:
@@ -26,76 +40,270 @@ def main():
 
         logger.info(f"\n{labeling_df.info()}")
         prepare_unlabeled_data(labeling_df)
-        label(labeling_df)
+        # Labeled batches are saved as they complete, so that a killed run resumes where it stopped
+        checkpoint = LabelingCheckpoint(
+            get_labeling_shards_dir(), os.environ.get(Environment.Vars.PATH_TO_GEOJSON_UNLABELED_DATA),
+            len(labeling_df.index), FEATURE_COLUMNS
+        )
+        resume_from_checkpoint(labeling_df, checkpoint)
+        # Labels of earlier runs, by (H3 cell, destination port): only the misses are routed
+        label_cache = load_label_cache(FEATURE_COLUMNS)
+        cache_misses = label_from_cache(labeling_df, label_cache)
+        label(labeling_df, checkpoint)
+        update_label_cache(labeling_df, label_cache, cache_misses)
+        interpolate_unflagged_pings(labeling_df)
         logger.info(f"\n{labeling_df}")
         save_labeled_data(labeling_df)
+        # The shards are merged into the labeled data file
+        checkpoint.remove()
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
         save_labeled_data(labeling_df)
 
-def label(labeling_df: pd.DataFrame):
+def resume_from_checkpoint(labeling_df: pd.DataFrame, checkpoint: LabelingCheckpoint):
+    """
+    Fill in the features of the rows labeled by a previous, interrupted run, and mark them labeled.
+    """
+    positions, features = checkpoint.load()
+    if len(positions) == 0:
+        return
+    logger.info(f"Resuming labeling: {len(positions)} rows were labeled in {len(checkpoint.shards)} saved partitions")
+    for i, col_name in enumerate(FEATURE_COLUMNS):
+        column = labeling_df[col_name].to_numpy(dtype=np.float64)
+        column[positions] = features[:, i]
+        labeling_df[col_name] = column
+    labeled = labeling_df['labeled'].to_numpy(dtype=bool)
+    labeled[positions] = True
+    labeling_df['labeled'] = labeled
+
+def label_from_cache(labeling_df: pd.DataFrame, label_cache: LabelCache):
+    """
+    Label the rows to be routed whose H3 cell and destination port are in the label cache.
+    Returns the positions, destination ports and cells of the other rows (None without a cache).
+    """
+    if label_cache is None:
+        return None
+    positions = get_pending_positions(labeling_df)
+    ods, od_index = np.unique(labeling_df['OD'].to_numpy()[positions].astype(str), return_inverse=True)
+    destinations = np.array([od.split(OD_SEPARATOR)[-1] for od in ods], dtype=object)[od_index.reshape(-1)]
+    cells = get_h3_cells(labeling_df[['olat', 'olon']].to_numpy()[positions], label_cache.resolution)
+    destination_latlon = labeling_df[['dlat', 'dlon']].to_numpy(dtype=np.float64)[positions]
+    found, labels = label_cache.lookup(destinations, cells, destination_latlon)
+
+    features = labeling_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    features[positions[found]] = labels[found]
+    for i, col_name in enumerate(FEATURE_COLUMNS):
+        labeling_df[col_name] = features[:, i]
+    labeled = labeling_df['labeled'].to_numpy(dtype=bool)
+    labeled[positions[found]] = True
+    labeling_df['labeled'] = labeled
+    logger.info(f"{int(found.sum())} of {len(positions)} rows labeled from the cache; {label_cache.stats()}")
+    return positions[~found], destinations[~found], cells[~found]
+
+def update_label_cache(labeling_df: pd.DataFrame, label_cache: LabelCache, cache_misses):
+    """Add the labels of the cache misses that were routed to the label cache, and save it"""
+    if label_cache is None:
+        return
+    positions, destinations, cells = cache_misses
+    destination_latlon = labeling_df[['dlat', 'dlon']].to_numpy(dtype=np.float64)[positions]
+    routed = labeling_df['labeled'].to_numpy(dtype=bool)[positions] & np.all(np.isfinite(destination_latlon), axis=1)
+    label_cache.add(
+        destinations[routed], cells[routed], destination_latlon[routed],
+        labeling_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)[positions[routed]]
+    )
+    logger.info(label_cache.stats())
+    if routed.any():
+        save_label_cache(label_cache)
+
+def label(labeling_df: pd.DataFrame, checkpoint: LabelingCheckpoint = None):
     """
     Perform geojson inference labeling for shortest ocean path and point-of-interest flags.
+    With a checkpoint, each labeled batch is appended to it as it completes.
     """
-    rows_total = len(labeling_df[labeling_df['remaining_distance_flag']].index)
+    pending_positions = get_pending_positions(labeling_df)
+    rows_total = len(pending_positions)
     rows_complete = 0
     rows_failed = 0
-    batch_df = get_batch_df(labeling_df)
-    while not is_labeling_finished(batch_df):
-        try:
-            logger.info(f"labeling a partition of {len(batch_df.index)} rows")
-            label_one_batch(batch_df)
-            logger.info("inserting features...")
-            for col_name in FEATURE_COLUMNS:
-                labeling_df.loc[batch_df.index, col_name] = batch_df[col_name]
-            labeling_df.loc[batch_df.index, 'labeled'] = True
-            rows_complete += len(batch_df.index)
-
-        except Exception as e:
+    worker_rows = defaultdict(int)
+    worker_seconds = defaultdict(float)
+
+    # Results are gathered in typed arrays, with one assignment per batch, and written to labeling_df at the end
+    features = labeling_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    labeled = labeling_df['labeled'].to_numpy(dtype=bool)
+    failed_job = labeling_df['failed_job'].to_numpy(dtype=bool)
+    try:
+        for positions, batch_features, worker, seconds, error in label_batches(labeling_df, pending_positions):
+            if error is None:
+                if checkpoint is not None:
+                    checkpoint.append(positions, batch_features)
+                features[positions] = batch_features
+                labeled[positions] = True
+                rows_complete += len(positions)
+            else:
+                logger.info(
+                    f"Unexpected error occurred while attempting to label the data: {error}."
+                    f"The rows in this batch will be flagged as 'failed_job'."
+                )
+                failed_job[positions] = True
+                rows_failed += len(positions)
+
+            worker_rows[worker] += len(positions)
+            worker_seconds[worker] += seconds
             logger.info(
-                f"Unexpected error occurred while attempting to label the data: {e}."
-                f"The rows in this batch will be flagged as 'failed_job'."
+                f"worker {worker}: {len(positions)} rows in {seconds:.1f}s "
+                f"({worker_rows[worker] / worker_seconds[worker]:.0f} rows/s overall)"
             )
-            labeling_df.loc[batch_df.index, 'failed_job'] = True
-            rows_failed += len(batch_df.index)
-
-        logger.info(f"{rows_complete} rows labeled, {rows_failed} failed out of {rows_total} total")
+            logger.info(f"{rows_complete} rows labeled, {rows_failed} failed out of {rows_total} total")
+    finally:
+        logger.info("inserting features...")
+        for i, col_name in enumerate(FEATURE_COLUMNS):
+            labeling_df[col_name] = features[:, i]
+        labeling_df['labeled'] = labeled
+        labeling_df['failed_job'] = failed_job
 
-        batch_df = get_batch_df(labeling_df)
+    for worker in sorted(worker_rows):
+        logger.info(
+            f"worker {worker}: {worker_rows[worker]} rows in {worker_seconds[worker]:.1f}s "
+            f"({worker_rows[worker] / worker_seconds[worker]:.0f} rows/s)"
+        )
 
-def get_batch_df(labeling_df: pd.DataFrame):
+def interpolate_unflagged_pings(labeling_df: pd.DataFrame):
     """
-    Extract a subset dataframe of size BATCH_SIZE from rows
-    that haven't yet been labeled, but need to be.
+    Label the moving pings that were not flagged for routing: each one is projected onto the shortest path
+    of the last flagged ping before it in its journey (its anchor), once that ping is labeled.
     """
-    batch_df = labeling_df[
-        (labeling_df['remaining_distance_flag']) &
-        (~labeling_df['labeled']) &
-        (~labeling_df['failed_job'])
-    ]
-    return batch_df[:BATCH_SIZE]
+    if not (configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}).get(ConfigKeys.INTERPOLATE_UNFLAGGED_PINGS, False):
+        return
+
+    journeys = Journeys.from_frame(
+        labeling_df, key_columns=JOURNEY_KEY_COLUMNS, columns=['remaining_distance_flag'], order_by='elapsed_time'
+    )
+    is_flagged = journeys['remaining_distance_flag'].astype(bool)
+    # Last flagged ping at or before each ping (in journey order), if it is in the same journey
+    last_flagged = np.maximum.accumulate(np.where(is_flagged, np.arange(journeys.n_pings), -1))
+    has_anchor = last_flagged >= journeys.starts[journeys.journey_index]
+    anchor_positions = np.where(has_anchor, journeys.positions[np.maximum(last_flagged, 0)], -1)
+
+    labeled = labeling_df['labeled'].to_numpy(dtype=bool)
+    to_interpolate = ~is_flagged & ~labeled[journeys.positions] & has_anchor
+    to_interpolate[to_interpolate] = labeled[anchor_positions[to_interpolate]]
+    ping_positions = journeys.positions[to_interpolate]
+    anchors, ping_anchor = np.unique(anchor_positions[to_interpolate], return_inverse=True)
+    ping_anchor = ping_anchor.reshape(-1)
+    if len(ping_positions) == 0:
+        return
+
+    # Anchors are routed in batches of BATCH_SIZE, sorted by OD (few destination nodes per batch)
+    anchor_order = labeling_df['OD'].iloc[anchors].reset_index(drop=True).sort_values(kind='stable').index.to_numpy()
+    anchor_batch = np.empty(len(anchors), dtype=np.int64)
+    anchor_batch[anchor_order] = np.arange(len(anchors)) // BATCH_SIZE
+    ping_order = np.argsort(anchor_batch[ping_anchor], kind='stable')
+    batch_starts = np.searchsorted(anchor_batch[ping_anchor][ping_order], np.arange(anchor_batch.max() + 2))
+    logger.info(f"interpolating labels for {len(ping_positions)} pings from the paths of {len(anchors)} labeled pings")
 
-def is_labeling_finished(batch_df: pd.DataFrame) -> bool:
-    """Return True if labeling is completely finished; False otherwise."""
-    return len(batch_df.index) == 0
+    features = labeling_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    interpolated = labeling_df['interpolated'].to_numpy(dtype=bool)
+    for start, stop in zip(batch_starts[:-1], batch_starts[1:]):
+        batch_pings = ping_order[start:stop]
+        batch_anchors, batch_ping_anchor = np.unique(ping_anchor[batch_pings], return_inverse=True)
+        results = calculate_interpolated_labels(
+            labeling_df.iloc[anchors[batch_anchors]], labeling_df.iloc[ping_positions[batch_pings]],
+            batch_ping_anchor.reshape(-1)
+        )
+        positions = ping_positions[batch_pings][results['interpolated']]
+        batch_features = np.column_stack([
+            results['ocean_distance'], results['distance_from_source_to_network'],
+            results['distance_to_dest_from_network'], np.asarray(results['points_of_interest'])
+        ])
+        features[positions] = batch_features[results['interpolated']]
+        interpolated[positions] = True
+        logger.info(f"{interpolated.sum()} of {len(ping_positions)} pings interpolated")
+
+    for i, col_name in enumerate(FEATURE_COLUMNS):
+        labeling_df[col_name] = features[:, i]
+    labeling_df['interpolated'] = interpolated
+    labeling_df['labeled'] = labeled | interpolated
 
-def label_one_batch(batch_df: pd.DataFrame) -> pd.DataFrame:
+def get_pending_positions(labeling_df: pd.DataFrame) -> np.ndarray:
     """
-    Perform geojson inference on each record for 1 batch of work.
+    Positions of the rows that haven't yet been labeled, but need to be, sorted by OD
+    so that a batch holds the rows of as few ODs (destination nodes to route to) as possible
+    """
+    pending = (
+        labeling_df['remaining_distance_flag'].to_numpy(dtype=bool) &
+        ~labeling_df['labeled'].to_numpy(dtype=bool) &
+        ~labeling_df['failed_job'].to_numpy(dtype=bool)
+    )
+    pending_positions = np.flatnonzero(pending)
+    od_order = labeling_df['OD'].iloc[pending_positions].reset_index(drop=True).sort_values(kind='stable').index
+    return pending_positions[od_order.to_numpy()]
+
+def label_batches(labeling_df: pd.DataFrame, pending_positions: np.ndarray):
+    """
+    Label the pending rows in batches of BATCH_SIZE, in the main process or with a pool of forked worker
+    processes (see get_num_workers). Yields the positions of each batch and label_one_batch_in_worker's
+    results for it, in batch order.
     """
-    results = calculate_shortest_path(batch_df)
+    global _worker_distance_tables, _worker_path_cache
+    num_workers = get_num_workers()
+    # The network is loaded before any fork, so that the workers share it
+    preload_network()
+    # Precomputed by 04b_precompute_port_distance_tables.py; records are routed on the network without them
+    _worker_distance_tables = load_distance_tables()
+    # LRU cache of routed (source node, target node) paths, sized in the package config
+    _worker_path_cache = load_path_cache()
+
+    coordinates = labeling_df[['olat', 'olon', 'dlat', 'dlon']].to_numpy(dtype=np.float64)
+    batches = [pending_positions[start:start + BATCH_SIZE] for start in range(0, len(pending_positions), BATCH_SIZE)]
+    tasks = (coordinates[positions] for positions in batches)
+    logger.info(f"labeling {len(pending_positions)} rows in {len(batches)} partitions with {num_workers} process(es)")
+
+    if num_workers > 1:
+        # Each worker gets its own copy of the path cache, which is not saved back
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            for positions, result in zip(batches, pool.imap(label_one_batch_in_worker, tasks)):
+                yield (positions, *result)
+    else:
+        for positions, batch_coordinates in zip(batches, tasks):
+            logger.info(f"labeling a partition of {len(positions)} rows")
+            yield (positions, *label_one_batch_in_worker(batch_coordinates))
+            if _worker_path_cache is not None:
+                logger.info(_worker_path_cache.stats())
+        save_path_cache(_worker_path_cache)
+
+def get_num_workers() -> int:
+    """Number of labeling processes from the package configs (0 means one per CPU)"""
+    num_workers = int((configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}).get(ConfigKeys.LABEL_WORKERS, 1))
+    return num_workers if num_workers > 0 else os.cpu_count()
 
-    # Populate ocean distance, source to network distance, and network to destination distance
-    batch_df.loc[batch_df.index, 'ocean_distance'] = results.get('ocean_distance')
-    batch_df.loc[batch_df.index, 'source_to_network_dist'] = results.get('distance_from_source_to_network')
-    batch_df.loc[batch_df.index, 'network_to_dest_dist'] = results.get('distance_to_dest_from_network')
+def label_one_batch_in_worker(batch_coordinates: np.ndarray):
+    """
+    Label one batch of (olat, olon, dlat, dlon) rows; returns the features, the process id, the time taken
+    and the error message if labeling failed (None otherwise).
+    """
+    start_time = time.perf_counter()
+    try:
+        batch_df = pd.DataFrame(batch_coordinates, columns=['olat', 'olon', 'dlat', 'dlon'])
+        batch_features, error = label_one_batch(batch_df, _worker_distance_tables, _worker_path_cache), None
+    except Exception as e:
+        batch_features, error = None, str(e)
+    return batch_features, os.getpid(), time.perf_counter() - start_time, error
 
-    # Populate points of interest flags
-    points_of_interest = results.get('points_of_interest')
-    for i, idx in enumerate(batch_df.index):
-        batch_df.loc[idx, POINTS_OF_INTEREST] = points_of_interest[i]
+def label_one_batch(batch_df: pd.DataFrame, distance_tables=None, path_cache=None) -> np.ndarray:
+    """
+    Perform geojson inference on each record for 1 batch of work.
+    Returns the FEATURE_COLUMNS of the records, as a (len(batch_df), len(FEATURE_COLUMNS)) array.
+    """
+    results = calculate_shortest_path(batch_df, distance_tables=distance_tables, path_cache=path_cache)
 
-    return batch_df
+    batch_features = np.empty((len(batch_df.index), len(FEATURE_COLUMNS)), dtype=np.float64)
+    # Ocean distance, source to network distance, and network to destination distance
+    batch_features[:, 0] = results.get('ocean_distance')
+    batch_features[:, 1] = results.get('distance_from_source_to_network')
+    batch_features[:, 2] = results.get('distance_to_dest_from_network')
+    # Points of interest flags (one row of 12 flags per record)
+    batch_features[:, 3:] = np.asarray(results.get('points_of_interest')).reshape(len(batch_df.index), -1)
+    return batch_features
 
 def prepare_unlabeled_data(labeling_df: pd.DataFrame):
     """
@@ -108,35 +316,28 @@ def prepare_unlabeled_data(labeling_df: pd.DataFrame):
     mark_destination_latlon(labeling_df)
     labeling_df['labeled'] = False
     labeling_df['failed_job'] = False
-    labeling_df['ocean_distance'] = None
-    labeling_df['source_to_network_dist'] = None
-    labeling_df['network_to_dest_dist'] = None
-
-    for i in range(len(POINTS_OF_INTEREST)):
-        col_name = POINTS_OF_INTEREST[i]
-        labeling_df[col_name] = pd.Series(
-            index=labeling_df.index, dtype='int32'
-        )
+    labeling_df['interpolated'] = False
+    # Feature columns are float64, NaN until labeled
+    for col_name in FEATURE_COLUMNS:
+        labeling_df[col_name] = np.nan
 
 def mark_destination_latlon(labeling_df: pd.DataFrame):
     """
     Populate destination latitude/longitude for each record in labeling_df
     """
     logger.info("...attaching destination lat/lon to unlabeled data...")
-    ports_data = load_ports_data()
-    df = labeling_df['OD'].str.split('-', expand=True)
-    df.columns = ['origin', 'destination']
-
-    # Merge with ports_data to get destination lat/lon
-    df = df.merge(
-        ports_data,
-        how='left', left_on='destination', right_on='locode',
-    )
-    df.index = labeling_df.index
+    ports_data = load_ports_data().drop_duplicates('locode', keep='last').set_index('locode')
+    port_dictionary = load_port_dictionary()
+
+    # OD code -> destination port code -> lat/lon, with lookup tables indexed by code
+    od_codes = port_dictionary.encode_ods(labeling_df['OD']).cat.codes.to_numpy()
+    destination_codes = np.append(port_dictionary.od_destination_codes(), -1)[od_codes]
+    port_lat = np.append(port_dictionary.port_values(ports_data['lat']), np.nan)
+    port_lon = np.append(port_dictionary.port_values(ports_data['lon']), np.nan)
 
-    # Attach columns
-    labeling_df['dlat'] = df['lat']
-    labeling_df['dlon'] = df['lon']
+    # Attach columns (code -1, for an unknown OD or port, picks the trailing NaN)
+    labeling_df['dlat'] = port_lat[destination_codes]
+    labeling_df['dlon'] = port_lon[destination_codes]
 
 def load_ports_data() -> pd.DataFrame:
     """
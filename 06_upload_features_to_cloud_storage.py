@@ -5,7 +5,7 @@ from azure.storage.blob import BlobServiceClient, ContainerClient
 from ocean_pta_training import Environment
 from typing import List
 
-DROPPED_FIELDS = ['remaining_distance_flag', 'labeled', 'failed_job']
+DROPPED_FIELDS = ['remaining_distance_flag', 'labeled', 'failed_job', 'interpolated']
 RANDOM_SEED = 12345
 SAMPLE_SIZE = None
 CSV_CHUNK_SIZE = int(1e5)
@@ -111,7 +111,8 @@ def load_data() -> pd.DataFrame:
 
     selected_fields = list(all_data.columns)
     for field in DROPPED_FIELDS:
-        selected_fields.remove(field)
+        if field in selected_fields:
+            selected_fields.remove(field)
 
     candidate_df = all_data[
         (all_data['labeled']) &
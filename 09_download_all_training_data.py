@@ -4,54 +4,47 @@ we will not need to download the data from Synapse each time
 """
 import os
 import logging
-import pandas as pd
-import pickle
-from ocean_pta_training import Environment
+from ocean_pta_training import Environment, configs, ConfigKeys
+from ocean_pta_training.training_download import TrainingDataDownloader
+from ocean_pta_training.training_store import get_local_training_store
 from ocean_pta_training.utilities import pyodbc_connect
 
+DEFAULT_DOWNLOAD_CONNECTIONS = 4
+DEFAULT_PAGE_JOURNEYS = 5_000
+DEFAULT_FETCH_ROWS = 50_000
 
 logger = logging.getLogger(f"{__name__}")
 
+
 def main():
     try:
-        all_data = load()
-        all_data = all_data[:10000]
-        save(all_data)
+        download()
     except Exception as e:
         logger.error(f"An unexpected exception occurred: {e}")
 
 
-def save(df: pd.DataFrame):
-    """
-    Saves the combined training data locally to a path specified by
-    environment variable PATH_TO_LOCAL_TRAINING_DATA
+def download() -> int:
     """
-    local_data_path = os.environ.get(Environment.Vars.PATH_TO_LOCAL_TRAINING_DATA)
-    logger.info(f"Saving ocean journeys dataset locally as file: {local_data_path}")
-    with open(local_data_path, 'wb') as pickle_file:
-        pickle.dump(df, pickle_file)
-    logger.info(f"Saving ocean journeys dataset to file: ")
-
-def load() -> pd.DataFrame:
-    """
-    Draw random samples from labeled data
+    Downloads the combined training data, page by page, into the local training store
+    at the path specified by environment variable PATH_TO_LOCAL_TRAINING_DATASET
     """
     schema = os.environ.get(Environment.Vars.SYNAPSE_SCHEMA)
     table = os.environ.get(Environment.Vars.OCEAN_JOURNEY_DATA_TABLE)
-    sql = f"""
-    SELECT *,
-        ROW_NUMBER() OVER(PARTITION BY IMO, OD, unique_route_id ORDER BY elapsed_time) as journey_obs
-    FROM {schema}.{table}
-    """
-    logger.info(f"Downloading ocean journeys dataset with sql statement:\n\t{sql}")
-
-    with pyodbc_connect() as conn:
-        df: pd.DataFrame = pd.read_sql(
-            con=conn,
-            sql=sql
-        )
-        logger.info(f"Dataset:\n{df}")
-        return df
+    store = get_local_training_store()
+    download_configs = configs.get(ConfigKeys.TRAINING_DOWNLOAD) or {}
+    downloader = TrainingDataDownloader(
+        connect=pyodbc_connect,
+        table=f"{schema}.{table}",
+        dialect='tsql',
+        n_connections=int(download_configs.get(ConfigKeys.DOWNLOAD_CONNECTIONS) or DEFAULT_DOWNLOAD_CONNECTIONS),
+        page_journeys=int(download_configs.get(ConfigKeys.PAGE_JOURNEYS) or DEFAULT_PAGE_JOURNEYS),
+        fetch_rows=int(download_configs.get(ConfigKeys.FETCH_ROWS) or DEFAULT_FETCH_ROWS)
+    )
+    logger.info(f"Downloading ocean journeys dataset {schema}.{table} into: {store.dataset_dir}")
+    downloader.download(store.dataset_dir)
+    store.refresh()
+    logger.info(f"Local training store: {store.num_rows} rows, {len(store.parts)} files, columns {store.columns()}")
+    return store.num_rows
 
 
 if __name__ == "__main__":
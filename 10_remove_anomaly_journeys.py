@@ -2,29 +2,34 @@
 This module will save a local copy of the training. This way,
 we will not need to download the data from Synapse each time
 """
-import os
 import logging
+import numpy as np
 import pandas as pd
-import pickle
-from ocean_pta_training import Environment
+from ocean_pta_training import Journeys, LocalTrainingStore
+from ocean_pta_training.training_store import get_local_training_store
 from typing import Dict, List
 
 logger = logging.getLogger(f"{__name__}")
 
 REMAINING_LEAD_TIME_CUTOFF = 80
+JOURNEY_KEY_COLUMNS = ['IMO', 'OD', 'unique_route_id']
+# Columns read from the local training store (the other columns are not loaded)
+LOAD_COLUMNS = JOURNEY_KEY_COLUMNS + ['elapsed_time', 'ocean_distance', 'remaining_lead_time']
+# Set to a file path (e.g. "./journeys_df.csv") to write the records, with their is_invalid_jump flag, for debugging
+JOURNEYS_DEBUG_CSV_FILE = None
 
 
 def main():
     try:
-        all_data_df = load()
+        store = get_local_training_store()
+        all_data_df = load(store)
         sort_data(all_data_df)
-        all_data_df = all_data_df
         all_data_df = exclude_outlier_remaining_lead_time(all_data_df)
         anomalies = flag_anomaly_journeys(all_data_df)
         logger.info(f"[ANOMALY_JOURNEYS] {anomalies}")
         all_data_df = exclude_anomalies(all_data_df, anomalies)
         logger.info(f"[CLEANED_DATASET]\n{all_data_df}")
-        save(all_data_df)
+        save(store, all_data_df)
     except Exception as e:
         logger.error(f"An unexpected exception occurred: {e}")
 
@@ -34,19 +39,14 @@ def exclude_anomalies(journeys_df: pd.DataFrame, anomalies: List[Dict]):
     Remove journeys having anomalous patterns in the estimated remaining distance
     (e.g. a very large jump in remaining distance after only a few hours timedelta
     """
-    trim_record = pd.Series(False, journeys_df.index)
-    for anomaly in anomalies:
-        anomaly_df = journeys_df[
-            (journeys_df['IMO'] == anomaly.get('IMO')) &
-            (journeys_df['OD'] == anomaly.get('OD')) &
-            (journeys_df['unique_route_id'] == anomaly.get('unique_route_id'))
-        ]
-        trim_record.loc[anomaly_df.index] = True
-
-    return (
-        journeys_df[~trim_record]
-        .reset_index(drop=True)
-    )
+    if not anomalies:
+        return journeys_df
+    # A single hashed anti-join on the journey keys
+    anomaly_keys = pd.MultiIndex.from_frame(pd.DataFrame(anomalies)[JOURNEY_KEY_COLUMNS])
+    trim_record = pd.MultiIndex.from_frame(journeys_df[JOURNEY_KEY_COLUMNS]).isin(anomaly_keys)
+
+    # The index is kept: it holds the rows' positions in the local training store
+    return journeys_df[~trim_record]
 
 
 def exclude_outlier_remaining_lead_time(journeys_df: pd.DataFrame) -> pd.DataFrame:
@@ -54,11 +54,7 @@ def exclude_outlier_remaining_lead_time(journeys_df: pd.DataFrame) -> pd.DataFra
     Apply a hard cutoff on the observed value of remaining_lead_time
     """
     cutoff = REMAINING_LEAD_TIME_CUTOFF
-    return (
-        journeys_df
-        [journeys_df['remaining_lead_time'] <= cutoff]
-        .reset_index(drop=True)
-    )
+    return journeys_df[journeys_df['remaining_lead_time'] <= cutoff]
 
 
 def is_distance_step_anomalous(this_idx, this_imo, this_route_id, this_ocean_distance,
@@ -85,69 +81,37 @@ def flag_anomaly_journeys(journeys_df) -> List:
     """
     Analyze each unique journey and flag the records where remaining
     distance is an unrealistic jump compared to the previous values.
+    journeys_df must be sorted (see sort_data).
     """
     distance_threshold = 2500
     time_delta_threshold = 0.5
-    sort_data(journeys_df)
-
-    # We will reference columns by their index (for speed)
-    elapsed_time_col_idx = 9999
-    imo_col_idx = 9999
-    od_col_idx = 9999
-    route_id_col_idx = 9999
-    ocean_distance_col_idx = 9999
-    for idx, col_name in enumerate(journeys_df.columns):
-        if col_name == 'IMO':
-            imo_col_idx = idx
-        elif col_name == 'OD':
-            od_col_idx = idx
-        elif col_name == 'unique_route_id':
-            route_id_col_idx = idx
-        elif col_name == 'elapsed_time':
-            elapsed_time_col_idx = idx
-        elif col_name == 'ocean_distance':
-            ocean_distance_col_idx = idx
-
-    journeys_df['is_invalid_jump'] = False
-    is_invalid_jump_col_idx = len(journeys_df.columns) - 1
-
-    imo = journeys_df.iloc[0, imo_col_idx]
-    od = journeys_df.iloc[0, od_col_idx]
-    unique_route_id = journeys_df.iloc[0, route_id_col_idx]
-    for idx in range(len(journeys_df.index)):
-        if idx == 0:
-            continue
-        elif (journeys_df.iloc[idx, imo_col_idx] != imo or
-              journeys_df.iloc[idx, od_col_idx] != od or
-              journeys_df.iloc[idx, route_id_col_idx] != unique_route_id):
-            imo = journeys_df.iloc[idx, imo_col_idx]
-            od = journeys_df.iloc[idx, od_col_idx]
-            unique_route_id = journeys_df.iloc[idx, route_id_col_idx]
-        else:
-            elapsed_time_delta = (
-                journeys_df.iloc[idx, elapsed_time_col_idx] -
-                journeys_df.iloc[idx-1, elapsed_time_col_idx]
-            )
-            this_ocean_dist = journeys_df.iloc[idx, ocean_distance_col_idx]
-            last_ocean_dist = journeys_df.iloc[idx - 1, ocean_distance_col_idx]
-
-            if (
-                    elapsed_time_delta <= time_delta_threshold and
-                    abs(this_ocean_dist - last_ocean_dist) > distance_threshold
-            ):
-                journeys_df.iloc[idx, is_invalid_jump_col_idx] = True
-
-    journeys_df.to_csv("./journeys_df.csv", index=False)
+
+    journeys = Journeys.from_frame(
+        journeys_df,
+        key_columns=JOURNEY_KEY_COLUMNS,
+        columns=['elapsed_time', 'ocean_distance'],
+        check_contiguous=False
+    )
+    # Differences with the previous record of the same journey (NaN at the first record of each journey)
+    elapsed_time_delta = journeys.diff('elapsed_time')
+    ocean_distance_delta = journeys.diff('ocean_distance')
+    journeys_df['is_invalid_jump'] = (
+        (elapsed_time_delta <= time_delta_threshold) &
+        (np.abs(ocean_distance_delta) > distance_threshold)
+    )
+
+    if JOURNEYS_DEBUG_CSV_FILE:
+        journeys_df.to_csv(JOURNEYS_DEBUG_CSV_FILE, index=False)
 
     anomaly_journeys = (
         journeys_df[(journeys_df['is_invalid_jump'])]
-        [['IMO', 'OD', 'unique_route_id']]
+        [JOURNEY_KEY_COLUMNS]
         .drop_duplicates()
         .reset_index(drop=True)
         .to_dict(orient='records')
     )
     logger.info(f"Anomalous journeys: {len(anomaly_journeys)}")
-    logger.info(f"Total journeys: {len(journeys_df[['IMO', 'OD', 'unique_route_id']].drop_duplicates())}")
+    logger.info(f"Total journeys: {len(journeys)}")
     logger.info(f"Flagged {len(anomaly_journeys)} anomalous journeys")
     return anomaly_journeys
 
@@ -160,22 +124,16 @@ def sort_data(df: pd.DataFrame):
     )
 
 
-def load() -> pd.DataFrame:
-    """Load the dataset (local)"""
-    local_data_path = os.environ.get(Environment.Vars.PATH_TO_LOCAL_TRAINING_DATA)
-    logger.info(f"Loading ocean journeys dataset locally from file: {local_data_path}")
-    with open(local_data_path, 'rb') as pickle_file:
-        df: pd.DataFrame = pickle.load(pickle_file)
-        return df
+def load(store: LocalTrainingStore) -> pd.DataFrame:
+    """Load the columns used from the local training store (indexed by row position in the store)"""
+    logger.info(f"Loading ocean journeys dataset columns {LOAD_COLUMNS} from: {store.dataset_dir}")
+    return store.read(columns=LOAD_COLUMNS)
 
 
-def save(df: pd.DataFrame):
-    """Save the dataset after it has been processed."""
-    local_data_path = os.environ.get(Environment.Vars.PATH_TO_LOCAL_TRAINING_DATA)
-    logger.info(f"Saving ocean journeys dataset locally as file: {local_data_path}")
-    with open(local_data_path, 'wb') as pickle_file:
-        pickle.dump(df, pickle_file)
-    logger.info(f"Saving ocean journeys dataset to file: {local_data_path}")
+def save(store: LocalTrainingStore, df: pd.DataFrame):
+    """Keep only the rows of the dataset left after it has been processed, in the local training store."""
+    store.keep_rows(df.index)
+    logger.info(f"Saved the cleaned ocean journeys dataset to: {store.dataset_dir}")
 
 
 if __name__ == "__main__":
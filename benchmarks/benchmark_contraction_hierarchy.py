@@ -0,0 +1,96 @@
+"""
+Validate and benchmark the contraction hierarchy (ocean_pta_training.geojson_inference.contraction)
+against igraph's Dijkstra search (g.get_shortest_paths), on seeded random pairs of network nodes:
+
+    1. the distance of each query equals igraph's, within TOLERANCE
+    2. each unpacked edge path runs from the source to the target, and its length is that distance
+    3. point-to-point query time, for both
+
+Exits with a non-zero status if a query disagrees with igraph. Run from the repository root (the package
+need not be installed):
+
+    python benchmarks/benchmark_contraction_hierarchy.py
+"""
+import logging
+import os
+import sys
+import time
+
+# The package is imported from the repository root, which is not on sys.path when run as benchmarks/<script>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from ocean_pta_training.geojson_inference import get_network, ContractionHierarchy
+
+logger = logging.getLogger(f"{__name__}")
+
+SEED = 20220325
+N_PAIRS = 2_000
+TOLERANCE = 1e-9  # relative
+
+
+def path_endpoints_ok(edges: np.ndarray, path, source: int, target: int) -> bool:
+    """True if the edges of path chain from source to target"""
+    node = source
+    for u, v in edges[path].tolist():
+        if node == u:
+            node = v
+        elif node == v:
+            node = u
+        else:
+            return False
+    return node == target
+
+
+def main():
+    rng = np.random.default_rng(SEED)
+    network = get_network()
+    g = network.graph
+    edges = np.asarray(network.edges)
+    weights = np.asarray(network.weights)
+
+    start = time.perf_counter()
+    hierarchy = ContractionHierarchy.build(network)
+    logger.info(f"Built the contraction hierarchy in {time.perf_counter() - start:.1f}s")
+    hierarchy.up  # build the query lists before timing
+
+    sources = rng.integers(0, network.n_nodes, N_PAIRS)
+    targets = rng.integers(0, network.n_nodes, N_PAIRS)
+
+    start = time.perf_counter()
+    expected_paths = [
+        g.get_shortest_paths(int(s), to=int(t), weights="weight", output="epath")[0] for s, t in zip(sources, targets)
+    ]
+    igraph_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = [hierarchy.query(s, t) for s, t in zip(sources, targets)]
+    hierarchy_seconds = time.perf_counter() - start
+
+    failures = []
+    same_paths = 0
+    for s, t, expected_path, (distance, path) in zip(sources, targets, expected_paths, results):
+        expected = np.sum(weights[expected_path]) if expected_path or s == t else np.inf
+        if not (distance == expected or abs(distance - expected) <= TOLERANCE * expected):
+            failures.append(f"{s} -> {t}: distance {distance}, igraph {expected}")
+        elif np.isfinite(distance) and not (
+            path_endpoints_ok(edges, path, s, t) and abs(np.sum(weights[path]) - distance) <= TOLERANCE * distance
+        ):
+            failures.append(f"{s} -> {t}: the unpacked path does not match its distance {distance}")
+        same_paths += list(path) == list(expected_path)
+
+    logger.info(
+        f"{N_PAIRS} queries: contraction hierarchy {1e6 * hierarchy_seconds / N_PAIRS:.0f}us per query, "
+        f"igraph {1e6 * igraph_seconds / N_PAIRS:.0f}us per query ({igraph_seconds / hierarchy_seconds:.1f}x); "
+        f"{same_paths} identical edge paths (the others are ties of equal length)"
+    )
+    if failures:
+        for failure in failures[:20]:
+            logger.error(f"FAILED: {failure}")
+        sys.exit(1)
+    logger.info("All contraction hierarchy queries match igraph")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark the shared geodesy kernels (ocean_pta_training.geo) against the haversine
+package they replaced, on seeded random workloads shaped like the three call sites:
+
+    1. closest_port_ser             nearest port to each stopped ping (nautical miles)
+    2. get_closest_node_on_network  nearest network node to each query point (km)
+    3. get_poi_flag                 is any path node within 5 km of a point of interest (km)
+
+Exits with a non-zero status if a result differs from the reference by more than the tolerance. Runs
+from the repository root without installing the package:
+
+    python benchmarks/benchmark_geo_kernels.py
+"""
+import logging
+import os
+import sys
+import time
+
+# The package is imported from the repository root, which is not on sys.path when run as benchmarks/<script>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from haversine import haversine_vector, Unit
+
+from ocean_pta_training import geo
+
+logger = logging.getLogger(f"{__name__}")
+
+SEED = 20220325
+TOLERANCE_KM = {np.float64: 1e-6, np.float32: 5e-2}
+
+
+def random_latlon(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Points uniformly distributed on the sphere, in degrees"""
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    lon = rng.uniform(-180, 180, n)
+    return np.column_stack([lat, lon])
+
+
+def perturb(rng: np.random.Generator, latlon: np.ndarray, n: int, scale_deg: float) -> np.ndarray:
+    """Points scattered around randomly chosen points of latlon"""
+    centers = latlon[rng.integers(0, len(latlon), n)]
+    points = centers + rng.normal(0, scale_deg, (n, 2))
+    points[:, 0] = np.clip(points[:, 0], -90, 90)
+    points[:, 1] = (points[:, 1] + 180) % 360 - 180
+    return points
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_nearest_neighbour(name: str, queries: np.ndarray, references: np.ndarray, unit: Unit, geo_unit: str):
+    failures = []
+    reference_distances, reference_seconds = timed(haversine_vector, references, queries, unit, comb=True)
+    reference_idx = np.argmin(reference_distances, axis=1)
+    reference_min = reference_distances[np.arange(len(queries)), reference_idx]
+
+    for dtype in (np.float64, np.float32):
+        (idx, distances), seconds = timed(geo.nearest_neighbour, queries, references, geo_unit, dtype=dtype)
+        # With float32, near-ties may pick a different (equally close) neighbour, so compare distances
+        max_error = np.max(np.abs(distances - reference_min)) / geo.UNIT_CONVERSIONS[geo_unit]
+        agreement = np.mean(idx == reference_idx)
+        logger.info(
+            f"[{name}] {np.dtype(dtype).name}: {seconds:.3f}s (haversine package: {reference_seconds:.3f}s), "
+            f"max error {max_error:.2e} km, same neighbour for {100 * agreement:.3f}% of queries"
+        )
+        if max_error > TOLERANCE_KM[dtype]:
+            failures.append(f"{name} ({np.dtype(dtype).name}): max error {max_error} km")
+    return failures
+
+
+def benchmark_within_radius(name: str, pois: list, path: np.ndarray, radius_km: float):
+    failures = []
+
+    def reference_flags():
+        return np.array([
+            np.max(np.where(np.min(haversine_vector(pairs, path, Unit.KILOMETERS, comb=True), axis=0) < radius_km, 1, 0))
+            for pairs in pois
+        ])
+
+    def geo_flags(dtype):
+        path_points = geo.GeoPoints(path, dtype=dtype)
+        return np.array([int(np.any(geo.within_radius(pairs, path_points, radius_km, dtype=dtype))) for pairs in pois])
+
+    expected, reference_seconds = timed(reference_flags)
+    for dtype in (np.float64, np.float32):
+        flags, seconds = timed(geo_flags, dtype)
+        logger.info(
+            f"[{name}] {np.dtype(dtype).name}: {seconds:.3f}s (haversine package: {reference_seconds:.3f}s), "
+            f"{int(np.sum(flags))} of {len(pois)} flagged, {int(np.sum(flags != expected))} mismatches"
+        )
+        if dtype is np.float64 and not np.array_equal(flags, expected):
+            failures.append(f"{name} ({np.dtype(dtype).name}): flags differ from the haversine package")
+    return failures
+
+
+def main():
+    rng = np.random.default_rng(SEED)
+    failures = []
+
+    ports = random_latlon(rng, 300)
+    pings = perturb(rng, ports, 200_000, 0.1)
+    failures += benchmark_nearest_neighbour("closest_port_ser", pings, ports, Unit.NAUTICAL_MILES, geo.NAUTICAL_MILES)
+
+    nodes = random_latlon(rng, 8_500)
+    points = perturb(rng, nodes, 2_000, 1.0)
+    failures += benchmark_nearest_neighbour(
+        "get_closest_node_on_network", points, nodes, Unit.KILOMETERS, geo.KILOMETERS
+    )
+
+    path = perturb(rng, random_latlon(rng, 20), 2_000, 2.0)
+    pois = [perturb(rng, path, int(rng.integers(2, 7)), 0.05).tolist() for _ in range(6)]
+    pois += [random_latlon(rng, int(rng.integers(2, 7))).tolist() for _ in range(6)]
+    failures += benchmark_within_radius("get_poi_flag", pois, path, 5)
+
+    if failures:
+        for failure in failures:
+            logger.error(f"FAILED: {failure}")
+        sys.exit(1)
+    logger.info("All geodesy kernels match the haversine package within tolerance")
+
+
+if __name__ == "__main__":
+    main()
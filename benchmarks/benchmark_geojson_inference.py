@@ -0,0 +1,199 @@
+"""
+Throughput of geojson inference (ocean_pta_training.geojson_inference) on seeded query workloads:
+
+    short_sea      both ends in northern European waters
+    transpacific   East Asia to the North American west coast
+    via_suez       Europe and the Mediterranean to South and East Asia
+    via_panama     the US east coast and the Caribbean to the Pacific coast of the Americas
+    degenerate     both ends snap to the same network node
+
+Each workload is timed end to end through calculate_shortest_path, and by stage: snapping both ends
+to the network, routing (batched shortest-path trees, and the contraction hierarchy if one is passed
+with --hierarchy-dir) and POI flagging. Each timing is the best of REPEATS runs. Results are written as JSON; pass --compare with an earlier
+results file to print the change of each timing. As for the numbered scripts, the first argument is the
+.env file (read when the package is imported), which must be given before any option. Run from the repository
+root; the package need not be installed:
+
+    python benchmarks/benchmark_geojson_inference.py .env --output results.json [--compare previous.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, Tuple
+
+# The package is imported from the repository root, which is not on sys.path when run as benchmarks/<script>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import igraph
+import numpy as np
+import pandas as pd
+
+from ocean_pta_training.geojson_inference import (
+    calculate_shortest_path, get_network, get_poi_list, ContractionHierarchy
+)
+from ocean_pta_training.geojson_inference.network import poi_mask_to_flags
+from ocean_pta_training.geojson_inference.shortest_path.graphfunctions import (
+    get_edge_paths_batched, get_path_poi_mask
+)
+
+logger = logging.getLogger(f"{__name__}")
+
+SEED = 20220325
+N_ROWS = 2_000
+N_DESTINATIONS = 20  # distinct destinations per workload, as a batch of the labeler holds a few ODs
+JITTER_DEG = 0.2
+REPEATS = 3  # each timing is the best of this many runs
+
+# (min lat, max lat, min lon, max lon) of the sources and of the destinations
+WORKLOADS: Dict[str, Tuple[Tuple[float, ...], Tuple[float, ...]]] = {
+    "short_sea": ((50, 60, -5, 25), (50, 60, -5, 25)),
+    "transpacific": ((20, 45, 118, 145), (30, 50, -130, -115)),
+    "via_suez": ((35, 55, -10, 30), (0, 25, 75, 120)),
+    "via_panama": ((25, 40, -80, -70), (5, 35, -125, -100)),
+}
+EXPECTED_POI = {"via_suez": "suez", "via_panama": "panama"}
+
+
+def nodes_in_box(node_latlon: np.ndarray, box: Tuple[float, ...]) -> np.ndarray:
+    min_lat, max_lat, min_lon, max_lon = box
+    lat, lon = node_latlon[:, 0], node_latlon[:, 1]
+    return np.flatnonzero((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon))
+
+
+def make_workload(rng: np.random.Generator, node_latlon: np.ndarray, name: str) -> pd.DataFrame:
+    """Seeded queries: sources near random nodes of a region, destinations at a few nodes of another"""
+    if name == "degenerate":
+        nodes = node_latlon[rng.integers(0, len(node_latlon), N_ROWS)]
+        return pd.DataFrame({
+            "olat": nodes[:, 0] + rng.normal(0, 1e-4, N_ROWS), "olon": nodes[:, 1] + rng.normal(0, 1e-4, N_ROWS),
+            "dlat": nodes[:, 0], "dlon": nodes[:, 1]
+        })
+    source_box, destination_box = WORKLOADS[name]
+    sources = node_latlon[rng.choice(nodes_in_box(node_latlon, source_box), N_ROWS)]
+    sources = sources + rng.normal(0, JITTER_DEG, sources.shape)
+    destinations = node_latlon[rng.choice(nodes_in_box(node_latlon, destination_box), N_DESTINATIONS)]
+    destinations = destinations[rng.integers(0, N_DESTINATIONS, N_ROWS)]
+    return pd.DataFrame({
+        "olat": sources[:, 0], "olon": sources[:, 1], "dlat": destinations[:, 0], "dlon": destinations[:, 1]
+    })
+
+
+def timed(func, *args, **kwargs):
+    """Result of func, and its best run time out of REPEATS"""
+    best_seconds = np.inf
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    return result, best_seconds
+
+
+def benchmark_workload(name: str, df: pd.DataFrame, hierarchy=None) -> Dict:
+    network = get_network()
+    poi_names, poi_latlon = get_poi_list()
+    edge_poi_masks = network.edge_poi_mask(poi_latlon)
+
+    results, end_to_end_seconds = timed(calculate_shortest_path, df)
+    (source_nodes, _), source_seconds = timed(network.snap, df[["olat", "olon"]].values)
+    (target_nodes, _), target_seconds = timed(network.snap, df[["dlat", "dlon"]].values)
+    edge_paths, routing_seconds = timed(get_edge_paths_batched, network.graph, source_nodes, target_nodes)
+
+    def flag_paths():
+        masks = np.array([get_path_poi_mask(edge_poi_masks, path) if path else 0 for path in edge_paths], dtype=np.uint16)
+        return poi_mask_to_flags(masks, len(poi_latlon))
+    flags, poi_seconds = timed(flag_paths)
+
+    n_rows = len(df.index)
+    timings = {
+        "end_to_end_seconds": end_to_end_seconds,
+        "snap_seconds": source_seconds + target_seconds,
+        "route_seconds": routing_seconds,
+        "poi_seconds": poi_seconds,
+    }
+    if hierarchy is not None:
+        _, timings["route_hierarchy_seconds"] = timed(hierarchy.get_edge_paths, source_nodes, target_nodes)
+
+    ocean_distance = np.asarray(results["ocean_distance"], dtype=np.float64)
+    summary = {
+        "rows": n_rows,
+        "rows_per_second": n_rows / end_to_end_seconds,
+        **timings,
+        "distinct_target_nodes": int(len(np.unique(target_nodes))),
+        "same_node_rows": int(np.sum(source_nodes == target_nodes)),
+        "mean_finite_ocean_distance_km": float(np.mean(ocean_distance[np.isfinite(ocean_distance)]))
+        if np.isfinite(ocean_distance).any() else None,
+        "poi_flag_rates": dict(zip(poi_names, np.mean(flags, axis=0).round(4).tolist())),
+    }
+    logger.info(
+        f"[{name}] {n_rows} rows: {summary['rows_per_second']:.0f} rows/s end to end; "
+        f"snap {timings['snap_seconds']:.3f}s, route {timings['route_seconds']:.3f}s, POI {timings['poi_seconds']:.3f}s"
+        + (f", route (hierarchy) {timings['route_hierarchy_seconds']:.3f}s" if hierarchy is not None else "")
+    )
+    if name in EXPECTED_POI and summary["poi_flag_rates"].get(EXPECTED_POI[name], 0) < 0.5:
+        logger.warning(f"[{name}] fewer than half of the paths pass {EXPECTED_POI[name]}")
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(results: Dict, previous: Dict) -> None:
+    """Log the ratio of each timing to that of a previous run"""
+    for name, summary in results["workloads"].items():
+        previous_summary = previous.get("workloads", {}).get(name)
+        if previous_summary is None:
+            continue
+        changes = [
+            f"{key[:-len('_seconds')]} x{summary[key] / previous_summary[key]:.2f}"
+            for key in summary if key.endswith("_seconds") and previous_summary.get(key)
+        ]
+        logger.info(f"[{name}] vs {previous.get('commit')}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark geojson inference throughput")
+    parser.add_argument("env_file", nargs="?", help=".env file of the package")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--hierarchy-dir", help="contraction hierarchy to time as well")
+    args = parser.parse_args()
+
+    network = get_network()
+    node_latlon = np.asarray(network.node_latlon)
+    hierarchy = ContractionHierarchy.load(args.hierarchy_dir, network) if args.hierarchy_dir else None
+    # Build the graph, node index and POI masks before timing
+    network.graph, network.snapper, network.edge_poi_mask(get_poi_list()[1])
+
+    rng = np.random.default_rng(SEED)
+    results = {
+        "commit": git_commit(),
+        "seed": SEED,
+        "network_fingerprint": network.fingerprint,
+        "python": platform.python_version(),
+        "igraph": igraph.__version__,
+        "numpy": np.__version__,
+        "workloads": {}
+    }
+    for name in list(WORKLOADS) + ["degenerate"]:
+        results["workloads"][name] = benchmark_workload(name, make_workload(rng, node_latlon, name), hierarchy)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        logger.info(f"Wrote the results to {args.output}")
+    if args.compare:
+        with open(args.compare, "r") as previous_file:
+            compare(results, json.load(previous_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Validate and benchmark the keyset-paginated training data download (ocean_pta_training.training_download)
+against a local SQLite stand-in of the Synapse training data table, filled with seeded random journeys:
+
+    1. the downloaded dataset equals the table read at once, in journey order, with journey_obs numbered
+       by ROW_NUMBER() (rows without a journey key excepted); a text column that is NULL in its first
+       rows keeps its declared type
+    2. every connection opened by the downloader is closed
+    3. a download that fails leaves the previous dataset in place, and no temporary directory
+    4. download time and throughput (rows/s)
+
+Exits with a non-zero status if a check fails. Takes the package's .env file (read when the package is
+imported), which must be given before any option. Run from the repository root; the package need not be installed:
+
+    python benchmarks/benchmark_training_download.py .env --rows 500000
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+# The package is imported from the repository root, which is not on sys.path when run as benchmarks/<script>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from ocean_pta_training.training_download import TrainingDataDownloader, JOURNEY_KEY_COLUMNS
+
+logger = logging.getLogger(f"{__name__}")
+
+SEED = 20220325
+TABLE = "OCEAN_JOURNEYS"
+N_NULL_LEADING_ROWS = 11_000  # rows at the start of the table whose status column is NULL
+N_CONNECTIONS = 3
+PAGE_JOURNEYS = 500
+FETCH_ROWS = 5_000
+
+
+class CountingConnection(sqlite3.Connection):
+    """sqlite3 connection counting the connections opened and closed"""
+    n_opened = 0
+    n_closed = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        CountingConnection.n_opened += 1
+
+    def close(self):
+        CountingConnection.n_closed += 1
+        super().close()
+
+
+def make_table(db_path: str, n_rows: int) -> None:
+    rng = np.random.default_rng(SEED)
+    df = pd.DataFrame({
+        'IMO': rng.integers(9_000_000, 9_000_400, n_rows),
+        'OD': rng.choice(['CNSHA-USLAX', 'NLRTM-SGSIN', 'DEHAM-USNYC', 'SGSIN-AEJEA'], n_rows),
+        'unique_route_id': rng.integers(0, 12, n_rows),
+        'elapsed_time': rng.random(n_rows) * 500,
+        'ocean_distance': rng.random(n_rows) * 10_000,
+        'remaining_lead_time': rng.random(n_rows) * 80,
+        'TimePosition': pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 10 ** 7, n_rows), unit='s'),
+        'status': np.where(rng.random(n_rows) < 0.5, 'late', 'on time')
+    })
+    df.loc[:N_NULL_LEADING_ROWS - 1, 'status'] = None
+    df.loc[rng.random(n_rows) < 0.001, 'OD'] = None
+    with sqlite3.connect(db_path) as connection:
+        df.to_sql(TABLE, connection, index=False)
+    connection.close()
+
+
+def read_reference(db_path: str) -> pd.DataFrame:
+    """The table read at once, as the query the download replaces"""
+    sql = f"""
+    SELECT *,
+        ROW_NUMBER() OVER(PARTITION BY IMO, OD, unique_route_id ORDER BY elapsed_time) as journey_obs
+    FROM {TABLE}
+    WHERE {' AND '.join(f'{c} IS NOT NULL' for c in JOURNEY_KEY_COLUMNS)}
+    ORDER BY IMO, OD, unique_route_id, elapsed_time
+    """
+    connection = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql(sql, connection)
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the training data download on a SQLite stand-in")
+    parser.add_argument("env_file", nargs="?", help=".env file of the package")
+    parser.add_argument("--rows", type=int, default=300_000, help="number of rows of the table")
+    args = parser.parse_args()
+    failures = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, "journeys.db")
+        dataset_dir = os.path.join(work_dir, "ocean_journeys")
+        make_table(db_path, args.rows)
+
+        def connect():
+            return sqlite3.connect(db_path, factory=CountingConnection, check_same_thread=False)
+
+        downloader = TrainingDataDownloader(
+            connect, TABLE, dialect='sqlite', n_connections=N_CONNECTIONS,
+            page_journeys=PAGE_JOURNEYS, fetch_rows=FETCH_ROWS
+        )
+        start_time = time.perf_counter()
+        n_rows = downloader.download(dataset_dir)
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"Downloaded {n_rows} rows in {elapsed:.2f}s ({n_rows / elapsed:,.0f} rows/s)")
+
+        downloaded = pd.read_parquet(dataset_dir)
+        reference = read_reference(db_path)
+        try:
+            pd.testing.assert_frame_equal(downloaded.reset_index(drop=True), reference)
+        except AssertionError as e:
+            failures.append(f"the downloaded dataset differs from the table: {e}")
+        if CountingConnection.n_closed != CountingConnection.n_opened:
+            failures.append(
+                f"{CountingConnection.n_opened - CountingConnection.n_closed} of "
+                f"{CountingConnection.n_opened} connections were left open"
+            )
+
+        # The third connection (the second IMO range's) fails, once the temporary directory is written to
+        CountingConnection.n_opened = CountingConnection.n_closed = 0
+
+        def failing_connect():
+            connection = connect()
+            if CountingConnection.n_opened > 2:
+                connection.close()
+                raise sqlite3.OperationalError("connection lost")
+            return connection
+
+        try:
+            TrainingDataDownloader(
+                failing_connect, TABLE, dialect='sqlite', n_connections=N_CONNECTIONS,
+                page_journeys=PAGE_JOURNEYS, fetch_rows=FETCH_ROWS
+            ).download(dataset_dir)
+            failures.append("a download whose connections fail did not raise")
+        except sqlite3.OperationalError:
+            pass
+        if os.path.exists(f"{dataset_dir}.partial"):
+            failures.append("a failed download left its temporary directory")
+        if len(pd.read_parquet(dataset_dir).index) != n_rows:
+            failures.append("a failed download did not leave the previous dataset in place")
+
+    if failures:
+        for failure in failures:
+            logger.error(f"FAILED: {failure}")
+        sys.exit(1)
+    logger.info("The download matches the table, closes its connections, and survives a failed run")
+
+
+if __name__ == "__main__":
+    main()
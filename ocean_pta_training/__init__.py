@@ -3,10 +3,15 @@ from .env import Environment
 Environment.set()
 
 from .config import configs, ConfigKeys
+from .feature_store import ODFeatureStore
 from .geojson_inference import *
+from .journey_index import JourneyIndex
+from .journeys import Journeys
 from .logging import set_logging_config
+from .port_dictionary import PortDictionary, load_port_dictionary
 from .route_extraction import OriginDestinationRouteExtractor  # expose the feature extraction utility
 from .trainer import ModelTrainer
+from .training_store import LocalTrainingStore
 from .utilities import pyodbc_connect
 
 set_logging_config()
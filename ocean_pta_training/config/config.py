@@ -13,6 +13,29 @@ class Keys:
     LOGGING_LEVEL = "level"
     DO_LOG_TO_FILE = "log_to_file"
 
+    # Combined dataset related configs
+    COMBINED_DATASET = "COMBINED_DATASET"
+    OD_EXTRACTS_DIR = "od_extracts_dir"
+    READ_WORKERS = "read_workers"
+
+    # Training data download related configs
+    TRAINING_DOWNLOAD = "TRAINING_DOWNLOAD"
+    DOWNLOAD_CONNECTIONS = "connections"
+    PAGE_JOURNEYS = "page_journeys"
+    FETCH_ROWS = "fetch_rows"
+
+    # Geojson inference related configs
+    GEOJSON_INFERENCE = "GEOJSON_INFERENCE"
+    PATH_CACHE_SIZE = "path_cache_size"
+    PATH_CACHE_FILE = "path_cache_file"
+    LABEL_WORKERS = "label_workers"
+    INTERPOLATE_UNFLAGGED_PINGS = "interpolate_unflagged_pings"
+    LABEL_CACHE_FILE = "label_cache_file"
+    LABEL_CACHE_RESOLUTION = "label_cache_resolution"
+    HOURS_BETWEEN_LABELS = "hours_between_labels"
+    KM_BETWEEN_LABELS = "km_between_labels"
+    MAX_LABELS_PER_JOURNEY = "max_labels_per_journey"
+
 def load_config() -> dict:
     """
     Load configurations from a YAML file
@@ -2,3 +2,6 @@ from typing import Final
 
 DEFAULT_OUTPUT_FILE_DIRECTORY: Final = "DEFAULT_OUTPUT_FILE_DIRECTORY"
 JOBS: Final = "JOBS"
+PORT_DICTIONARY_FILE_NAME: Final = "port_dictionary.json"
+JOURNEY_INDEX_FILE_NAME: Final = "journey_index.feather"
+OD_FEATURE_STORE_SUBDIR: Final = "od_feature_store"
@@ -27,7 +27,7 @@ class Environment:
         OCEAN_JOURNEY_FEATURES_TABLE = "OCEAN_JOURNEY_FEATURES_TABLE"
         OCEAN_JOURNEY_RESPONSE_TABLE = "OCEAN_JOURNEY_RESPONSE_TABLE"
         OCEAN_JOURNEY_DATA_TABLE = "OCEAN_JOURNEY_DATA_TABLE"
-        PATH_TO_LOCAL_TRAINING_DATA = "PATH_TO_LOCAL_TRAINING_DATA"
+        PATH_TO_LOCAL_TRAINING_DATASET = "PATH_TO_LOCAL_TRAINING_DATASET"
         BLOB_SERVICE_CONNECTION_STRING = "BLOB_SERVICE_CONNECTION_STRING"
         BLOB_SERVICE_ACCESS_KEY = "BLOB_SERVICE_ACCESS_KEY"
         BLOB_SERVICE_URL = "BLOB_SERVICE_URL"
@@ -0,0 +1,213 @@
+"""
+Aggregate features of each OD and of each (IMO, OD) pair, and kept as Parquet files under
+$PATH_TO_OUTPUT_DIRECTORY/od_feature_store/:
+
+    od_features.parquet       by OD: share of time moving, mean and median speed while moving,
+                              and the number, mean and median of intermediate ports of its journeys
+    imo_od_features.parquet   by (IMO, OD): the number, mean and median of intermediate ports
+
+The features are read from the OD aggregates saved by the route extractor (od_stats/od_aggregates.json) when
+there are any, so that neither the combined OD dataset nor the port sequences are scanned. Otherwise, they are
+computed from the combined OD dataset and the combined port sequences.
+
+ODs are identified by their port dictionary code, so that features are joined to a frame through
+integer lookups rather than merges on OD strings. The schema metadata of each file records the format
+version and the size and modification time of the source files; the store is rebuilt when they change.
+"""
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from typing import Dict, Optional
+from .constants import OD_FEATURE_STORE_SUBDIR
+from .env import Environment
+from .port_dictionary import PortDictionary
+from .route_extraction.constants import OD_AGGREGATES_FILENAME, OUTPUT_STATS_SUBDIR
+from .route_extraction.od_aggregates import ODAggregates
+
+logger = logging.getLogger(f"{__name__}")
+
+OD_FEATURES_FILE_NAME = "od_features.parquet"
+IMO_OD_FEATURES_FILE_NAME = "imo_od_features.parquet"
+FEATURE_STORE_METADATA_KEY = b"od_feature_store"
+# Minimum number of port sequences of an (IMO, OD) pair for its own intermediate ports features to be used
+MIN_IMO_OD_SAMPLE_SIZE = 5
+
+
+def file_signature(file_path: str) -> Dict:
+    stat = os.stat(file_path)
+    return {"file_path": os.path.abspath(file_path), "file_size": stat.st_size, "file_mtime_ns": stat.st_mtime_ns}
+
+
+def encode_od_index(features: pd.DataFrame, port_dictionary: PortDictionary) -> pd.DataFrame:
+    """Features indexed by OD (or IMO and OD) strings, indexed by OD code instead (ODs not in the dictionary dropped)"""
+    ods = features.index.get_level_values('OD')
+    codes = port_dictionary.encode_ods(pd.Series(ods)).cat.codes.to_numpy()
+    if isinstance(features.index, pd.MultiIndex):
+        features.index = pd.MultiIndex.from_arrays([features.index.get_level_values('IMO'), codes], names=['IMO', 'OD'])
+    else:
+        features.index = pd.Index(codes, name='OD')
+    return features[codes >= 0]
+
+
+class ODFeatureStore(object):
+    """
+    OD features (od_features, indexed by OD code) and (IMO, OD) features (imo_od_features, indexed by IMO and OD code)
+    """
+    FORMAT_VERSION: int = 1
+
+    od_features: pd.DataFrame
+    imo_od_features: pd.DataFrame
+    version: Dict
+
+    def __init__(self, od_features: pd.DataFrame, imo_od_features: pd.DataFrame, version: Dict):
+        self.od_features = od_features
+        self.imo_od_features = imo_od_features
+        self.version = version
+
+    @staticmethod
+    def get_version(combined_data_path: str, port_sequence_path: str, od_aggregates_path: Optional[str] = None) -> Dict:
+        """Signatures of the source files: the OD aggregates if the file exists, else the combined OD dataset and port sequences"""
+        if od_aggregates_path and os.path.isfile(od_aggregates_path):
+            return {"format_version": ODFeatureStore.FORMAT_VERSION, "od_aggregates": file_signature(od_aggregates_path)}
+        return {
+            "format_version": ODFeatureStore.FORMAT_VERSION,
+            "combined_data": file_signature(combined_data_path),
+            "port_sequences": file_signature(port_sequence_path)
+        }
+
+    @classmethod
+    def build(cls, combined_data_path: str, port_sequence_path: str, port_dictionary: PortDictionary,
+              od_aggregates_path: Optional[str] = None) -> "ODFeatureStore":
+        """
+        Read the features from the OD aggregates if od_aggregates_path exists; otherwise, aggregate the
+        combined OD dataset and the port sequences, reading only the columns used
+        """
+        version = cls.get_version(combined_data_path, port_sequence_path, od_aggregates_path)
+        if "od_aggregates" in version:
+            logger.info(f"Building OD features from the OD aggregates at {od_aggregates_path}")
+            aggregates = ODAggregates.load(od_aggregates_path)
+            od_features = aggregates.od_features()
+        else:
+            logger.info(f"Building OD features from {combined_data_path} and {port_sequence_path}")
+            combined_df = feather.read_table(
+                combined_data_path, columns=['OD', 'is_moving', 'speed'], memory_map=True
+            ).to_pandas()
+            combined_df['OD'] = combined_df['OD'].astype(str)
+            moving_df = combined_df[combined_df['is_moving'] == 1]
+            moving_features = (
+                combined_df.groupby('OD').agg(moving_portion=('is_moving', 'mean'))
+                .join(moving_df.groupby('OD').agg(avg_speed=('speed', 'mean'), median_speed=('speed', 'median')))
+            )
+            # The port sequence features are summarized as in the extractor's OD aggregates
+            aggregates = ODAggregates()
+            aggregates.add_port_sequences(
+                pd.read_csv(port_sequence_path, usecols=['IMO', 'OD', 'num_intermediate_ports'])
+            )
+            port_sequence_features = aggregates.od_features().reindex(
+                columns=['n', 'avg_intermediate_ports', 'median_intermediate_ports']
+            )
+            od_features = moving_features.join(port_sequence_features, how='outer')
+        imo_od_features = aggregates.imo_od_features()
+
+        od_features = encode_od_index(od_features, port_dictionary)
+        imo_od_features = encode_od_index(imo_od_features, port_dictionary)
+        logger.info(f"...{len(od_features.index)} ODs, {len(imo_od_features.index)} (IMO, OD) pairs")
+        return cls(od_features, imo_od_features, version)
+
+    def save(self, store_dir: str) -> None:
+        os.makedirs(store_dir, exist_ok=True)
+        metadata = {FEATURE_STORE_METADATA_KEY: json.dumps(self.version).encode()}
+        for file_name, features in (
+            (OD_FEATURES_FILE_NAME, self.od_features), (IMO_OD_FEATURES_FILE_NAME, self.imo_od_features)
+        ):
+            table = pa.Table.from_pandas(features.reset_index(), preserve_index=False)
+            file_path = os.path.join(store_dir, file_name)
+            pq.write_table(table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata}), f"{file_path}.tmp")
+            os.replace(f"{file_path}.tmp", file_path)
+        logger.info(f"Saved the OD features to {store_dir}")
+
+    @classmethod
+    def load(cls, store_dir: str, version: Optional[Dict] = None) -> Optional["ODFeatureStore"]:
+        """The store saved in store_dir, or None if there is none (or it was built with another version)"""
+        tables = []
+        for file_name in (OD_FEATURES_FILE_NAME, IMO_OD_FEATURES_FILE_NAME):
+            file_path = os.path.join(store_dir, file_name)
+            if not os.path.isfile(file_path):
+                return None
+            tables.append(pq.read_table(file_path))
+        saved_versions = [json.loads((t.schema.metadata or {}).get(FEATURE_STORE_METADATA_KEY, b"{}")) for t in tables]
+        if saved_versions[0] != saved_versions[1] or (version is not None and saved_versions[0] != version):
+            logger.info(f"The OD features in {store_dir} were built from other source files")
+            return None
+        od_table, imo_od_table = tables
+        return cls(
+            od_table.to_pandas().set_index('OD'),
+            imo_od_table.to_pandas().set_index(['IMO', 'OD']),
+            saved_versions[0]
+        )
+
+    @classmethod
+    def load_or_build(cls, combined_data_path: str, port_sequence_path: str, port_dictionary: PortDictionary,
+                      store_dir: Optional[str] = None, od_aggregates_path: Optional[str] = None) -> "ODFeatureStore":
+        """The saved store if it was built from these source files; otherwise, build it and save it"""
+        store_dir = store_dir or get_od_feature_store_dir()
+        od_aggregates_path = od_aggregates_path or get_od_aggregates_path()
+        store = cls.load(store_dir, cls.get_version(combined_data_path, port_sequence_path, od_aggregates_path))
+        if store is not None:
+            logger.info(f"Loaded the OD features from {store_dir}")
+            return store
+        store = cls.build(combined_data_path, port_sequence_path, port_dictionary, od_aggregates_path)
+        store.save(store_dir)
+        return store
+
+    def join(self, df: pd.DataFrame, port_dictionary: PortDictionary) -> pd.DataFrame:
+        """
+        Add the OD features of each row of df (by its OD and IMO columns):
+            journey_time_moving_pct, median_speed_while_moving, and avg_intermediate_ports
+            (from the row's (IMO, OD) pair if it has at least MIN_IMO_OD_SAMPLE_SIZE port sequences, else from its OD)
+        """
+        od_codes = port_dictionary.encode_ods(df['OD']).cat.codes.to_numpy()
+        has_od = od_codes >= 0
+        od_rows = np.full(len(od_codes), -1, dtype=np.int64)
+        od_rows[has_od] = self.od_features.index.get_indexer(od_codes[has_od])
+
+        imo = pd.to_numeric(df['IMO'], errors='coerce').to_numpy()
+        has_key = has_od & ~np.isnan(imo)
+        imo_od_rows = np.full(len(od_codes), -1, dtype=np.int64)
+        imo_od_rows[has_key] = self.imo_od_features.index.get_indexer(
+            pd.MultiIndex.from_arrays([imo[has_key].astype(np.int64), od_codes[has_key]])
+        )
+
+        def take(features: pd.DataFrame, rows: np.ndarray, column: str) -> np.ndarray:
+            values = np.append(features[column].to_numpy(dtype=np.float64), np.nan)
+            return values[rows]  # row -1 takes the NaN appended
+
+        df['journey_time_moving_pct'] = take(self.od_features, od_rows, 'moving_portion')
+        df['median_speed_while_moving'] = take(self.od_features, od_rows, 'median_speed')
+        use_imo_od = take(self.imo_od_features, imo_od_rows, 'n') >= MIN_IMO_OD_SAMPLE_SIZE
+        df['avg_intermediate_ports'] = np.where(
+            use_imo_od,
+            take(self.imo_od_features, imo_od_rows, 'avg_intermediate_ports'),
+            take(self.od_features, od_rows, 'avg_intermediate_ports')
+        )
+        logger.info(
+            f"Joined OD features: {int(np.sum(od_rows >= 0))} of {len(od_rows)} rows matched an OD, "
+            f"{int(np.sum(use_imo_od))} used their (IMO, OD) intermediate ports"
+        )
+        return df
+
+
+def get_od_feature_store_dir(output_dir: Optional[str] = None) -> str:
+    output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    return os.path.join(output_dir, OD_FEATURE_STORE_SUBDIR)
+
+
+def get_od_aggregates_path(output_dir: Optional[str] = None) -> str:
+    """The OD aggregates saved by the route extractor in its output directory"""
+    output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    return os.path.join(output_dir, OUTPUT_STATS_SUBDIR, OD_AGGREGATES_FILENAME)
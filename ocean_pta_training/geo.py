@@ -0,0 +1,184 @@
+"""
+Vectorized great-circle (haversine) kernels shared by the route extraction and the
+geojson inference. Coordinates are (latitude, longitude) pairs in degrees, which is
+the convention of the haversine package that these kernels replace.
+
+The radians and the cosine of the latitude of a set of points are computed once,
+by wrapping the points in GeoPoints. Pairwise kernels process their input in chunks,
+so that at most chunk_size distances are held in memory at any time.
+
+In float64 mode, the nearest neighbour and radius searches compare the dot products of
+unit vectors (a matrix product), which decrease monotonically with the haversine distance,
+and compute the haversine distance only for the selected pairs. In float32 mode
+the dot product is too coarse for nearby points, so the haversine kernel is used throughout.
+"""
+import numpy as np
+from typing import Final, Tuple, Union
+
+EARTH_RADIUS_KM: Final = 6371.0088  # mean earth radius, as in the haversine package
+
+# Units
+KILOMETERS: Final = "km"
+NAUTICAL_MILES: Final = "nmi"
+UNIT_CONVERSIONS: Final = {
+    KILOMETERS: 1.0,
+    NAUTICAL_MILES: 0.539956803
+}
+
+DEFAULT_CHUNK_SIZE: Final = 2 ** 22  # maximum number of pairwise distances computed at once
+
+
+class GeoPoints(object):
+    """
+    An array of (latitude, longitude) points, with radians and cosines precomputed.
+    Pass dtype=np.float32 to halve memory and speed up the kernels, at the cost of
+    precision (roughly 1 meter for distances under 1000 km).
+    """
+    latlon: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    cos_lat: np.ndarray
+    xyz: np.ndarray  # unit vectors
+
+    def __init__(self, latlon, dtype=np.float64):
+        self.latlon = np.asarray(latlon, dtype=np.float64).reshape(-1, 2)
+        self.lat = np.radians(self.latlon[:, 0]).astype(dtype)
+        self.lon = np.radians(self.latlon[:, 1]).astype(dtype)
+        self.cos_lat = np.cos(self.lat)
+        self.xyz = np.column_stack([
+            self.cos_lat * np.cos(self.lon),
+            self.cos_lat * np.sin(self.lon),
+            np.sin(self.lat)
+        ])
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    @property
+    def dtype(self):
+        return self.lat.dtype
+
+    def take(self, indices) -> "GeoPoints":
+        """Subset of the points, without recomputing radians and cosines"""
+        subset = GeoPoints.__new__(GeoPoints)
+        subset.latlon = self.latlon[indices]
+        subset.lat = self.lat[indices]
+        subset.lon = self.lon[indices]
+        subset.cos_lat = self.cos_lat[indices]
+        subset.xyz = self.xyz[indices]
+        return subset
+
+
+PointsLike = Union[GeoPoints, np.ndarray, list]
+
+
+def as_geo_points(points: PointsLike, dtype=np.float64) -> GeoPoints:
+    """Wrap (latitude, longitude) pairs in GeoPoints, unless they already are"""
+    if isinstance(points, GeoPoints):
+        return points
+    return GeoPoints(points, dtype=dtype)
+
+
+def _haversine_kernel(lat1, lon1, cos_lat1, lat2, lon2, cos_lat2) -> np.ndarray:
+    """Central angle (radians) between points given in radians. Inputs broadcast."""
+    d = (
+        np.sin((lat2 - lat1) * 0.5) ** 2
+        + cos_lat1 * cos_lat2 * np.sin((lon2 - lon1) * 0.5) ** 2
+    )
+    return 2 * np.arcsin(np.sqrt(np.clip(d, 0, 1)))
+
+
+def _radius(unit: str) -> float:
+    try:
+        return EARTH_RADIUS_KM * UNIT_CONVERSIONS[unit]
+    except KeyError:
+        raise ValueError(f"Unsupported unit {unit}; expected one of {list(UNIT_CONVERSIONS)}")
+
+
+def haversine(points1: PointsLike, points2: PointsLike, unit: str = KILOMETERS, dtype=np.float64) -> np.ndarray:
+    """Element-wise distance between two arrays of points of the same length"""
+    p1 = as_geo_points(points1, dtype)
+    p2 = as_geo_points(points2, dtype)
+    if len(p1) != len(p2):
+        raise ValueError(f"Cannot compute element-wise distances between {len(p1)} and {len(p2)} points")
+    return _radius(unit) * _haversine_kernel(p1.lat, p1.lon, p1.cos_lat, p2.lat, p2.lon, p2.cos_lat)
+
+
+def haversine_matrix(queries: PointsLike, references: PointsLike,
+                     unit: str = KILOMETERS, dtype=np.float64) -> np.ndarray:
+    """
+    Distances between every query and every reference point; shape (len(queries), len(references)).
+    Equivalent to haversine_vector(references, queries, comb=True). Not chunked: see nearest_neighbour
+    and within_radius for reductions over large inputs.
+    """
+    q = as_geo_points(queries, dtype)
+    r = as_geo_points(references, dtype)
+    return _radius(unit) * _haversine_kernel(
+        q.lat[:, None], q.lon[:, None], q.cos_lat[:, None],
+        r.lat[None, :], r.lon[None, :], r.cos_lat[None, :]
+    )
+
+
+def _iter_query_chunks(n_queries: int, n_references: int, chunk_size: int):
+    """Slices of queries such that each chunk has at most chunk_size pairwise distances"""
+    rows = max(1, chunk_size // max(n_references, 1))
+    for start in range(0, n_queries, rows):
+        yield slice(start, min(start + rows, n_queries))
+
+
+def nearest_neighbour(queries: PointsLike, references: PointsLike, unit: str = KILOMETERS,
+                      dtype=np.float64, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    For each query point, return the position of the closest reference point and the distance to it.
+    Ties are resolved in favour of the first reference point (as np.argmin does).
+    """
+    q = as_geo_points(queries, dtype)
+    r = as_geo_points(references, dtype)
+    if len(r) == 0:
+        raise ValueError("Cannot search for nearest neighbours among zero reference points")
+
+    closest = np.empty(len(q), dtype=np.int64)
+    closest_angle = np.empty(len(q), dtype=q.dtype)
+    for chunk in _iter_query_chunks(len(q), len(r), chunk_size):
+        if q.dtype == np.float64:
+            idx = np.argmax(q.xyz[chunk] @ r.xyz.T, axis=1)
+            closest_angle[chunk] = _haversine_kernel(
+                q.lat[chunk], q.lon[chunk], q.cos_lat[chunk],
+                r.lat[idx], r.lon[idx], r.cos_lat[idx]
+            )
+        else:
+            angles = _haversine_kernel(
+                q.lat[chunk, None], q.lon[chunk, None], q.cos_lat[chunk, None],
+                r.lat[None, :], r.lon[None, :], r.cos_lat[None, :]
+            )
+            idx = np.argmin(angles, axis=1)
+            closest_angle[chunk] = angles[np.arange(len(idx)), idx]
+        closest[chunk] = idx
+
+    return closest, _radius(unit) * closest_angle
+
+
+def within_radius(queries: PointsLike, references: PointsLike, radius: float, unit: str = KILOMETERS,
+                  dtype=np.float64, chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """
+    For each query point, True if any reference point is strictly closer than radius.
+    """
+    q = as_geo_points(queries, dtype)
+    r = as_geo_points(references, dtype)
+    result = np.zeros(len(q), dtype=bool)
+    if len(r) == 0:
+        return result
+
+    # Compare central angles (or their cosines), so the distances never need to be materialized
+    max_angle = radius / _radius(unit)
+    for chunk in _iter_query_chunks(len(q), len(r), chunk_size):
+        if q.dtype == np.float64:
+            result[chunk] = np.any(q.xyz[chunk] @ r.xyz.T > np.cos(max_angle), axis=1)
+        else:
+            angles = _haversine_kernel(
+                q.lat[chunk, None], q.lon[chunk, None], q.cos_lat[chunk, None],
+                r.lat[None, :], r.lon[None, :], r.cos_lat[None, :]
+            )
+            result[chunk] = np.any(angles < max_angle, axis=1)
+
+    return result
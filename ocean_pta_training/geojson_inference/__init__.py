@@ -3,33 +3,184 @@ from .shortest_path import (
     get_subnetwork,
     get_closest_node_on_network,
     get_shortest_path_length,
-    get_shortest_path_length_iter
+    get_shortest_path_length_iter,
+    get_network_shortest_path_length,
+    get_network_shortest_path_length_iter
 )
+from .network import ShortestPathNetwork, convert_network_pickle, load_poi_list
+from .distance_tables import PortDistanceTables, DISTANCE_TABLES_SUBDIR
+from .path_cache import PathCache
+from .checkpoint import LabelingCheckpoint, LABELING_SHARDS_SUBDIR
+from .interpolation import PathGeometries, interpolate_along_paths
+from .contraction import ContractionHierarchy, CONTRACTION_HIERARCHY_SUBDIR
+from .label_cache import LabelCache, get_h3_cells, DEFAULT_LABEL_CACHE_RESOLUTION
+from ..config import configs, ConfigKeys
+from ..env import Environment
 import logging
 import os
 import pandas as pd
-import pickle
+import threading
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(f"{__name__}")
-this_dir_path = os.path.abspath(os.path.dirname(__file__))
 
-# POI input file
-poi_file_path = os.path.join(this_dir_path, "poi_list.csv")
-poi = pd.read_csv(poi_file_path)
-poi_latlon = poi['latlon'].apply(eval).values.tolist()
-poi_names = poi['poi'].values.tolist()
+# The network and the points of interest are loaded on first use, not at import time
+_network: Optional[ShortestPathNetwork] = None
+_poi: Optional[Tuple[List[str], List]] = None
+_load_lock = threading.Lock()
 
-# Load all the pickled objects
-obj_infile = open(os.path.join(this_dir_path, "shortest_path_objects.pkl"), "rb")
-obj_names_infile = open(os.path.join(this_dir_path, "shortest_path_objects_names.pkl"), "rb")
-obj_list_names = pickle.load(obj_names_infile)
-exec(obj_list_names+'='+'pickle.load(obj_infile)')
-obj_infile.close()
-obj_names_infile.close()
 
+def get_network() -> ShortestPathNetwork:
+    """The (memory-mapped) ocean network, loaded on the first call"""
+    global _network
+    if _network is None:
+        with _load_lock:
+            if _network is None:
+                _network = ShortestPathNetwork()
+    return _network
 
-def calculate_shortest_path(input_df: pd.DataFrame):
-    """TODO"""
+
+def get_poi_list() -> Tuple[List[str], List]:
+    """Names and [lat, lon] points of the points of interest, loaded on the first call"""
+    global _poi
+    if _poi is None:
+        _poi = load_poi_list()
+    return _poi
+
+
+def preload_network() -> ShortestPathNetwork:
+    """
+    Load the network with its graph, node index and POI masks now rather than on first use,
+    e.g. before forking worker processes, so that they share it instead of each building it
+    """
+    network = get_network()
+    network.graph, network.snapper, network.edge_poi_mask(get_poi_list()[1])
+    return network
+
+
+def get_distance_tables_dir(output_dir: Optional[str] = None) -> str:
+    """Precomputed distance tables live in the output directory"""
+    output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    return os.path.join(output_dir, DISTANCE_TABLES_SUBDIR)
+
+
+def load_distance_tables(tables_dir: Optional[str] = None) -> Optional[PortDistanceTables]:
+    """The precomputed distance tables, or None if they have not been computed"""
+    tables_dir = tables_dir or get_distance_tables_dir()
+    if not os.path.isdir(tables_dir):
+        logger.info(f"No precomputed distance tables in {tables_dir}")
+        return None
+    tables = PortDistanceTables.load(tables_dir, network=get_network())
+    if tables.poi_names != get_poi_list()[0]:
+        message = f"The distance tables in {tables_dir} were computed for other points of interest"
+        logger.error(message)
+        raise ValueError(message)
+    return tables
+
+
+def get_contraction_hierarchy_dir(output_dir: Optional[str] = None) -> str:
+    """The contraction hierarchy of the network lives in the output directory"""
+    output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    return os.path.join(output_dir, CONTRACTION_HIERARCHY_SUBDIR)
+
+
+def load_contraction_hierarchy(hierarchy_dir: Optional[str] = None) -> Optional[ContractionHierarchy]:
+    """The contraction hierarchy of the network, or None if it has not been built"""
+    hierarchy_dir = hierarchy_dir or get_contraction_hierarchy_dir()
+    if not os.path.isdir(hierarchy_dir):
+        logger.info(f"No contraction hierarchy in {hierarchy_dir}")
+        return None
+    return ContractionHierarchy.load(hierarchy_dir, network=get_network())
+
+
+def get_labeling_shards_dir(output_dir: Optional[str] = None) -> str:
+    """Shards of an interrupted labeling run live in the output directory"""
+    output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    return os.path.join(output_dir, LABELING_SHARDS_SUBDIR)
+
+
+def get_path_cache_file_path() -> Optional[str]:
+    """Where the path cache is persisted between runs (None if it is not)"""
+    file_name = (configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}).get(ConfigKeys.PATH_CACHE_FILE)
+    if not file_name:
+        return None
+    return os.path.join(os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY), file_name)
+
+
+def load_path_cache() -> Optional[PathCache]:
+    """
+    The path cache sized by the package configs (None if its size is 0), with the entries
+    saved by a previous run if persistence is configured
+    """
+    max_size = int((configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}).get(ConfigKeys.PATH_CACHE_SIZE) or 0)
+    if max_size <= 0:
+        return None
+    return PathCache.load_or_create(
+        get_path_cache_file_path(), max_size, get_network().fingerprint, get_poi_list()[1]
+    )
+
+
+def save_path_cache(path_cache: Optional[PathCache]) -> None:
+    """Persist the path cache, if persistence is configured"""
+    file_path = get_path_cache_file_path()
+    if path_cache is not None and file_path:
+        path_cache.save(file_path, get_network().fingerprint, get_poi_list()[1])
+
+
+def get_label_cache_file_path() -> Optional[str]:
+    """Where labels are kept across labeling runs (None if they are not)"""
+    file_name = (configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}).get(ConfigKeys.LABEL_CACHE_FILE)
+    if not file_name:
+        return None
+    return os.path.join(os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY), file_name)
+
+
+def load_label_cache(label_columns: List[str]) -> Optional[LabelCache]:
+    """
+    The labels of previous runs, by (H3 cell, destination port), or None if the label cache is not configured
+    """
+    file_path = get_label_cache_file_path()
+    if file_path is None:
+        return None
+    resolution = int(
+        (configs.get(ConfigKeys.GEOJSON_INFERENCE) or {}).get(ConfigKeys.LABEL_CACHE_RESOLUTION)
+        or DEFAULT_LABEL_CACHE_RESOLUTION
+    )
+    return LabelCache.load_or_create(file_path, resolution, label_columns, get_network().fingerprint, get_poi_list()[1])
+
+
+def save_label_cache(label_cache: Optional[LabelCache]) -> None:
+    file_path = get_label_cache_file_path()
+    if label_cache is not None and file_path:
+        label_cache.save(file_path)
+
+
+def __getattr__(name: str):
+    """Module attributes that used to be loaded at import time, now loaded when first accessed"""
+    if name == "network_obj":
+        return get_network().network_obj
+    if name == "nodes_hexes":
+        return get_network().nodes_hexes
+    if name == "poi_names":
+        return get_poi_list()[0]
+    if name == "poi_latlon":
+        return get_poi_list()[1]
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def calculate_shortest_path(input_df: pd.DataFrame, batched: bool = True,
+                            distance_tables: Optional[PortDistanceTables] = None,
+                            path_cache: Optional[PathCache] = None,
+                            contraction_hierarchy: Optional[ContractionHierarchy] = None):
+    """
+    Shortest ocean path from (olat, olon) to (dlat, dlon) for each row of input_df.
+    With batched=True, one shortest-path tree is computed per destination node, instead of one search per row.
+    With distance_tables (see load_distance_tables), rows whose destination has a table are labeled with
+    a lookup instead; their entry in shortest_paths is None. With path_cache (see load_path_cache), rows whose
+    snapped (source, target) nodes were routed before are labeled from the cache, also without a path.
+    With contraction_hierarchy (see load_contraction_hierarchy), the other rows are routed with one
+    point-to-point query each, instead of a shortest-path tree per destination node.
+    """
     expected_columns = ["olat", "olon", "dlat", "dlon"]
     for column in expected_columns:
         if column not in input_df.columns:
@@ -50,9 +201,13 @@ def calculate_shortest_path(input_df: pd.DataFrame):
         distance_from_source_to_network, distance_to_dest_from_network,
         points_of_interest
 
-    ) = get_shortest_path_length_iter(
-        network_obj, nodes_hexes, poi_latlon,
-        input_source, input_dest
+    ) = get_network_shortest_path_length_iter(
+        get_network(), get_poi_list()[1],
+        input_source, input_dest,
+        batched=batched,
+        distance_tables=distance_tables,
+        path_cache=path_cache,
+        contraction_hierarchy=contraction_hierarchy
     )
     return {
         'shortest_paths': shortest_paths,
@@ -62,3 +217,36 @@ def calculate_shortest_path(input_df: pd.DataFrame):
         'distance_to_dest_from_network': distance_to_dest_from_network,
         'points_of_interest': points_of_interest
     }
+
+
+def calculate_interpolated_labels(anchor_df: pd.DataFrame, ping_df: pd.DataFrame, ping_anchor):
+    """
+    Labels of the pings of ping_df (olat, olon) from the shortest path of their anchor, the row of anchor_df
+    (olat, olon, dlat, dlon) at position ping_anchor: the ping is projected onto the path, see
+    interpolate_along_paths. 'interpolated' is False for pings that could not be projected.
+    """
+    for df, expected_columns in ((anchor_df, ["olat", "olon", "dlat", "dlon"]), (ping_df, ["olat", "olon"])):
+        for column in expected_columns:
+            if column not in df.columns:
+                message = f"Input lacks the required column {column}. Cannot continue."
+                logger.error(message)
+                raise ValueError(message)
+
+    (
+        interpolated,
+        haversine_distance, ocean_distance,
+        distance_from_source_to_network, distance_to_dest_from_network,
+        points_of_interest
+    ) = interpolate_along_paths(
+        get_network(), get_poi_list()[1],
+        anchor_df[['olat', 'olon']].values, anchor_df[['dlat', 'dlon']].values,
+        ping_df[['olat', 'olon']].values, ping_anchor
+    )
+    return {
+        'interpolated': interpolated,
+        'haversine_distance': haversine_distance,
+        'ocean_distance': ocean_distance,
+        'distance_from_source_to_network': distance_from_source_to_network,
+        'distance_to_dest_from_network': distance_to_dest_from_network,
+        'points_of_interest': points_of_interest
+    }
@@ -0,0 +1,128 @@
+"""
+Checkpoint of a geojson labeling run: each labeled batch is appended to a shard directory as an
+uncompressed Arrow IPC file holding the positions of its rows and their features, and recorded in a
+JSON manifest once it is on disk. A run that is killed can then resume from the manifest, labeling
+only the rows of the batches it does not list.
+
+    geojson_labeling_shards/
+        manifest.json       format version, the input the positions refer to, and the shards
+        shard_000000.arrow  row_position, then one float64 column per feature
+        ...
+
+The manifest records the input file (path, size, modification time), its number of rows and the
+feature columns; shards written for another input are discarded rather than resumed.
+"""
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import pyarrow as pa
+from pyarrow import feather
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(f"{__name__}")
+
+LABELING_CHECKPOINT_FORMAT_VERSION = 1
+LABELING_SHARDS_SUBDIR = "geojson_labeling_shards"
+LABELING_MANIFEST_FILE_NAME = "manifest.json"
+ROW_POSITION = "row_position"
+
+
+def replace_durably(temp_path: str, file_path: str) -> None:
+    """Flush temp_path to disk, then atomically move it to file_path"""
+    with open(temp_path, "rb+") as temp_file:
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, file_path)
+
+
+class LabelingCheckpoint(object):
+    """
+    Shards of the batches labeled so far, for one input file.
+    """
+    shard_dir: str
+    input_signature: Dict
+    feature_columns: List[str]
+    shards: List[Dict]
+
+    def __init__(self, shard_dir: str, input_file_path: str, n_rows: int, feature_columns: List[str]):
+        self.shard_dir = shard_dir
+        stat = os.stat(input_file_path)
+        self.input_signature = {
+            "file_path": os.path.abspath(input_file_path),
+            "file_size": stat.st_size,
+            "file_mtime_ns": stat.st_mtime_ns,
+            "n_rows": n_rows
+        }
+        self.feature_columns = list(feature_columns)
+        self.shards = []
+
+        manifest = self.load_manifest()
+        if manifest is not None:
+            if (
+                manifest.get("format_version") == LABELING_CHECKPOINT_FORMAT_VERSION
+                and manifest.get("input") == self.input_signature
+                and manifest.get("feature_columns") == self.feature_columns
+            ):
+                self.shards = manifest["shards"]
+            else:
+                logger.warning(f"Discarding the labeling shards in {shard_dir}: they were written for another input")
+                self.remove()
+        os.makedirs(shard_dir, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.shard_dir, LABELING_MANIFEST_FILE_NAME)
+
+    @property
+    def n_rows_labeled(self) -> int:
+        return sum(shard["rows"] for shard in self.shards)
+
+    def load_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return None
+        with open(self.manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+
+    def save_manifest(self) -> None:
+        manifest = {
+            "format_version": LABELING_CHECKPOINT_FORMAT_VERSION,
+            "input": self.input_signature,
+            "feature_columns": self.feature_columns,
+            "shards": self.shards
+        }
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        replace_durably(temp_path, self.manifest_path)
+
+    def append(self, positions: np.ndarray, features: np.ndarray) -> None:
+        """Write the features (one column per feature column) of the rows at positions as a new shard"""
+        file_name = f"shard_{len(self.shards):06d}.arrow"
+        table = pa.table(
+            [pa.array(np.asarray(positions, dtype=np.int64))] +
+            [pa.array(features[:, i]) for i in range(len(self.feature_columns))],
+            names=[ROW_POSITION] + self.feature_columns
+        )
+        temp_path = os.path.join(self.shard_dir, f"{file_name}.tmp")
+        feather.write_feather(table, temp_path, compression="uncompressed")
+        replace_durably(temp_path, os.path.join(self.shard_dir, file_name))
+        self.shards.append({"file": file_name, "rows": len(positions)})
+        self.save_manifest()
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions and features of the rows labeled in the shards of the manifest"""
+        positions = [np.zeros(0, dtype=np.int64)]
+        features = [np.zeros((0, len(self.feature_columns)), dtype=np.float64)]
+        for shard in self.shards:
+            table = feather.read_table(os.path.join(self.shard_dir, shard["file"]), memory_map=True)
+            positions.append(table.column(ROW_POSITION).to_numpy())
+            features.append(np.column_stack([
+                table.column(col_name).to_numpy().astype(np.float64) for col_name in self.feature_columns
+            ]).reshape(-1, len(self.feature_columns)))
+        return np.concatenate(positions), np.concatenate(features)
+
+    def remove(self) -> None:
+        """Delete the shards, e.g. once they are merged into the labeled data file"""
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
+        self.shards = []
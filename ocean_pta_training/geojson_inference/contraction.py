@@ -0,0 +1,316 @@
+"""
+Contraction hierarchy over the ocean network, for fast point-to-point shortest paths.
+
+Preprocessing contracts the nodes one by one, in order of importance (fewest shortcuts first): when a
+node is removed, a shortcut arc is added between two of its neighbours unless a local "witness"
+search finds a path between them, avoiding the node, that is no longer. A query then only relaxes
+arcs towards nodes contracted later, from both ends (a bidirectional Dijkstra search over the
+upward graph), which settles a few hundred nodes instead of a large part of the network.
+
+Every arc is an edge of the network or a shortcut standing for two arcs through the contracted
+node (its middle), so the edge path of a query is unpacked recursively from the arcs it uses.
+The hierarchy is saved as .npy arrays plus a JSON manifest recording the network it was built on:
+
+    python -m ocean_pta_training.geojson_inference.contraction
+"""
+import heapq
+import json
+import logging
+import os
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from .network import ShortestPathNetwork
+
+logger = logging.getLogger(f"{__name__}")
+
+CONTRACTION_HIERARCHY_FORMAT_VERSION = 1
+CONTRACTION_HIERARCHY_SUBDIR = "contraction_hierarchy"
+CONTRACTION_HIERARCHY_MANIFEST_FILE_NAME = "manifest.json"
+WITNESS_SEARCH_SETTLED_LIMIT = 500  # a witness search gives up (adding a shortcut) after settling this many nodes
+
+CONTRACTION_HIERARCHY_ARRAYS = [
+    "rank",         # int64 (n_nodes,): contraction order of each node
+    "arc_tail",     # int64 (n_arcs,): endpoints of each arc
+    "arc_head",
+    "arc_weight",   # float64 (n_arcs,)
+    "arc_edge",     # int64 (n_arcs,): network edge of the arc, or -1 for a shortcut
+    "arc_middle",   # int64 (n_arcs,): node a shortcut goes through, or -1
+    "arc_children", # int64 (n_arcs, 2): the arcs tail-middle and middle-head of a shortcut, or -1
+    "up_offsets",   # int64 (n_nodes + 1,): upward arcs of each node, in up_arcs
+    "up_arcs"       # int64: arcs to the nodes contracted after each node
+]
+
+
+class ContractionHierarchy(object):
+    """
+    Contraction hierarchy of an undirected network, with point-to-point shortest path queries.
+    """
+    rank: np.ndarray
+    arc_tail: np.ndarray
+    arc_head: np.ndarray
+    arc_weight: np.ndarray
+    arc_edge: np.ndarray
+    arc_middle: np.ndarray
+    arc_children: np.ndarray
+    up_offsets: np.ndarray
+    up_arcs: np.ndarray
+    network_fingerprint: str
+
+    def __init__(self, arrays: Dict[str, np.ndarray], network_fingerprint: str):
+        for name in CONTRACTION_HIERARCHY_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.network_fingerprint = network_fingerprint
+        self._up: Optional[List[List[Tuple[int, float, int]]]] = None
+        self._unpacking: Optional[Tuple[List[int], ...]] = None
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.rank)
+
+    @property
+    def n_shortcuts(self) -> int:
+        return int(np.sum(self.arc_edge < 0))
+
+    @classmethod
+    def build(cls, network: ShortestPathNetwork,
+              settled_limit: int = WITNESS_SEARCH_SETTLED_LIMIT) -> "ContractionHierarchy":
+        """Contract every node of the network"""
+        n_nodes = network.n_nodes
+        tail, head, weight, edge, middle, children = [], [], [], [], [], []
+        # Remaining (not yet contracted) graph: neighbour -> lightest arc, for each node
+        adjacency: List[Dict[int, int]] = [dict() for _ in range(n_nodes)]
+
+        def add_arc(u, v, w, e=-1, m=-1, child_u=-1, child_v=-1):
+            existing = adjacency[u].get(v)
+            if existing is not None and weight[existing] <= w:
+                return
+            tail.append(u), head.append(v), weight.append(w), edge.append(e)
+            middle.append(m), children.append((child_u, child_v))
+            adjacency[u][v] = adjacency[v][u] = len(tail) - 1
+
+        for e, ((u, v), w) in enumerate(zip(np.asarray(network.edges).tolist(), np.asarray(network.weights).tolist())):
+            if u != v:
+                add_arc(u, v, w, e)
+
+        def witness_distances(source, avoided, targets, max_distance):
+            """Distances from source to targets in the remaining graph without avoided, up to max_distance"""
+            distances = {source: 0.0}
+            heap = [(0.0, source)]
+            settled = 0
+            remaining = set(targets)
+            while heap and remaining and settled < settled_limit:
+                d, x = heapq.heappop(heap)
+                if d > distances[x]:
+                    continue
+                if d > max_distance:
+                    break
+                remaining.discard(x)
+                settled += 1
+                for y, arc in adjacency[x].items():
+                    if y == avoided:
+                        continue
+                    nd = d + weight[arc]
+                    if nd < distances.get(y, np.inf):
+                        distances[y] = nd
+                        heapq.heappush(heap, (nd, y))
+            return distances
+
+        def shortcuts(v):
+            """The shortcuts needed if v is contracted: (u, w, distance, arc u-v, arc v-w)"""
+            neighbours = list(adjacency[v].items())
+            needed = []
+            for i, (u, arc_u) in enumerate(neighbours[:-1]):
+                via_v = {w: weight[arc_u] + weight[arc_w] for w, arc_w in neighbours[i + 1:]}
+                distances = witness_distances(u, v, via_v, max(via_v.values()))
+                needed.extend(
+                    (u, w, d, arc_u, adjacency[v][w]) for w, d in via_v.items() if distances.get(w, np.inf) > d
+                )
+            return needed
+
+        contracted_neighbours = np.zeros(n_nodes, dtype=np.int64)
+
+        def priority(v, needed):
+            # Edge difference, plus the contracted neighbours to spread the contraction over the network
+            return len(needed) - len(adjacency[v]) + contracted_neighbours[v]
+
+        heap = [(priority(v, shortcuts(v)), v) for v in range(n_nodes)]
+        heapq.heapify(heap)
+        rank = np.zeros(n_nodes, dtype=np.int64)
+        up_arcs: List[List[int]] = [[] for _ in range(n_nodes)]
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            needed = shortcuts(v)
+            # Lazy update: contract v only if it is still the least important node
+            v_priority = priority(v, needed)
+            if heap and v_priority > heap[0][0]:
+                heapq.heappush(heap, (v_priority, v))
+                continue
+
+            for u, w, d, arc_u, arc_w in needed:
+                add_arc(u, w, d, m=v, child_u=arc_u, child_v=arc_w)
+            for u, arc in adjacency[v].items():
+                up_arcs[v].append(arc)
+                del adjacency[u][v]
+                contracted_neighbours[u] += 1
+            adjacency[v] = {}
+            rank[v] = order
+            order += 1
+            if order % 1000 == 0:
+                logger.info(f"...contracted {order} of {n_nodes} nodes ({len(tail)} arcs)")
+
+        arrays = {
+            "rank": rank,
+            "arc_tail": np.array(tail, dtype=np.int64),
+            "arc_head": np.array(head, dtype=np.int64),
+            "arc_weight": np.array(weight, dtype=np.float64),
+            "arc_edge": np.array(edge, dtype=np.int64),
+            "arc_middle": np.array(middle, dtype=np.int64),
+            "arc_children": np.array(children, dtype=np.int64).reshape(-1, 2),
+            "up_offsets": np.r_[0, np.cumsum([len(arcs) for arcs in up_arcs])].astype(np.int64),
+            "up_arcs": np.array([arc for arcs in up_arcs for arc in arcs], dtype=np.int64)
+        }
+        hierarchy = cls(arrays, network.fingerprint)
+        logger.info(
+            f"Built a contraction hierarchy of {n_nodes} nodes: {len(tail)} arcs, {hierarchy.n_shortcuts} shortcuts"
+        )
+        return hierarchy
+
+    def save(self, hierarchy_dir: str) -> None:
+        os.makedirs(hierarchy_dir, exist_ok=True)
+        for name in CONTRACTION_HIERARCHY_ARRAYS:
+            np.save(os.path.join(hierarchy_dir, f"{name}.npy"), getattr(self, name))
+        manifest = {
+            "format_version": CONTRACTION_HIERARCHY_FORMAT_VERSION,
+            "network_fingerprint": self.network_fingerprint,
+            "n_nodes": self.n_nodes,
+            "n_arcs": len(self.arc_tail),
+            "n_shortcuts": self.n_shortcuts
+        }
+        with open(os.path.join(hierarchy_dir, CONTRACTION_HIERARCHY_MANIFEST_FILE_NAME), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        logger.info(f"Saved the contraction hierarchy to {hierarchy_dir}")
+
+    @classmethod
+    def load(cls, hierarchy_dir: str, network: Optional[ShortestPathNetwork] = None) -> "ContractionHierarchy":
+        """Load the hierarchy; if network is given, check that it was built on it"""
+        manifest_path = os.path.join(hierarchy_dir, CONTRACTION_HIERARCHY_MANIFEST_FILE_NAME)
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("format_version") != CONTRACTION_HIERARCHY_FORMAT_VERSION:
+            message = f"Unsupported contraction hierarchy version {manifest.get('format_version')} in {manifest_path}"
+            logger.error(message)
+            raise ValueError(message)
+        if network is not None and manifest["network_fingerprint"] != network.fingerprint:
+            message = f"The contraction hierarchy in {hierarchy_dir} was built on another version of the network"
+            logger.error(message)
+            raise ValueError(message)
+        arrays = {name: np.load(os.path.join(hierarchy_dir, f"{name}.npy")) for name in CONTRACTION_HIERARCHY_ARRAYS}
+        return cls(arrays, manifest["network_fingerprint"])
+
+    @property
+    def up(self) -> List[List[Tuple[int, float, int]]]:
+        """(neighbour, weight, arc) of the upward arcs of each node, as Python lists for the searches"""
+        if self._up is None:
+            neighbours = np.where(
+                self.arc_tail[self.up_arcs] == np.repeat(np.arange(self.n_nodes), np.diff(self.up_offsets)),
+                self.arc_head[self.up_arcs], self.arc_tail[self.up_arcs]
+            )
+            arcs = list(zip(neighbours.tolist(), self.arc_weight[self.up_arcs].tolist(), self.up_arcs.tolist()))
+            offsets = self.up_offsets.tolist()
+            self._up = [arcs[offsets[v]:offsets[v + 1]] for v in range(self.n_nodes)]
+        return self._up
+
+    def query(self, source: int, target: int) -> Tuple[float, List[int]]:
+        """
+        Shortest path distance from source to target, and its edge path (edge ids of the network,
+        from source to target). An unreachable target has an infinite distance and an empty path.
+        """
+        source, target = int(source), int(target)
+        if source == target:
+            return 0.0, []
+        up = self.up
+        inf = np.inf
+        distances = ({source: 0.0}, {target: 0.0})
+        parents = ({source: None}, {target: None})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        best, meeting = np.inf, -1
+        while heaps[0] or heaps[1]:
+            # Expand the side with the closest node; stop once neither side can improve on best
+            side = 0 if heaps[0] and (not heaps[1] or heaps[0][0][0] <= heaps[1][0][0]) else 1
+            d, x = heapq.heappop(heaps[side])
+            if d >= best:
+                heaps[side].clear()
+                continue
+            if d > distances[side][x]:
+                continue
+            other = distances[1 - side].get(x)
+            if other is not None and d + other < best:
+                best, meeting = d + other, x
+            # Stall-on-demand: x is not on a shortest path if a node above it is reached more cheaply through it
+            side_distances = distances[side]
+            stalled = False
+            for y, w, _ in up[x]:
+                if side_distances.get(y, inf) + w < d:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            for y, w, arc in up[x]:
+                nd = d + w
+                if nd < side_distances.get(y, inf):
+                    side_distances[y] = nd
+                    parents[side][y] = (x, arc)
+                    heapq.heappush(heaps[side], (nd, y))
+
+        if meeting < 0:
+            return np.inf, []
+        # Arcs from source to the meeting node, then from the meeting node to target, with their start node
+        forward = []
+        node = meeting
+        while parents[0][node] is not None:
+            node, arc = parents[0][node]
+            forward.append((arc, node))
+        path = []
+        for arc, start in reversed(forward):
+            path.extend(self.unpack(arc, start))
+        node = meeting
+        while parents[1][node] is not None:
+            parent, arc = parents[1][node]
+            path.extend(self.unpack(arc, node))
+            node = parent
+        return best, path
+
+    def unpack(self, arc: int, start: int) -> List[int]:
+        """Network edges of an arc, in order from its endpoint start"""
+        if self._unpacking is None:
+            self._unpacking = (
+                self.arc_tail.tolist(), self.arc_edge.tolist(), self.arc_middle.tolist(),
+                self.arc_children[:, 0].tolist(), self.arc_children[:, 1].tolist()
+            )
+        arc_tail, arc_edge, arc_middle, child_tails, child_heads = self._unpacking
+        edges = []
+        stack = [(arc, start)]
+        while stack:
+            arc, start = stack.pop()
+            if arc_edge[arc] >= 0:
+                edges.append(arc_edge[arc])
+            elif start == arc_tail[arc]:
+                stack.append((child_heads[arc], arc_middle[arc]))
+                stack.append((child_tails[arc], start))
+            else:
+                stack.append((child_tails[arc], arc_middle[arc]))
+                stack.append((child_heads[arc], start))
+        return edges
+
+    def get_edge_paths(self, source_indices, target_indices):
+        """Edge path of each (source, target) pair, in the format of get_edge_paths_pairwise"""
+        return [
+            [] if source == target else [self.query(source, target)[1]]
+            for source, target in zip(np.asarray(source_indices).tolist(), np.asarray(target_indices).tolist())
+        ]
+
+
+if __name__ == "__main__":
+    from . import get_network, get_contraction_hierarchy_dir
+    ContractionHierarchy.build(get_network()).save(get_contraction_hierarchy_dir())
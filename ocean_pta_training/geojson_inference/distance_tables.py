@@ -0,0 +1,124 @@
+"""
+Precomputed remaining-distance tables: for each destination node (the network node closest to a
+destination port), the ocean distance from every network node to it, and the points of interest
+passed on the way, as a bitmask (bit p for poi_latlon[p]).
+
+Each table row comes from one shortest-path tree rooted at the destination node, as in the batched
+routing of get_shortest_path_length_iter, so a looked-up label matches a routed one. The tables are
+saved as .npy matrices (one row per destination node) plus a JSON manifest recording the network
+they were computed on, and are memory-mapped when loaded.
+"""
+import json
+import logging
+import os
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from .network import ShortestPathNetwork
+
+logger = logging.getLogger(f"{__name__}")
+
+DISTANCE_TABLES_FORMAT_VERSION = 1
+DISTANCE_TABLES_SUBDIR = "port_distance_tables"
+DISTANCE_TABLES_MANIFEST_FILE_NAME = "manifest.json"
+DISTANCE_TABLES_DISTANCES_FILE_NAME = "distances.npy"
+DISTANCE_TABLES_POI_MASKS_FILE_NAME = "poi_masks.npy"
+
+
+class PortDistanceTables(object):
+    """
+    Node-to-destination distances and POI masks, keyed by destination node.
+    """
+    target_nodes: np.ndarray   # destination node of each table row, sorted
+    distances: np.ndarray      # float64 (n_targets, n_nodes)
+    poi_masks: np.ndarray      # uint16 (n_targets, n_nodes)
+    poi_names: List[str]
+    ports: Dict[str, int]      # destination port -> destination node
+    network_fingerprint: str
+
+    def __init__(self, target_nodes, distances, poi_masks, poi_names, ports, network_fingerprint):
+        self.target_nodes = np.asarray(target_nodes, dtype=np.int64)
+        self.distances = distances
+        self.poi_masks = poi_masks
+        self.poi_names = list(poi_names)
+        self.ports = dict(ports)
+        self.network_fingerprint = network_fingerprint
+
+    @classmethod
+    def build(cls, network: ShortestPathNetwork, poi_names: List[str], poi_latlon: List,
+              ports_latlon: Dict[str, Tuple[float, float]]) -> "PortDistanceTables":
+        """Compute the tables for the destination nodes of the given ports ({locode: (lat, lon)})"""
+        ports = list(ports_latlon)
+        port_nodes, _ = network.snap([ports_latlon[port] for port in ports])
+        target_nodes = np.unique(port_nodes)
+        edge_poi_masks = network.edge_poi_mask(poi_latlon)
+        weights = np.asarray(network.weights)
+
+        distances = np.zeros((len(target_nodes), network.n_nodes), dtype=np.float64)
+        poi_masks = np.zeros((len(target_nodes), network.n_nodes), dtype=np.uint16)
+        for row, target in enumerate(target_nodes):
+            logger.info(f"...distance table {row + 1} of {len(target_nodes)} (destination node {target})")
+            tree_paths = network.graph.get_shortest_paths(int(target), to=None, weights="weight", output="epath")
+            for node, path in enumerate(tree_paths):
+                # Reversed, to sum the weights in the same order as the routed labels
+                path = path[::-1]
+                distances[row, node] = np.sum(weights[path])
+                poi_masks[row, node] = np.bitwise_or.reduce(edge_poi_masks[path]) if path else 0
+
+        return cls(
+            target_nodes=target_nodes,
+            distances=distances,
+            poi_masks=poi_masks,
+            poi_names=poi_names,
+            ports={port: int(node) for port, node in zip(ports, port_nodes)},
+            network_fingerprint=network.fingerprint
+        )
+
+    def save(self, tables_dir: str) -> None:
+        os.makedirs(tables_dir, exist_ok=True)
+        np.save(os.path.join(tables_dir, DISTANCE_TABLES_DISTANCES_FILE_NAME), self.distances)
+        np.save(os.path.join(tables_dir, DISTANCE_TABLES_POI_MASKS_FILE_NAME), self.poi_masks)
+        manifest = {
+            "format_version": DISTANCE_TABLES_FORMAT_VERSION,
+            "network_fingerprint": self.network_fingerprint,
+            "target_nodes": self.target_nodes.tolist(),
+            "poi_names": self.poi_names,
+            "ports": self.ports
+        }
+        with open(os.path.join(tables_dir, DISTANCE_TABLES_MANIFEST_FILE_NAME), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        logger.info(f"Saved {len(self.target_nodes)} distance tables to {tables_dir}")
+
+    @classmethod
+    def load(cls, tables_dir: str, network: Optional[ShortestPathNetwork] = None) -> "PortDistanceTables":
+        """Load (memory-map) the tables; if network is given, check that they were computed on it"""
+        manifest_path = os.path.join(tables_dir, DISTANCE_TABLES_MANIFEST_FILE_NAME)
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("format_version") != DISTANCE_TABLES_FORMAT_VERSION:
+            message = f"Unsupported distance tables version {manifest.get('format_version')} in {manifest_path}"
+            logger.error(message)
+            raise ValueError(message)
+        if network is not None and manifest["network_fingerprint"] != network.fingerprint:
+            message = f"The distance tables in {tables_dir} were computed on another version of the network"
+            logger.error(message)
+            raise ValueError(message)
+        return cls(
+            target_nodes=manifest["target_nodes"],
+            distances=np.load(os.path.join(tables_dir, DISTANCE_TABLES_DISTANCES_FILE_NAME), mmap_mode="r"),
+            poi_masks=np.load(os.path.join(tables_dir, DISTANCE_TABLES_POI_MASKS_FILE_NAME), mmap_mode="r"),
+            poi_names=manifest["poi_names"],
+            ports=manifest["ports"],
+            network_fingerprint=manifest["network_fingerprint"]
+        )
+
+    def table_rows(self, target_nodes: np.ndarray) -> np.ndarray:
+        """Table row of each destination node, or -1 if it has no table"""
+        target_nodes = np.asarray(target_nodes, dtype=np.int64)
+        if len(self.target_nodes) == 0:
+            return np.full(len(target_nodes), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.target_nodes, target_nodes), len(self.target_nodes) - 1)
+        return np.where(self.target_nodes[rows] == target_nodes, rows, -1)
+
+    def lookup(self, source_nodes: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Distance and POI bitmask from each source node to the destination node of each table row"""
+        return self.distances[rows, source_nodes], self.poi_masks[rows, source_nodes]
@@ -0,0 +1,167 @@
+"""
+Along-path interpolation of labels. Only some pings of a journey are routed on the network (the
+"anchors", see 04_extract_unlabeled_data_for_geojson_inference.py); the pings in between lie, roughly,
+on the path of the anchor before them. Each such ping is projected onto that path, and labeled with the
+distance left along the path from the projected point and the points of interest still ahead of it.
+
+The paths of a batch of anchors are routed as in get_edge_paths_batched (one shortest-path tree per
+destination node) and kept as node sequences (PathGeometries), with the distance to the destination
+node and the POI bitmask of the rest of the path at each node. Projections are computed on unit
+vectors, segment by segment, so that no map projection (or antimeridian handling) is needed.
+"""
+import numpy as np
+from typing import Tuple
+from .network import ShortestPathNetwork, poi_mask_to_flags
+from ..geo import EARTH_RADIUS_KM, GeoPoints, haversine
+
+PROJECTION_CHUNK_SIZE = 2 ** 21  # maximum number of (ping, path segment) pairs projected at once
+
+
+class PathGeometries(object):
+    """
+    Node sequences of paths from a source node to a target node, as flat arrays plus offsets
+    """
+    offsets: np.ndarray       # int64, n_paths + 1
+    nodes: np.ndarray         # int64, node positions along each path, from its source to its target
+    remaining: np.ndarray     # float64, along-path distance from each node to the target
+    suffix_masks: np.ndarray  # uint16, POI bitmask of the edges from each node to the target
+
+    def __init__(self, offsets, nodes, remaining, suffix_masks):
+        self.offsets = offsets
+        self.nodes = nodes
+        self.remaining = remaining
+        self.suffix_masks = suffix_masks
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of nodes of each path (1 if it has no edge: source == target, or no path)"""
+        return np.diff(self.offsets)
+
+    @classmethod
+    def route(cls, network: ShortestPathNetwork, edge_poi_masks: np.ndarray,
+              source_nodes: np.ndarray, target_nodes: np.ndarray) -> "PathGeometries":
+        """Shortest paths from each source node to the target node at the same position"""
+        edge_paths = [np.zeros(0, dtype=np.int64)] * len(source_nodes)
+        for target in np.unique(target_nodes):
+            rows = np.flatnonzero((target_nodes == target) & (source_nodes != target))
+            if len(rows) == 0:
+                continue
+            unique_sources, inverse = np.unique(source_nodes[rows], return_inverse=True)
+            tree_paths = network.graph.get_shortest_paths(
+                int(target), to=unique_sources.tolist(), weights="weight", output="epath"
+            )
+            for row, k in zip(rows, inverse.reshape(-1)):
+                edge_paths[row] = np.asarray(tree_paths[k][::-1], dtype=np.int64)
+
+        edges = np.asarray(network.edges)
+        weights = np.asarray(network.weights)
+        nodes, remaining, suffix_masks = [], [], []
+        for source, target, path in zip(source_nodes, target_nodes, edge_paths):
+            if len(path) == 0:
+                nodes.append(np.array([source], dtype=np.int64))
+                remaining.append(np.zeros(1))
+                suffix_masks.append(np.zeros(1, dtype=np.uint16))
+                continue
+            # The node between two consecutive edges is the endpoint they share
+            ends = edges[path]
+            previous, following = ends[:-1], ends[1:]
+            is_first_shared = (previous[:, 0] == following[:, 0]) | (previous[:, 0] == following[:, 1])
+            shared = np.where(is_first_shared, previous[:, 0], previous[:, 1])
+            nodes.append(np.r_[source, shared, target].astype(np.int64))
+            remaining.append(np.r_[np.cumsum(weights[path][::-1])[::-1], 0.0])
+            suffix_masks.append(
+                np.r_[np.bitwise_or.accumulate(edge_poi_masks[path][::-1])[::-1], 0].astype(np.uint16)
+            )
+
+        return cls(
+            offsets=np.r_[0, np.cumsum([len(path_nodes) for path_nodes in nodes])].astype(np.int64),
+            nodes=np.concatenate(nodes) if nodes else np.zeros(0, dtype=np.int64),
+            remaining=np.concatenate(remaining) if remaining else np.zeros(0),
+            suffix_masks=np.concatenate(suffix_masks) if suffix_masks else np.zeros(0, dtype=np.uint16)
+        )
+
+    def project(self, node_points: GeoPoints, points: GeoPoints,
+                paths: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Closest point, on path paths[i] (which must have an edge), to each point i.
+        Returns the position (in self.nodes) of the first node of the segment it is on,
+        its fraction of the way along that segment, and its distance to the point in km.
+        """
+        n_segments = self.lengths[paths] - 1
+        segment = np.zeros(len(paths), dtype=np.int64)
+        fraction = np.zeros(len(paths))
+        chord = np.zeros(len(paths))
+        if len(paths) == 0:
+            return segment, fraction, chord
+
+        ends = np.cumsum(n_segments)
+        chunk_starts = np.r_[0, np.flatnonzero(np.diff(ends // PROJECTION_CHUNK_SIZE)) + 1]
+        for start, stop in zip(chunk_starts, np.r_[chunk_starts[1:], len(paths)]):
+            counts = n_segments[start:stop]
+            pair_point = np.repeat(np.arange(start, stop), counts)
+            group_starts = np.r_[0, np.cumsum(counts)[:-1]]
+            pair_segment = (
+                np.repeat(self.offsets[paths[start:stop]], counts)
+                + np.arange(len(pair_point)) - np.repeat(group_starts, counts)
+            )
+            a = node_points.xyz[self.nodes[pair_segment]]
+            ab = node_points.xyz[self.nodes[pair_segment + 1]] - a
+            ap = points.xyz[pair_point] - a
+            ab_squared = np.einsum("ij,ij->i", ab, ab)
+            t = np.clip(np.einsum("ij,ij->i", ap, ab) / np.where(ab_squared > 0, ab_squared, 1), 0, 1)
+            distance = np.linalg.norm(ap - t[:, None] * ab, axis=1)
+
+            # The closest segment of each point: the first of its group, once sorted by distance
+            closest = np.lexsort((distance, pair_point))[group_starts]
+            segment[start:stop] = pair_segment[closest]
+            fraction[start:stop] = t[closest]
+            chord[start:stop] = distance[closest]
+
+        return segment, fraction, 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1))
+
+
+def interpolate_along_paths(network: ShortestPathNetwork, poi_latlon, anchor_source, anchor_dest,
+                            ping_source, ping_anchor: np.ndarray):
+    """
+    Labels of pings from the path of their anchor (ping_anchor: position of each ping's anchor).
+    Anchors and pings are [lat, lon] points; anchor_dest is the destination of each anchor,
+    which is also that of its pings. A ping is labeled as in get_shortest_path_length_iter, with its
+    projection onto the anchor's path in place of its closest network node. Pings whose anchor's path
+    has no edge are not labeled (NaN distances).
+
+    Returns (interpolated, haversine_distance, ocean_distance, distance_from_source_to_network,
+    distance_to_dest_from_network, points_of_interest).
+    """
+    anchor_source = np.asarray(anchor_source, dtype=np.float64).reshape(-1, 2)
+    anchor_dest = np.asarray(anchor_dest, dtype=np.float64).reshape(-1, 2)
+    ping_source = np.asarray(ping_source, dtype=np.float64).reshape(-1, 2)
+    ping_anchor = np.asarray(ping_anchor, dtype=np.int64)
+
+    source_nodes, _ = network.snap(anchor_source)
+    target_nodes, anchor_d_to_Nd = network.snap(anchor_dest)
+    geometries = PathGeometries.route(network, network.edge_poi_mask(poi_latlon), source_nodes, target_nodes)
+
+    d_od = haversine(ping_source, anchor_dest[ping_anchor])
+    interpolated = geometries.lengths[ping_anchor] > 1
+    d_to_path = np.full(len(ping_anchor), np.nan)
+    d_along_path = np.full(len(ping_anchor), np.nan)
+    path_poi_masks = np.zeros(len(ping_anchor), dtype=np.uint16)
+
+    pings = np.flatnonzero(interpolated)
+    segment, fraction, d_to_path[pings] = geometries.project(
+        network.snapper.node_points, GeoPoints(ping_source[pings]), ping_anchor[pings]
+    )
+    segment_length = geometries.remaining[segment] - geometries.remaining[segment + 1]
+    d_along_path[pings] = geometries.remaining[segment] - fraction * segment_length
+    path_poi_masks[pings] = geometries.suffix_masks[segment]
+
+    d_to_Nd = np.where(interpolated, anchor_d_to_Nd[ping_anchor], np.nan)
+    is_near = d_od <= (d_to_path + d_to_Nd)
+    distance = np.where(is_near, d_od, d_along_path)
+    distance_from_source_to_network = np.where(is_near, 0, d_to_path)
+    distance_to_dest_from_network = np.where(is_near, 0, d_to_Nd)
+    return (
+        interpolated, d_od, distance,
+        distance_from_source_to_network, distance_to_dest_from_network,
+        poi_mask_to_flags(path_poi_masks, len(poi_latlon)).tolist()
+    )
@@ -0,0 +1,151 @@
+"""
+On-disk cache of geojson labels across labeling runs, keyed by (H3 cell of the ping, destination port).
+
+Rebuilding the combined dataset and labeling it again mostly re-labels positions seen in earlier runs:
+a ping whose H3 cell (at a fine resolution, ~65 m across at resolution 10) and destination port are
+in the cache takes the labels of the ping that was routed there, instead of being routed. A cached
+label is that of another point of the same cell, so the distances of a hit may differ from routing
+the ping itself by up to the size of the cell.
+
+The cache is saved as an uncompressed Arrow IPC file whose schema metadata records the format version,
+the network fingerprint, the points of interest, the H3 resolution and the label columns; a cache saved
+for anything else is discarded. Each entry also keeps the destination coordinates it was routed to,
+so that an entry is a miss once its port has moved in the ports file.
+"""
+import json
+import logging
+import os
+import h3.api.numpy_int as h3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(f"{__name__}")
+
+LABEL_CACHE_FORMAT_VERSION = 1
+LABEL_CACHE_METADATA_KEY = b"geojson_label_cache"
+DEFAULT_LABEL_CACHE_RESOLUTION = 10
+CELL = "h3_cell"
+DESTINATION = "destination"
+DESTINATION_LATLON = ["dlat", "dlon"]
+
+
+def get_h3_cells(latlon, resolution: int) -> np.ndarray:
+    """H3 cell (as uint64) of each [lat, lon] point"""
+    latlon = np.asarray(latlon, dtype=np.float64).reshape(-1, 2)
+    return np.array([h3.geo_to_h3(lat, lon, resolution) for lat, lon in latlon.tolist()], dtype=np.uint64)
+
+
+class LabelCache(object):
+    """
+    Labels (label_columns) by (destination port, H3 cell), with the number of hits and misses of this run.
+    """
+    resolution: int
+    label_columns: List[str]
+    version: dict
+    hits: int
+    misses: int
+
+    def __init__(self, resolution: int, label_columns: List[str], network_fingerprint: str, poi_latlon):
+        self.resolution = resolution
+        self.label_columns = list(label_columns)
+        self.version = {
+            "format_version": LABEL_CACHE_FORMAT_VERSION,
+            "network_fingerprint": network_fingerprint,
+            "poi_latlon": poi_latlon,
+            "resolution": resolution,
+            "label_columns": self.label_columns
+        }
+        self.hits = 0
+        self.misses = 0
+        self._entries = pd.DataFrame(
+            columns=DESTINATION_LATLON + self.label_columns,
+            index=pd.MultiIndex.from_arrays([[], np.zeros(0, dtype=np.uint64)], names=[DESTINATION, CELL]),
+            dtype=np.float64
+        )
+        self._new_entries: List[pd.DataFrame] = []
+
+    def __len__(self) -> int:
+        self._merge_new_entries()
+        return len(self._entries.index)
+
+    def _merge_new_entries(self) -> None:
+        if self._new_entries:
+            entries = pd.concat([self._entries] + self._new_entries)
+            self._entries = entries[~entries.index.duplicated(keep="first")]
+            self._new_entries = []
+
+    def lookup(self, destinations: np.ndarray, cells: np.ndarray,
+               destination_latlon: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cached labels of each (destination, cell) pair routed to the same destination coordinates.
+        Returns (found, labels); labels are NaN where found is False.
+        """
+        self._merge_new_entries()
+        keys = pd.MultiIndex.from_arrays([np.asarray(destinations, dtype=object), np.asarray(cells, dtype=np.uint64)])
+        entries = self._entries.reindex(keys)
+        found = np.all(entries[DESTINATION_LATLON].to_numpy(dtype=np.float64) == destination_latlon, axis=1)
+        labels = entries[self.label_columns].to_numpy(dtype=np.float64)
+        labels[~found] = np.nan
+        n_found = int(found.sum())
+        self.hits += n_found
+        self.misses += len(found) - n_found
+        return found, labels
+
+    def add(self, destinations: np.ndarray, cells: np.ndarray, destination_latlon: np.ndarray,
+            labels: np.ndarray) -> None:
+        """Add routed labels, replacing those of a (destination, cell) pair already in the cache"""
+        entries = pd.DataFrame(
+            np.column_stack([destination_latlon, labels]),
+            columns=DESTINATION_LATLON + self.label_columns,
+            index=pd.MultiIndex.from_arrays(
+                [np.asarray(destinations, dtype=object), np.asarray(cells, dtype=np.uint64)], names=[DESTINATION, CELL]
+            )
+        )
+        self._merge_new_entries()
+        stale = self._entries.index.isin(entries.index)
+        self._entries = self._entries[~stale]
+        self._new_entries.append(entries[~entries.index.duplicated(keep="first")])
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return (
+            f"label cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.1%} hit rate), "
+            f"{len(self)} entries"
+        )
+
+    def save(self, file_path: str) -> None:
+        self._merge_new_entries()
+        table = pa.Table.from_pandas(self._entries.reset_index(), preserve_index=False)
+        table = table.replace_schema_metadata({LABEL_CACHE_METADATA_KEY: json.dumps(self.version).encode()})
+        temp_path = f"{file_path}.tmp"
+        feather.write_feather(table, temp_path, compression="uncompressed")
+        os.replace(temp_path, file_path)
+        logger.info(f"Saved {len(self._entries.index)} cached labels to {file_path}")
+
+    @classmethod
+    def load_or_create(cls, file_path: Optional[str], resolution: int, label_columns: List[str],
+                       network_fingerprint: str, poi_latlon) -> "LabelCache":
+        """The cache saved in file_path, if it exists and matches the network, POIs, resolution and labels"""
+        label_cache = cls(resolution, label_columns, network_fingerprint, poi_latlon)
+        if not file_path or not os.path.isfile(file_path):
+            return label_cache
+        table = feather.read_table(file_path)
+        saved_version = json.loads((table.schema.metadata or {}).get(LABEL_CACHE_METADATA_KEY, b"{}"))
+        if saved_version != label_cache.version:
+            logger.warning(
+                f"Ignoring the label cache in {file_path}: it was saved for another network, POI list, "
+                f"resolution or set of labels"
+            )
+            return label_cache
+        entries = table.to_pandas()
+        entries[CELL] = entries[CELL].astype(np.uint64)
+        label_cache._entries = entries.set_index([DESTINATION, CELL])[DESTINATION_LATLON + label_cache.label_columns]
+        logger.info(f"Loaded {len(label_cache._entries.index)} cached labels from {file_path}")
+        return label_cache
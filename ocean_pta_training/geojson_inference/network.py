@@ -0,0 +1,243 @@
+"""
+The ocean network used by geojson inference, stored as a versioned directory of .npy arrays
+plus a JSON manifest, instead of a pickle:
+
+    network/
+        manifest.json      format version, sizes and the files below
+        edges.npy          int32 (n_edges, 2): node positions of each edge's endpoints
+        weights.npy        float64 (n_edges,): edge lengths, in km
+        node_latlon.npy    float64 (n_nodes, 2): latitude, longitude of each node
+        node_hexes.npy     uint64 (n_resolutions, n_nodes): H3 cell of each node, at each resolution
+
+The arrays are memory-mapped, so processes reading the same artifact share its pages, and nothing
+is read until the network is first used (see get_network). The igraph Graph is built from the edge
+array on first access; edges keep their positions, so edge ids are those of the original graph.
+
+convert_network_pickle performs the one-time conversion from the pickled objects
+(shortest_path_objects.pkl) that the network was originally distributed as.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from igraph import Graph
+from typing import Dict, List, Optional, Tuple
+from .snapping import NodeSnapper
+from ..geo import GeoPoints, within_radius
+
+logger = logging.getLogger(f"{__name__}")
+this_dir_path = os.path.abspath(os.path.dirname(__file__))
+
+NETWORK_FORMAT_VERSION = 1
+NETWORK_ARTIFACT_DIR = os.path.join(this_dir_path, "network")
+NETWORK_MANIFEST_FILE_NAME = "manifest.json"
+NETWORK_PICKLE_FILE_PATH = os.path.join(this_dir_path, "shortest_path_objects.pkl")
+POI_FILE_PATH = os.path.join(this_dir_path, "poi_list.csv")
+H3_RESOLUTIONS = [4, 3, 2, 1]  # resolutions of node_hexes, from the finest to the coarsest
+POI_RADIUS_KM = 5  # a path passes a point of interest if one of its nodes is closer than this
+
+NETWORK_ARRAY_FILES = {
+    "edges": "edges.npy",
+    "weights": "weights.npy",
+    "node_latlon": "node_latlon.npy",
+    "node_hexes": "node_hexes.npy"
+}
+
+
+class ShortestPathNetwork(object):
+    """
+    Memory-mapped ocean network: node coordinates, H3 cells, edges and weights.
+    """
+    artifact_dir: str
+    manifest: Dict
+    edges: np.ndarray
+    weights: np.ndarray
+    node_latlon: np.ndarray
+    node_hexes: np.ndarray
+
+    def __init__(self, artifact_dir: str = NETWORK_ARTIFACT_DIR):
+        self.artifact_dir = artifact_dir
+        manifest_path = os.path.join(artifact_dir, NETWORK_MANIFEST_FILE_NAME)
+        with open(manifest_path, "r") as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get("format_version") != NETWORK_FORMAT_VERSION:
+            message = (
+                f"Unsupported network format version {self.manifest.get('format_version')} in {manifest_path}; "
+                f"expected {NETWORK_FORMAT_VERSION}"
+            )
+            logger.error(message)
+            raise ValueError(message)
+
+        for name, file_name in self.manifest["arrays"].items():
+            setattr(self, name, np.load(os.path.join(artifact_dir, file_name), mmap_mode="r"))
+        self._graph: Optional[Graph] = None
+        self._snapper: Optional[NodeSnapper] = None
+        self._edge_poi_masks: Dict[str, np.ndarray] = {}
+        logger.info(f"Loaded the ocean network ({self.n_nodes} nodes, {self.n_edges} edges) from {artifact_dir}")
+
+    @classmethod
+    def from_objects(cls, network_obj: Tuple, nodes_hexes: List) -> "ShortestPathNetwork":
+        """
+        In-memory network from the objects of the original pickle ([network_obj, nodes_hexes]),
+        for code written against them; the graph of network_obj is used as is
+        """
+        network = cls.__new__(cls)
+        network.artifact_dir = None
+        network.manifest = {"format_version": NETWORK_FORMAT_VERSION, "h3_resolutions": H3_RESOLUTIONS,
+                            "arrays": NETWORK_ARRAY_FILES}
+        for name, array in network_arrays(network_obj, nodes_hexes).items():
+            setattr(network, name, array)
+        network._graph = network_obj[0]
+        network._snapper = None
+        network._edge_poi_masks = {}
+        return network
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.node_latlon)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.edges)
+
+    @property
+    def graph(self) -> Graph:
+        """Undirected igraph Graph, with a 'weight' edge attribute (built on first access)"""
+        if self._graph is None:
+            self._graph = Graph(n=self.n_nodes, edges=self.edges.tolist(), directed=False)
+            self._graph.es["weight"] = self.weights.tolist()
+        return self._graph
+
+    @property
+    def snapper(self) -> NodeSnapper:
+        """Spatial index of the nodes, by H3 cell (built on first access)"""
+        if self._snapper is None:
+            self._snapper = NodeSnapper(
+                self.node_latlon, self.node_hexes, self.manifest.get("h3_resolutions", H3_RESOLUTIONS)
+            )
+        return self._snapper
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the network arrays, identifying this version of the network in derived artifacts"""
+        sha = hashlib.sha256()
+        for name in sorted(self.manifest["arrays"]):
+            sha.update(name.encode())
+            sha.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return sha.hexdigest()
+
+    def node_poi_mask(self, poi_latlon: List, radius_km: float = POI_RADIUS_KM) -> np.ndarray:
+        """
+        Bitmask of the points of interest near each node: bit p is set if a point of
+        poi_latlon[p] is strictly within radius_km of the node (as in get_poi_flag)
+        """
+        if len(poi_latlon) > 16:
+            raise ValueError(f"At most 16 points of interest fit in a node mask; got {len(poi_latlon)}")
+        node_points = GeoPoints(self.node_latlon)
+        mask = np.zeros(self.n_nodes, dtype=np.uint16)
+        for p, poi_points in enumerate(poi_latlon):
+            mask[within_radius(node_points, poi_points, radius_km)] |= np.uint16(1 << p)
+        return mask
+
+    def edge_poi_mask(self, poi_latlon: List, radius_km: float = POI_RADIUS_KM) -> np.ndarray:
+        """
+        Bitmask of the points of interest near each edge, computed once per list of points of interest.
+        As in get_poi_flag, an edge is near a point of interest if its first endpoint is.
+        """
+        key = json.dumps([poi_latlon, radius_km])
+        if key not in self._edge_poi_masks:
+            self._edge_poi_masks[key] = self.node_poi_mask(poi_latlon, radius_km)[np.asarray(self.edges[:, 0])]
+        return self._edge_poi_masks[key]
+
+    def snap(self, latlon) -> Tuple[np.ndarray, np.ndarray]:
+        """Closest node (position) to each [lat, lon] point, and the distance to it in km"""
+        return self.snapper.snap(latlon)
+
+    @property
+    def network_obj(self) -> Tuple:
+        """
+        The network in the layout of the original pickle, for code written against it:
+        (g, edge_list, edge_list_mapped, weights, nodes_mapping, nodes_master, nodes_master_reversed, nodes_mapping)
+        """
+        nodes_master = self.node_latlon[:, ::-1].tolist()
+        nodes_mapping = {str(node): i for i, node in enumerate(nodes_master)}
+        edge_list_mapped = self.edges.tolist()
+        edge_list = [[nodes_master[a], nodes_master[b]] for a, b in edge_list_mapped]
+        return (
+            self.graph, edge_list, edge_list_mapped, np.array(self.weights), nodes_mapping,
+            nodes_master, self.node_latlon.tolist(), nodes_mapping
+        )
+
+    @property
+    def nodes_hexes(self) -> List[List[int]]:
+        """H3 cells of the nodes in the layout of the original pickle (one list per resolution)"""
+        return self.node_hexes.tolist()
+
+
+def poi_mask_to_flags(masks: np.ndarray, n_poi: int) -> np.ndarray:
+    """0/1 flags (n, n_poi) from POI bitmasks"""
+    return ((np.asarray(masks)[:, None] >> np.arange(n_poi, dtype=np.uint16)) & 1).astype(int)
+
+
+def load_poi_list(file_path: str = POI_FILE_PATH) -> Tuple[List[str], List[List[List[float]]]]:
+    """Names and [lat, lon] points of the points of interest (choke points)"""
+    poi = pd.read_csv(file_path)
+    return poi['poi'].values.tolist(), [json.loads(latlon) for latlon in poi['latlon']]
+
+
+def network_arrays(network_obj: Tuple, nodes_hexes: List, source: str = "network_obj") -> Dict[str, np.ndarray]:
+    """The arrays of the network artifact, from the objects of the original pickle"""
+    g, edge_list, edge_list_mapped, weights, nodes_mapping, nodes_master, nodes_master_reversed, _ = network_obj
+
+    node_latlon = np.array(nodes_master_reversed, dtype=np.float64)
+    # Node positions must be those of nodes_mapping, which the graph's vertex ids follow
+    for i, node in enumerate(nodes_master):
+        if nodes_mapping[str(node)] != i:
+            message = f"Node {i} of {source} does not map to its own position; cannot convert"
+            logger.error(message)
+            raise ValueError(message)
+
+    arrays = {
+        "edges": np.array(edge_list_mapped, dtype=np.int32),
+        "weights": np.asarray(weights, dtype=np.float64),
+        "node_latlon": node_latlon,
+        "node_hexes": np.array(nodes_hexes, dtype=np.uint64)
+    }
+    if len(arrays["edges"]) != g.ecount() or len(node_latlon) != g.vcount():
+        message = f"The arrays of {source} do not match the size of its graph; cannot convert"
+        logger.error(message)
+        raise ValueError(message)
+    return arrays
+
+
+def convert_network_pickle(pickle_path: str = NETWORK_PICKLE_FILE_PATH,
+                           artifact_dir: str = NETWORK_ARTIFACT_DIR) -> None:
+    """
+    Write the network artifact from the pickled [network_obj, nodes_hexes] objects
+    """
+    with open(pickle_path, "rb") as pickle_file:
+        network_obj, nodes_hexes = pickle.load(pickle_file)
+    arrays = network_arrays(network_obj, nodes_hexes, pickle_path)
+    node_latlon = arrays["node_latlon"]
+
+    os.makedirs(artifact_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(artifact_dir, NETWORK_ARRAY_FILES[name]), array)
+    manifest = {
+        "format_version": NETWORK_FORMAT_VERSION,
+        "source": os.path.basename(pickle_path),
+        "n_nodes": len(node_latlon),
+        "n_edges": len(arrays["edges"]),
+        "h3_resolutions": H3_RESOLUTIONS,
+        "arrays": NETWORK_ARRAY_FILES
+    }
+    with open(os.path.join(artifact_dir, NETWORK_MANIFEST_FILE_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    logger.info(f"Wrote the network artifact ({manifest['n_nodes']} nodes, {manifest['n_edges']} edges) to {artifact_dir}")
+
+
+if __name__ == "__main__":
+    convert_network_pickle()
@@ -0,0 +1,109 @@
+"""
+Bounded (LRU) cache of routed labels, keyed by (source node, target node): the ocean distance
+between the two nodes and the POI bitmask of the path. Consecutive pings of a journey, and vessels
+sharing a lane, snap to the same nodes, so most of their paths need no graph search.
+
+The cache can be saved and reloaded between runs; a saved cache records the network fingerprint
+and the points of interest it was computed with, and is discarded if either has changed.
+"""
+import logging
+import os
+import pickle
+import numpy as np
+from collections import OrderedDict
+from typing import Tuple
+
+logger = logging.getLogger(f"{__name__}")
+
+PATH_CACHE_FORMAT_VERSION = 1
+
+
+class PathCache(object):
+    """
+    LRU mapping of (source node, target node) to (distance, POI bitmask).
+    """
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, source_nodes: np.ndarray, target_nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Cached distance and POI mask of each (source, target) pair.
+        Returns (found, distances, masks); distances and masks are 0 where found is False.
+        """
+        found = np.zeros(len(source_nodes), dtype=bool)
+        distances = np.zeros(len(source_nodes), dtype=np.float64)
+        masks = np.zeros(len(source_nodes), dtype=np.uint16)
+        for i, key in enumerate(zip(source_nodes.tolist(), target_nodes.tolist())):
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                found[i] = True
+                distances[i], masks[i] = value
+        n_found = int(found.sum())
+        self.hits += n_found
+        self.misses += len(found) - n_found
+        return found, distances, masks
+
+    def store(self, source_nodes: np.ndarray, target_nodes: np.ndarray,
+              distances: np.ndarray, masks: np.ndarray) -> None:
+        """Add routed pairs, evicting the least recently used ones beyond max_size"""
+        if self.max_size <= 0:
+            return
+        for key, distance, mask in zip(
+                zip(source_nodes.tolist(), target_nodes.tolist()), distances.tolist(), masks.tolist()):
+            self._entries[key] = (distance, mask)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> str:
+        return (
+            f"path cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.1%} hit rate), "
+            f"{len(self)} of {self.max_size} entries"
+        )
+
+    def save(self, file_path: str, network_fingerprint: str, poi_latlon) -> None:
+        with open(file_path, "wb") as pickle_file:
+            pickle.dump({
+                "version": PATH_CACHE_FORMAT_VERSION,
+                "network_fingerprint": network_fingerprint,
+                "poi_latlon": poi_latlon,
+                "entries": list(self._entries.items())
+            }, pickle_file)
+        logger.info(f"Saved {len(self)} cached paths to {file_path}")
+
+    @classmethod
+    def load_or_create(cls, file_path: str, max_size: int, network_fingerprint: str, poi_latlon) -> "PathCache":
+        """A cache with the entries saved in file_path, if it exists and matches the network and POIs"""
+        path_cache = cls(max_size)
+        if not file_path or not os.path.isfile(file_path):
+            return path_cache
+        with open(file_path, "rb") as pickle_file:
+            saved = pickle.load(pickle_file)
+        if (
+            saved.get("version") != PATH_CACHE_FORMAT_VERSION
+            or saved.get("network_fingerprint") != network_fingerprint
+            or saved.get("poi_latlon") != poi_latlon
+        ):
+            logger.warning(f"Ignoring the path cache in {file_path}: it was saved for another network or POI list")
+            return path_cache
+        # Keep the most recently used entries, in LRU order
+        for key, value in saved["entries"][-max_size:] if max_size > 0 else []:
+            path_cache._entries[key] = value
+        logger.info(f"Loaded {len(path_cache)} cached paths from {file_path}")
+        return path_cache
@@ -3,5 +3,7 @@ from .graphfunctions import (
     get_subnetwork,
     get_closest_node_on_network,
     get_shortest_path_length,
-    get_shortest_path_length_iter
+    get_shortest_path_length_iter,
+    get_network_shortest_path_length,
+    get_network_shortest_path_length_iter
 )
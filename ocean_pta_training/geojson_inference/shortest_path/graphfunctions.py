@@ -1,96 +1,157 @@
 import h3.api.numpy_int as h3
 import numpy as np
 from igraph import Graph
-from haversine import haversine, haversine_vector, Unit
+from ...geo import GeoPoints, haversine, within_radius
+from ..network import H3_RESOLUTIONS, ShortestPathNetwork, poi_mask_to_flags
+from ..snapping import NodeSnapper
 import math
 
+# Last (nodes_master_reversed, nodes_hexes, NodeSnapper) and (network_obj, nodes_hexes, ShortestPathNetwork)
+# built for the legacy entry points, so that repeated calls with the same objects do not rebuild them
+_legacy_snapper = None
+_legacy_network = None
+
 def get_poi_flag(poi_latlon, edge_list_mapped, nodes_master_reversed, shortest_path):
-    shortest_path_mapped_edges = [edge_list_mapped[edge][0] for edge in shortest_path[0]]
-    shortest_path_edges = [nodes_master_reversed[node] for node in shortest_path_mapped_edges]
+    shortest_path_mapped_edges = np.asarray(edge_list_mapped)[shortest_path[0], 0]
+    shortest_path_edges = GeoPoints(np.asarray(nodes_master_reversed)[shortest_path_mapped_edges])
     poi_flag = []
     for pairs in poi_latlon:
-        poi_pairs_flag = np.max(np.where((np.min(haversine_vector(pairs, shortest_path_edges, Unit.KILOMETERS, comb=True), axis = 0)) < 5, 1 ,0)) ### poi within 5km
+        poi_pairs_flag = int(np.any(within_radius(pairs, shortest_path_edges, 5)))  ### poi within 5km
         poi_flag.append(poi_pairs_flag)
     return poi_flag
 
+def get_path_poi_mask(edge_poi_masks, shortest_path):
+    """POI bitmask of a path: the union of the masks of its edges"""
+    if len(shortest_path[0]) == 0:
+        return np.uint16(0)
+    return np.bitwise_or.reduce(edge_poi_masks[shortest_path[0]])
+
+def get_subnetwork_indices(nodes_hexes, node):
+    """
+    Positions of the nodes sharing the finest H3 cell (resolution 4, then 3, 2, 1) with node;
+    all nodes if there is none
+    """
+    for resolution, resolution_hexes in zip(H3_RESOLUTIONS, nodes_hexes):
+        node_hex = h3.geo_to_h3(node[0], node[1], resolution)
+        indices = np.flatnonzero(np.asarray(resolution_hexes, dtype=np.uint64) == node_hex)
+        if len(indices) > 0:
+            return indices
+    return np.arange(len(nodes_hexes[0]))
+
 def get_subnetwork(nodes_master, nodes_hexes, node):
-    node_hex_reso4 = h3.geo_to_h3(node[0],node[1],4)
-    node_hex_reso3 = h3.geo_to_h3(node[0],node[1],3)
-    node_hex_reso2 = h3.geo_to_h3(node[0],node[1],2)
-    node_hex_reso1 = h3.geo_to_h3(node[0],node[1],1)
-    if (node_hex_reso4 in nodes_hexes[0]):
-        hex4nodes = [i for i, x in enumerate(nodes_hexes[0]) if x==node_hex_reso4]
-        network = [nodes_master[i] for i in hex4nodes]
-    elif (node_hex_reso3 in nodes_hexes[1]):
-        hex3nodes = [i for i, x in enumerate(nodes_hexes[1]) if x==node_hex_reso3]
-        network = [nodes_master[i] for i in hex3nodes]
-    elif (node_hex_reso2 in nodes_hexes[2]):
-        hex2nodes = [i for i, x in enumerate(nodes_hexes[2]) if x==node_hex_reso2]
-        network = [nodes_master[i] for i in hex2nodes]
-    elif (node_hex_reso1 in nodes_hexes[3]):
-        hex1nodes = [i for i, x in enumerate(nodes_hexes[3]) if x==node_hex_reso1]
-        network = [nodes_master[i] for i in hex1nodes]
-    else:
-        network = nodes_master
-    return network
+    return [nodes_master[i] for i in get_subnetwork_indices(nodes_hexes, node)]
 
 def get_closest_node_on_network(nodes_master_reversed, nodes_hexes, input):
-    closest_nodes = []
-    closest_nodes_dist = []
-    for node in input:        
-        node_network = get_subnetwork(nodes_master_reversed, nodes_hexes, node)
-        dist_vector = haversine_vector(node_network, node, Unit.KILOMETERS, comb=True) #lat/long
-        min_index = np.argmin(dist_vector, axis = 1)[0]
-        min_dist =  np.min(dist_vector, axis = 1)[0]
-        closest_nodes.append(node_network[min_index]) 
-        closest_nodes_dist.append(min_dist)
-    return closest_nodes,np.array(closest_nodes_dist)
+    global _legacy_snapper
+    if _legacy_snapper is None or _legacy_snapper[0] is not nodes_master_reversed or _legacy_snapper[1] is not nodes_hexes:
+        _legacy_snapper = (nodes_master_reversed, nodes_hexes, NodeSnapper(nodes_master_reversed, nodes_hexes, H3_RESOLUTIONS))
+    closest_nodes, closest_nodes_dist = _legacy_snapper[2].snap(input)
+    return [nodes_master_reversed[i] for i in closest_nodes], closest_nodes_dist
 
+def get_legacy_network(network_obj, nodes_hexes) -> ShortestPathNetwork:
+    """ShortestPathNetwork of the original pickled objects (the one built last is kept)"""
+    global _legacy_network
+    if _legacy_network is None or _legacy_network[0] is not network_obj or _legacy_network[1] is not nodes_hexes:
+        _legacy_network = (network_obj, nodes_hexes, ShortestPathNetwork.from_objects(network_obj, nodes_hexes))
+    return _legacy_network[2]
 
 def get_shortest_path_length(network_obj, nodes_hexes, source, dest):
-    g, edge_list, edge_list_mapped, weights, nodes_mapping, nodes_master, nodes_master_reversed, nodes_mapping = network_obj
-    d_od = haversine_vector(source, dest, Unit.KILOMETERS, comb=False)
-    No,d_to_No = get_closest_node_on_network(nodes_master_reversed, nodes_hexes, source)
-    Nd,d_to_Nd = get_closest_node_on_network(nodes_master_reversed, nodes_hexes, dest)
-    source_indices = [nodes_mapping[str([i[1],i[0]])] for i in No] ##reversed for haversine vector
-    target_indices = [nodes_mapping[str([i[1],i[0]])] for i in Nd] ##reversed for haversine vector
-    d_No_to_Nd = g.shortest_paths(source= source_indices, target=target_indices, weights = weights, mode='all')
+    return get_network_shortest_path_length(get_legacy_network(network_obj, nodes_hexes), source, dest)
+
+def get_network_shortest_path_length(network, source, dest):
+    g, weights = network.graph, network.weights
+    d_od = haversine(source, dest)
+    source_indices, d_to_No = network.snap(source)
+    target_indices, d_to_Nd = network.snap(dest)
+    d_No_to_Nd = g.shortest_paths(source= source_indices.tolist(), target=target_indices.tolist(), weights = "weight", mode='all')
     distance = np.where((d_od <= (d_to_No + d_to_Nd)), d_od, d_No_to_Nd)
     distance_from_source_to_network = np.where((d_od <= (d_to_No + d_to_Nd)), 0, d_to_No)
     distance_to_dest_from_network  = np.where((d_od <= (d_to_No + d_to_Nd)), 0, d_to_Nd)
     return d_od, distance, distance_from_source_to_network, distance_to_dest_from_network
 
-def get_shortest_path_length_iter(network_obj, nodes_hexes, poi_latlon, source, dest):
-    g, edge_list, edge_list_mapped, weights, nodes_mapping, nodes_master, nodes_master_reversed, nodes_mapping = network_obj
-    d_od = haversine_vector(source, dest, Unit.KILOMETERS, comb=False)
-    No,d_to_No = get_closest_node_on_network(nodes_master_reversed, nodes_hexes, source)
-    Nd,d_to_Nd = get_closest_node_on_network(nodes_master_reversed, nodes_hexes, dest)
-    source_indices = [nodes_mapping[str([i[1],i[0]])] for i in No] ##reversed for haversine vector
-    target_indices = [nodes_mapping[str([i[1],i[0]])] for i in Nd] ##reversed for haversine vector
-    d_No_to_Nd = []
-    shortest_paths=[]
-    poi_flag_master = []
+def get_edge_paths_pairwise(g, source_indices, target_indices):
+    """Edge path of each (source, target) pair, with one Dijkstra search per pair ([] if source == target)"""
+    edge_paths = []
     for i in range(0, len(source_indices)):
         if source_indices[i] == target_indices[i]:
             shortest_path = []
         else:
-            shortest_path = g.get_shortest_paths(source_indices[i], to=target_indices[i],weights=g.es["weight"],output="epath",)
-        if len(shortest_path)>0:
-            distance = np.sum([weights[edge] for edge in shortest_path[0]])
-            d_No_to_Nd.append(distance)
-            shortest_paths.append(shortest_path)
-            poi_flag = get_poi_flag(poi_latlon, edge_list_mapped, nodes_master_reversed, shortest_path)
-            poi_flag_master.append(poi_flag)
-        else:
-            try:
-                d_No_to_Nd.append(np.inf)
-                shortest_paths.append([])
-                poi_flag = [0 for _ in range(len(poi_latlon))]
-                poi_flag_master.append(poi_flag)
-                # poi_flag.append([0 for _ in range(len(poi_latlon))])  # np.zeros(poi_latlon)
-            except Exception as e:
-                print(f"Error: {e}")
+            shortest_path = g.get_shortest_paths(int(source_indices[i]), to=int(target_indices[i]),weights="weight",output="epath",)
+        edge_paths.append(shortest_path)
+    return edge_paths
+
+def get_edge_paths_batched(g, source_indices, target_indices):
+    """
+    Edge path of each (source, target) pair ([] if source == target), with one shortest-path tree
+    per distinct target: the graph is undirected, so the tree rooted at a target holds the paths
+    from all of its sources. Paths are reversed to run from the source to the target.
+    """
+    edge_paths = [[] for _ in range(len(source_indices))]
+    for target in np.unique(target_indices):
+        rows = np.flatnonzero((target_indices == target) & (source_indices != target))
+        if len(rows) == 0:
+            continue
+        unique_sources, inverse = np.unique(source_indices[rows], return_inverse=True)
+        tree_paths = g.get_shortest_paths(int(target), to=unique_sources.tolist(), weights="weight", output="epath")
+        for row, k in zip(rows, inverse.reshape(-1)):
+            edge_paths[row] = [tree_paths[k][::-1]]
+    return edge_paths
+
+def get_shortest_path_length_iter(network_obj, nodes_hexes, poi_latlon, source, dest, batched=True):
+    return get_network_shortest_path_length_iter(
+        get_legacy_network(network_obj, nodes_hexes), poi_latlon, source, dest, batched=batched
+    )
+
+def get_network_shortest_path_length_iter(network, poi_latlon, source, dest, batched=True, distance_tables=None,
+                                          path_cache=None, contraction_hierarchy=None):
+    g, weights = network.graph, network.weights
+    edge_poi_masks = network.edge_poi_mask(poi_latlon)
+    d_od = haversine(source, dest)
+    source_indices, d_to_No = network.snap(source)
+    target_indices, d_to_Nd = network.snap(dest)
+    # A path whose source node is its target node has an infinite length (and no POI)
+    d_No_to_Nd = np.full(len(source_indices), np.inf)
+    path_poi_masks = np.zeros(len(source_indices), dtype=np.uint16)
+    shortest_paths = [[] for _ in range(len(source_indices))]
+    remaining = np.flatnonzero(source_indices != target_indices)
+
+    # Rows whose destination node has a precomputed distance table are labeled with a lookup (no path)
+    if distance_tables is not None:
+        table_rows = distance_tables.table_rows(target_indices[remaining])
+        looked_up = remaining[table_rows >= 0]
+        d_No_to_Nd[looked_up], path_poi_masks[looked_up] = distance_tables.lookup(
+            source_indices[looked_up], table_rows[table_rows >= 0]
+        )
+        for row in looked_up:
+            shortest_paths[row] = None
+        remaining = remaining[table_rows < 0]
+
+    # Rows whose (source, target) nodes were routed before are labeled from the cache (no path)
+    if path_cache is not None:
+        found, distances, masks = path_cache.lookup(source_indices[remaining], target_indices[remaining])
+        cached = remaining[found]
+        d_No_to_Nd[cached], path_poi_masks[cached] = distances[found], masks[found]
+        for row in cached:
+            shortest_paths[row] = None
+        remaining = remaining[~found]
+
+    if contraction_hierarchy is not None:
+        edge_paths = contraction_hierarchy.get_edge_paths(source_indices[remaining], target_indices[remaining])
+    elif batched:
+        edge_paths = get_edge_paths_batched(g, source_indices[remaining], target_indices[remaining])
+    else:
+        edge_paths = get_edge_paths_pairwise(g, source_indices[remaining], target_indices[remaining])
+    for row, shortest_path in zip(remaining, edge_paths):
+        d_No_to_Nd[row] = np.sum(weights[shortest_path[0]])
+        path_poi_masks[row] = get_path_poi_mask(edge_poi_masks, shortest_path)
+        shortest_paths[row] = shortest_path
+    if path_cache is not None:
+        path_cache.store(
+            source_indices[remaining], target_indices[remaining], d_No_to_Nd[remaining], path_poi_masks[remaining]
+        )
+
+    poi_flag_master = poi_mask_to_flags(path_poi_masks, len(poi_latlon)).tolist()
     distance = np.where((d_od <= (d_to_No + d_to_Nd)), d_od, d_No_to_Nd)
     distance_from_source_to_network = np.where((d_od <= (d_to_No + d_to_Nd)), 0, d_to_No)
     distance_to_dest_from_network  = np.where((d_od <= (d_to_No + d_to_Nd)), 0, d_to_Nd)
-    return shortest_paths, d_od, distance, distance_from_source_to_network, distance_to_dest_from_network, poi_flag_master
\ No newline at end of file
+    return shortest_paths, d_od, distance, distance_from_source_to_network, distance_to_dest_from_network, poi_flag_master
@@ -0,0 +1,103 @@
+"""
+Batched snapping of [lat, lon] points to the closest node of the ocean network.
+
+The candidate nodes of a point are those sharing its H3 cell at the finest resolution where any
+node does (4, then 3, 2, 1), or every node if there is none, as in get_subnetwork. NodeSnapper
+prebuilds, for each resolution, the sorted array of node cells and the nodes of each cell,
+so that a batch of points is resolved with binary searches instead of scans over every node.
+Points are then grouped by candidate cell, and the nearest node of each group is found with
+one vectorized distance computation.
+"""
+import h3.api.numpy_int as h3
+import numpy as np
+from typing import List, Sequence, Tuple
+from ..geo import GeoPoints, nearest_neighbour
+
+ALL_NODES = -1  # resolution level of the points whose candidates are all the nodes
+
+
+class H3CellIndex(object):
+    """
+    The nodes of each H3 cell, at one resolution, as sorted cells plus offsets into node positions
+    """
+    cells: np.ndarray    # uint64, sorted unique cells
+    offsets: np.ndarray  # int64, len(cells) + 1
+    nodes: np.ndarray    # int64, node positions grouped by cell (ascending within a cell)
+
+    def __init__(self, node_cells: np.ndarray):
+        node_cells = np.asarray(node_cells, dtype=np.uint64)
+        self.nodes = np.argsort(node_cells, kind="stable")
+        self.cells, counts = np.unique(node_cells[self.nodes], return_counts=True)
+        self.offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+
+    def lookup(self, cells: np.ndarray) -> np.ndarray:
+        """Position of each cell in self.cells, or -1 if no node is in that cell"""
+        if len(self.cells) == 0:
+            return np.full(len(cells), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.cells, cells), len(self.cells) - 1)
+        return np.where(self.cells[positions] == cells, positions, -1)
+
+    def cell_nodes(self, position: int) -> np.ndarray:
+        return self.nodes[self.offsets[position]:self.offsets[position + 1]]
+
+
+class NodeSnapper(object):
+    """
+    Prebuilt spatial index over the network nodes, snapping batches of points to their closest node.
+    """
+    resolutions: List[int]
+    node_points: GeoPoints
+    cell_indexes: List[H3CellIndex]
+
+    def __init__(self, node_latlon: np.ndarray, node_hexes: Sequence, resolutions: Sequence[int]):
+        self.resolutions = list(resolutions)
+        self.node_points = GeoPoints(node_latlon)
+        self.cell_indexes = [H3CellIndex(node_cells) for node_cells in node_hexes]
+
+    def candidate_cells(self, latlon: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        For each point, the resolution level (position in self.resolutions, or ALL_NODES) and
+        the position of the cell (in that level's index) whose nodes are the point's candidates
+        """
+        level = np.full(len(latlon), ALL_NODES, dtype=np.int64)
+        cell = np.full(len(latlon), -1, dtype=np.int64)
+        for i, (resolution, cell_index) in enumerate(zip(self.resolutions, self.cell_indexes)):
+            unresolved = np.flatnonzero(level == ALL_NODES)
+            if len(unresolved) == 0:
+                break
+            cells = np.array(
+                [h3.geo_to_h3(lat, lon, resolution) for lat, lon in latlon[unresolved]], dtype=np.uint64
+            )
+            positions = cell_index.lookup(cells)
+            found = positions >= 0
+            level[unresolved[found]] = i
+            cell[unresolved[found]] = positions[found]
+        return level, cell
+
+    def snap(self, latlon) -> Tuple[np.ndarray, np.ndarray]:
+        """Closest node (position) to each [lat, lon] point, and the distance to it in km"""
+        latlon = np.asarray(latlon, dtype=np.float64).reshape(-1, 2)
+        if len(latlon) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        # Repeated points (e.g. the destination port of every row of an OD) are snapped once
+        unique_latlon, inverse = np.unique(latlon, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        unique_ids = np.zeros(len(unique_latlon), dtype=np.int64)
+        unique_distances = np.zeros(len(unique_latlon), dtype=np.float64)
+
+        level, cell = self.candidate_cells(unique_latlon)
+        groups = np.lexsort((cell, level))
+        group_starts = np.flatnonzero(np.r_[True, (np.diff(level[groups]) != 0) | (np.diff(cell[groups]) != 0)])
+        for points in np.split(groups, group_starts[1:]):
+            if level[points[0]] == ALL_NODES:
+                candidates = np.arange(len(self.node_points))
+            else:
+                candidates = self.cell_indexes[level[points[0]]].cell_nodes(cell[points[0]])
+            closest, closest_distance = nearest_neighbour(
+                unique_latlon[points], self.node_points.take(candidates)
+            )
+            unique_ids[points] = candidates[closest]
+            unique_distances[points] = closest_distance
+
+        return unique_ids[inverse], unique_distances[inverse]
@@ -0,0 +1,189 @@
+"""
+A persisted index over the route extractor's training files (od_extracts/*.feather), with one entry
+per journey: its OD, IMO, unique_route_ID, first and last timestamps, the file holding it and its
+row range in that file.
+
+Queries (by OD, IMO and time range) are answered from the index alone, without opening the
+training files. The selected journeys are then read from memory-mapped Arrow files: only the
+rows of the selected ranges are converted, so a single journey can be read without loading its
+whole OD. The extractor writes its training files uncompressed, which makes the memory-mapped
+reads zero-copy (compressed files written by earlier versions are still readable, but each
+file is decompressed when first accessed).
+"""
+import logging
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from typing import Dict, List, Optional, Sequence, Union
+from .constants import JOURNEY_INDEX_FILE_NAME
+from .env import Environment
+
+logger = logging.getLogger(f"{__name__}")
+
+Timestamp = Union[str, pd.Timestamp, np.datetime64]
+
+
+class JourneyIndex(object):
+    """
+    Index of the journeys in a directory of OD extracts, sorted by (OD, IMO, start_time).
+    """
+    FORMAT_VERSION: int = 1
+    INDEX_COLUMNS: List[str] = [
+        'OD', 'IMO', 'unique_route_ID', 'start_time', 'end_time', 'file_name', 'row_start', 'row_stop'
+    ]
+
+    output_dir: str
+    entries: pd.DataFrame
+
+    def __init__(self, output_dir: str, entries: pd.DataFrame):
+        self.output_dir = output_dir
+        self.entries = (
+            entries[self.INDEX_COLUMNS]
+            .sort_values(['OD', 'IMO', 'start_time'], kind='mergesort')
+            .reset_index(drop=True)
+        )
+        self.entries['OD'] = self.entries['OD'].astype(str).astype('category')
+        self.entries['file_name'] = self.entries['file_name'].astype('category')
+
+        # Plain arrays, so that queries do not go through pandas
+        self._od_codes: Dict[str, int] = {od: code for code, od in enumerate(self.entries['OD'].cat.categories)}
+        self._od = self.entries['OD'].cat.codes.to_numpy()
+        self._imo = self.entries['IMO'].to_numpy()
+        self._start_time = self.entries['start_time'].to_numpy().astype('datetime64[ns]')
+        self._end_time = self.entries['end_time'].to_numpy().astype('datetime64[ns]')
+        self._tables: Dict[str, pa.Table] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries.index)
+
+    @classmethod
+    def build(cls, output_dir: str, extracts_subdir: str) -> "JourneyIndex":
+        """
+        Index every .feather file in output_dir/extracts_subdir. A journey is a run of rows with
+        the same (IMO, unique_route_ID); only the key and time columns of each file are read.
+        """
+        extracts_dir = os.path.join(output_dir, extracts_subdir)
+        entries = []
+        for file_name in sorted(x for x in os.listdir(extracts_dir) if x.endswith(".feather")):
+            relative_path = os.path.join(extracts_subdir, file_name)
+            keys_df = feather.read_table(
+                os.path.join(extracts_dir, file_name),
+                columns=['OD', 'IMO', 'unique_route_ID', 'TimePosition'],
+                memory_map=True
+            ).to_pandas()
+            if keys_df.empty:
+                continue
+            imo = keys_df['IMO'].to_numpy()
+            route_id = keys_df['unique_route_ID'].to_numpy()
+            is_boundary = (imo[1:] != imo[:-1]) | (route_id[1:] != route_id[:-1])
+            row_start = np.r_[0, np.flatnonzero(is_boundary) + 1]
+            row_stop = np.r_[row_start[1:], len(keys_df.index)]
+            time_position = keys_df['TimePosition'].to_numpy()
+            entries.append(pd.DataFrame({
+                'OD': keys_df['OD'].astype(str).to_numpy()[row_start],
+                'IMO': imo[row_start],
+                'unique_route_ID': route_id[row_start],
+                'start_time': np.minimum.reduceat(time_position, row_start),
+                'end_time': np.maximum.reduceat(time_position, row_start),
+                'file_name': relative_path,
+                'row_start': row_start,
+                'row_stop': row_stop
+            }))
+        if entries:
+            entries_df = pd.concat(entries, ignore_index=True)
+        else:
+            entries_df = pd.DataFrame({c: [] for c in cls.INDEX_COLUMNS})
+        logger.info(f"Indexed {len(entries_df.index)} journeys in {len(entries)} files under {extracts_dir}")
+        return cls(output_dir, entries_df)
+
+    def save(self, file_path: Optional[str] = None) -> None:
+        file_path = file_path or os.path.join(self.output_dir, JOURNEY_INDEX_FILE_NAME)
+        table = pa.Table.from_pandas(self.entries, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}), b"journey_index_version": str(self.FORMAT_VERSION).encode()
+        })
+        feather.write_feather(table, file_path, compression="uncompressed")
+
+    @classmethod
+    def load(cls, output_dir: Optional[str] = None) -> "JourneyIndex":
+        """Load the index saved in the extractor's output directory"""
+        output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+        file_path = os.path.join(output_dir, JOURNEY_INDEX_FILE_NAME)
+        table = feather.read_table(file_path, memory_map=True)
+        version = (table.schema.metadata or {}).get(b"journey_index_version", b"").decode()
+        if version != str(cls.FORMAT_VERSION):
+            message = f"Unsupported journey index version {version or None} in {file_path}"
+            logger.error(message)
+            raise ValueError(message)
+        return cls(output_dir, table.to_pandas())
+
+    def query(self,
+              od: Optional[Union[str, Sequence[str]]] = None,
+              imo: Optional[Union[int, Sequence[int]]] = None,
+              start: Optional[Timestamp] = None,
+              end: Optional[Timestamp] = None) -> pd.DataFrame:
+        """
+        Index entries of the journeys matching every given filter. With start and/or end,
+        the journeys overlapping the time range [start, end] are selected.
+        """
+        # The entries are sorted by OD code, then IMO: the journeys of each OD, and of each IMO within it,
+        # are a contiguous slice found by binary search, and only the selected rows are filtered by time
+        if od is not None:
+            ods = [od] if isinstance(od, str) else list(od)
+            codes = np.unique([self._od_codes[x] for x in ods if x in self._od_codes]).astype(self._od.dtype)
+            od_slices = zip(np.searchsorted(self._od, codes, 'left'), np.searchsorted(self._od, codes, 'right'))
+        else:
+            od_slices = [(0, len(self))]
+        imos = np.unique(np.atleast_1d(imo)).astype(self._imo.dtype) if imo is not None else None
+
+        rows = []
+        for od_start, od_stop in od_slices:
+            if imos is None:
+                rows.append(np.arange(od_start, od_stop))
+            elif od is None:
+                # IMOs are only sorted within an OD
+                rows.append(np.flatnonzero(np.isin(self._imo, imos)))
+            else:
+                od_imo = self._imo[od_start:od_stop]
+                rows.extend(
+                    np.arange(od_start + imo_start, od_start + imo_stop) for imo_start, imo_stop in
+                    zip(np.searchsorted(od_imo, imos, 'left'), np.searchsorted(od_imo, imos, 'right'))
+                )
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+
+        if start is not None:
+            rows = rows[self._end_time[rows] >= np.datetime64(pd.Timestamp(start), 'ns')]
+        if end is not None:
+            rows = rows[self._start_time[rows] <= np.datetime64(pd.Timestamp(end), 'ns')]
+        return self.entries.iloc[rows]
+
+    def _get_table(self, file_name: str) -> pa.Table:
+        """Memory-mapped table of one training file (kept open for later reads)"""
+        if file_name not in self._tables:
+            self._tables[file_name] = feather.read_table(
+                os.path.join(self.output_dir, file_name), memory_map=True
+            )
+        return self._tables[file_name]
+
+    def read(self, selection: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Read the rows of the journeys in selection (entries returned by query), in the order of selection
+        """
+        slices = []
+        for file_name, row_start, row_stop in zip(
+                selection['file_name'].astype(str), selection['row_start'], selection['row_stop']):
+            table = self._get_table(file_name)
+            if columns is not None:
+                table = table.select(columns)
+            slices.append(table.slice(int(row_start), int(row_stop - row_start)))
+        if not slices:
+            return pd.DataFrame(columns=columns)
+        return pa.concat_tables(slices).to_pandas()
+
+    def read_journey(self, od: str, imo: int, unique_route_id: int,
+                     columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Read a single journey"""
+        selection = self.query(od=od, imo=imo)
+        return self.read(selection[selection['unique_route_ID'] == unique_route_id], columns)
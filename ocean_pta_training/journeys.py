@@ -0,0 +1,279 @@
+"""
+A journey-level (ragged) representation of ping-level data. Each journey, identified
+by its key columns (by default IMO, OD and unique_route_id), owns a contiguous range
+of rows in a set of ping arrays, delimited by an offsets array:
+
+    pings of journey i = columns[name][offsets[i]:offsets[i + 1]]
+
+Journey boundaries are found once, when the container is built; per-journey operations
+(first/last ping, within-journey differences, reductions, subsets) then work on the
+offsets without sorting or scanning the ping-level frame again.
+
+On disk, Journeys are stored as an Arrow IPC (feather) file with one row per journey:
+the key columns, plus one list column per ping column. Files are written uncompressed,
+so they can be memory-mapped when read back.
+"""
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger(f"{__name__}")
+
+JOURNEY_KEYS: List[str] = ['IMO', 'OD', 'unique_route_id']
+
+
+def _first_reaching(values: np.ndarray, reference: np.ndarray, step: float,
+                    lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    For each i, the first position p in [lo[i], hi[i]) where values[p] - reference[i] >= step, or hi[i]
+    if there is none. values must be non-decreasing in each range (a bisection runs on all of them at once).
+    """
+    lo = lo.copy()
+    hi = hi.copy()
+    active = np.flatnonzero(lo < hi)
+    while len(active):
+        mid = (lo[active] + hi[active]) // 2
+        reached = values[mid] - reference[active] >= step
+        hi[active[reached]] = mid[reached]
+        lo[active[~reached]] = mid[~reached] + 1
+        active = active[lo[active] < hi[active]]
+    return lo
+
+
+def _key_array(values: pd.Series) -> np.ndarray:
+    """Array used to compare keys (categorical columns are compared through their codes)"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy()
+    return values.to_numpy()
+
+
+class Journeys(object):
+    """
+    Ragged container of ping arrays, with one entry per journey.
+    """
+    keys: pd.DataFrame           # one row per journey: key columns and per-journey attributes
+    offsets: np.ndarray          # int64, len(keys) + 1 values
+    columns: Dict[str, np.ndarray]
+    positions: Optional[np.ndarray]  # row position, in the source frame, of each ping
+
+    def __init__(self, keys: pd.DataFrame, offsets: np.ndarray, columns: Dict[str, np.ndarray],
+                 positions: Optional[np.ndarray] = None):
+        self.keys = keys.reset_index(drop=True)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = dict(columns)
+        self.positions = positions
+
+        if len(self.offsets) != len(self.keys) + 1:
+            raise ValueError(f"Expected {len(self.keys) + 1} offsets for {len(self.keys)} journeys")
+        for name, values in self.columns.items():
+            if len(values) != self.n_pings:
+                raise ValueError(f"Ping column {name} has {len(values)} values; expected {self.n_pings}")
+
+    @classmethod
+    def from_frame(cls,
+                   df: pd.DataFrame,
+                   key_columns: Sequence[str] = JOURNEY_KEYS,
+                   columns: Optional[Sequence[str]] = None,
+                   journey_columns: Sequence[str] = (),
+                   order_by: Optional[str] = None,
+                   check_contiguous: bool = True) -> "Journeys":
+        """
+        Build Journeys from a ping-level frame.
+
+        If order_by is given, the rows are first (stably) sorted by the key columns and order_by.
+        Otherwise, each journey must occupy a contiguous range of rows of df, already in order;
+        with check_contiguous=False, every run of rows with equal keys is taken as a journey,
+        even if the same keys appear again further down.
+
+        columns are the ping columns to keep (default: all columns except keys and journey_columns).
+        journey_columns are constant within a journey, and are kept once per journey, in keys.
+        """
+        key_columns = list(key_columns)
+        journey_columns = list(journey_columns)
+        if columns is None:
+            columns = [c for c in df.columns if c not in key_columns and c not in journey_columns]
+
+        if order_by is not None:
+            sort_keys = [_key_array(df[c]) for c in reversed(key_columns + [order_by])]
+            positions = np.lexsort(sort_keys)
+        else:
+            positions = np.arange(len(df.index))
+
+        key_arrays = [_key_array(df[c])[positions] for c in key_columns]
+        n_pings = len(positions)
+        if n_pings > 0:
+            is_boundary = np.zeros(n_pings - 1, dtype=bool)
+            for values in key_arrays:
+                is_boundary |= values[1:] != values[:-1]
+            starts = np.r_[0, np.flatnonzero(is_boundary) + 1]
+        else:
+            starts = np.zeros(0, dtype=np.int64)
+        offsets = np.r_[starts, n_pings].astype(np.int64)
+
+        keys = df[key_columns + journey_columns].iloc[positions[starts]].reset_index(drop=True)
+        if order_by is None and check_contiguous and keys.duplicated(key_columns).any():
+            message = "Journeys are not contiguous in the frame; pass order_by to sort the pings first"
+            logger.error(message)
+            raise ValueError(message)
+
+        return cls(
+            keys=keys,
+            offsets=offsets,
+            columns={c: df[c].to_numpy()[positions] for c in columns},
+            positions=positions
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def n_pings(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of pings in each journey"""
+        return np.diff(self.offsets)
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self.offsets[:-1]
+
+    @property
+    def journey_index(self) -> np.ndarray:
+        """For each ping, the position of its journey"""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def journey(self, i: int) -> pd.DataFrame:
+        """The pings of one journey"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return pd.DataFrame({name: values[start:end] for name, values in self.columns.items()})
+
+    def first(self, name: str) -> np.ndarray:
+        """Value of a ping column at the first ping of each journey (journeys must not be empty)"""
+        return self.columns[name][self.offsets[:-1]]
+
+    def last(self, name: str) -> np.ndarray:
+        """Value of a ping column at the last ping of each journey (journeys must not be empty)"""
+        return self.columns[name][self.offsets[1:] - 1]
+
+    def diff(self, name: str) -> np.ndarray:
+        """Difference with the previous ping of the same journey (NaN at the first ping)"""
+        values = self.columns[name]
+        result = np.empty(len(values), dtype=np.result_type(values.dtype, np.float64))
+        if len(values):
+            result[1:] = values[1:] - values[:-1]
+        result[self.offsets[:-1][self.lengths > 0]] = np.nan
+        return result
+
+    def reduce(self, values: np.ndarray, ufunc: np.ufunc = np.add) -> np.ndarray:
+        """
+        Reduce a ping-level array (e.g. a column, or a boolean mask) to one value per journey,
+        with ufunc (np.add, np.maximum, np.logical_or...). Journeys must not be empty.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=values.dtype)
+        return ufunc.reduceat(values, self.offsets[:-1])
+
+    def sample(self, times: np.ndarray, min_time_step: Optional[float],
+               distances: Optional[np.ndarray] = None, min_distance_step: Optional[float] = None,
+               max_per_journey: Optional[int] = None, first_reference: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Boolean mask of the pings sampled at a cadence: the first ping of each journey, then the first ping
+        at least min_time_step (in times) or min_distance_step (in distances, cumulative along the journey)
+        after the previously sampled one, up to max_per_journey pings per journey. A step of None is not used.
+        times and distances must be non-decreasing within each journey. first_reference is, for each journey,
+        the time the second sample is measured from (by default, the time of its first ping).
+
+        The sampled pings of all journeys are found together, one sample (a vectorized bisection) at a time.
+        """
+        sampled = np.zeros(self.n_pings, dtype=bool)
+        journeys = np.flatnonzero(self.lengths > 0)
+        current = self.offsets[:-1][journeys]
+        end = self.offsets[1:][journeys]
+        reference_time = times[current] if first_reference is None else np.asarray(first_reference)[journeys]
+        n_samples = 0
+        while len(current) and (max_per_journey is None or n_samples < max_per_journey):
+            sampled[current] = True
+            n_samples += 1
+            following = end.copy()
+            if min_time_step is not None:
+                following = _first_reaching(times, reference_time, min_time_step, current + 1, end)
+            if min_distance_step is not None:
+                following = np.minimum(
+                    following, _first_reaching(distances, distances[current], min_distance_step, current + 1, end)
+                )
+            has_following = following < end
+            current, end = following[has_following], end[has_following]
+            reference_time = times[current]
+        return sampled
+
+    def take(self, journeys: np.ndarray) -> "Journeys":
+        """A subset of journeys (given by position, or by a boolean mask), copied contiguously"""
+        journeys = np.arange(len(self))[journeys]
+        lengths = self.lengths[journeys]
+        offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        # Ping positions of the selected journeys, in the order of the selection
+        pings = np.repeat(self.offsets[:-1][journeys] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Journeys(
+            keys=self.keys.iloc[journeys],
+            offsets=offsets,
+            columns={name: values[pings] for name, values in self.columns.items()},
+            positions=None if self.positions is None else self.positions[pings]
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """Ping-level frame, with the key (and journey) columns repeated for each ping"""
+        df = self.keys.iloc[self.journey_index].reset_index(drop=True)
+        for name, values in self.columns.items():
+            df[name] = values
+        return df
+
+    def to_table(self) -> pa.Table:
+        """Arrow table with one row per journey and one list column per ping column"""
+        table = pa.Table.from_pandas(self.keys, preserve_index=False)
+        offsets = pa.array(self.offsets.astype(np.int32) if self.n_pings < 2 ** 31 else self.offsets)
+        list_type = pa.ListArray if offsets.type == pa.int32() else pa.LargeListArray
+        for name, values in self.columns.items():
+            table = table.append_column(name, list_type.from_arrays(offsets, pa.array(values)))
+        return table
+
+    @classmethod
+    def from_table(cls, table: pa.Table, key_columns: Optional[Sequence[str]] = None) -> "Journeys":
+        """Inverse of to_table: the list columns are ping columns, every other column goes to keys"""
+        table = table.combine_chunks()
+        list_columns = [
+            field.name for field in table.schema
+            if pa.types.is_list(field.type) or pa.types.is_large_list(field.type)
+        ]
+        keys = table.drop(list_columns).to_pandas()
+        if key_columns is not None:
+            keys = keys[list(key_columns) + [c for c in keys.columns if c not in key_columns]]
+
+        offsets = np.zeros(table.num_rows + 1, dtype=np.int64)
+        columns = {}
+        for name in list_columns:
+            list_array = table.column(name).chunk(0) if table.num_rows else None
+            if list_array is None:
+                columns[name] = np.zeros(0)
+                continue
+            offsets = list_array.offsets.to_numpy().astype(np.int64)
+            values = list_array.values.slice(offsets[0], offsets[-1] - offsets[0])
+            offsets = offsets - offsets[0]
+            columns[name] = values.to_numpy(zero_copy_only=False)
+        return cls(keys=keys, offsets=offsets, columns=columns)
+
+    def save(self, file_path: str) -> None:
+        """Write as an uncompressed Arrow IPC (feather) file, which can be memory-mapped"""
+        feather.write_feather(self.to_table(), file_path, compression="uncompressed")
+
+    @classmethod
+    def load(cls, file_path: str, memory_map: bool = True) -> "Journeys":
+        """Read Journeys written by save()"""
+        return cls.from_table(feather.read_table(file_path, memory_map=memory_map))
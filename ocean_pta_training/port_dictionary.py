@@ -0,0 +1,186 @@
+"""
+A shared dictionary of port locodes and origin-destination (OD) strings, with stable
+integer codes. The route extractor creates (or extends) the dictionary and saves it to
+its output directory; every later step loads it to encode port and OD columns as pandas
+categoricals whose codes are the dictionary codes.
+
+Codes are stable: entries are only ever appended, so a code keeps its meaning across
+runs and across files. Categorical columns written to feather or Parquet are stored as
+Arrow dictionary arrays and are read back as categoricals with the same categories.
+"""
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+from typing import Dict, Iterable, List, Optional
+from .constants import PORT_DICTIONARY_FILE_NAME
+from .env import Environment
+
+logger = logging.getLogger(f"{__name__}")
+
+OD_SEPARATOR = "-"
+
+
+class PortDictionary(object):
+    """
+    Append-only mapping of port locodes and OD strings (e.g. "CNLYG-CNSZX") to integer codes.
+    """
+    FORMAT_VERSION: int = 1
+
+    ports: List[str]
+    ods: List[str]
+
+    def __init__(self, ports: Optional[Iterable[str]] = None, ods: Optional[Iterable[str]] = None):
+        self.ports = []
+        self.ods = []
+        self._port_codes: Dict[str, int] = {}
+        self._od_codes: Dict[str, int] = {}
+        self.add_ports(ports or [])
+        self.add_ods(ods or [])
+
+    def add_ports(self, ports: Iterable[str]) -> None:
+        """Append the ports that are not in the dictionary yet (in sorted order, for reproducibility)"""
+        new_ports = sorted({p for p in ports if isinstance(p, str) and p not in self._port_codes})
+        for port in new_ports:
+            self._port_codes[port] = len(self.ports)
+            self.ports.append(port)
+
+    def add_ods(self, ods: Iterable[str]) -> None:
+        """Append the ODs that are not in the dictionary yet; their ports are added as well"""
+        new_ods = sorted({od for od in ods if isinstance(od, str) and od not in self._od_codes})
+        self.add_ports(port for od in new_ods for port in od.split(OD_SEPARATOR))
+        for od in new_ods:
+            self._od_codes[od] = len(self.ods)
+            self.ods.append(od)
+
+    def port_code(self, port: str) -> int:
+        """Code of a port, or -1 if it is not in the dictionary"""
+        return self._port_codes.get(port, -1)
+
+    def od_code(self, od: str) -> int:
+        """Code of an OD, or -1 if it is not in the dictionary"""
+        return self._od_codes.get(od, -1)
+
+    @property
+    def port_dtype(self) -> pd.CategoricalDtype:
+        return pd.CategoricalDtype(categories=self.ports)
+
+    @property
+    def od_dtype(self) -> pd.CategoricalDtype:
+        return pd.CategoricalDtype(categories=self.ods)
+
+    def encode_ports(self, ports: pd.Series) -> pd.Series:
+        """Port column as a categorical whose codes are the dictionary codes"""
+        return self._encode(ports, self.port_dtype, "ports")
+
+    def encode_ods(self, ods: pd.Series) -> pd.Series:
+        """OD column as a categorical whose codes are the dictionary codes"""
+        return self._encode(ods, self.od_dtype, "ODs")
+
+    @staticmethod
+    def _encode(values: pd.Series, dtype: pd.CategoricalDtype, description: str) -> pd.Series:
+        if isinstance(values.dtype, pd.CategoricalDtype) and values.dtype == dtype:
+            return values
+        encoded = values.astype(dtype)
+        n_unknown = int((encoded.isna() & values.notna()).sum())
+        if n_unknown:
+            logger.warning(f"{n_unknown} values are not in the port dictionary's {description} and were set to NaN")
+        return encoded
+
+    def od_origin_codes(self) -> np.ndarray:
+        """Port code of the origin of each OD, indexed by OD code"""
+        return np.array([self.port_code(od.split(OD_SEPARATOR)[0]) for od in self.ods], dtype=np.int32)
+
+    def od_destination_codes(self) -> np.ndarray:
+        """Port code of the destination of each OD, indexed by OD code"""
+        return np.array([self.port_code(od.split(OD_SEPARATOR)[-1]) for od in self.ods], dtype=np.int32)
+
+    def port_values(self, port_to_value: pd.Series, fill_value=np.nan) -> np.ndarray:
+        """
+        Lookup table indexed by port code, from a Series indexed by locode
+        (e.g. the latitude of every port).
+        """
+        table = np.full(len(self.ports), fill_value, dtype=np.result_type(port_to_value.dtype, type(fill_value)))
+        codes = np.array([self.port_code(p) for p in port_to_value.index], dtype=np.int64)
+        known = codes >= 0
+        table[codes[known]] = port_to_value.to_numpy()[known]
+        return table
+
+    def save(self, file_path: str) -> None:
+        with open(file_path, "w") as json_file:
+            json.dump({"version": self.FORMAT_VERSION, "ports": self.ports, "ods": self.ods}, json_file, indent=1)
+
+    @classmethod
+    def load(cls, file_path: str) -> "PortDictionary":
+        with open(file_path, "r") as json_file:
+            data = json.load(json_file)
+        if data.get("version") != cls.FORMAT_VERSION:
+            message = f"Unsupported port dictionary version {data.get('version')} in {file_path}"
+            logger.error(message)
+            raise ValueError(message)
+        port_dictionary = cls()
+        # Preserve the saved order, which defines the codes
+        for port in data.get("ports", []):
+            port_dictionary._port_codes[port] = len(port_dictionary.ports)
+            port_dictionary.ports.append(port)
+        for od in data.get("ods", []):
+            port_dictionary._od_codes[od] = len(port_dictionary.ods)
+            port_dictionary.ods.append(od)
+        return port_dictionary
+
+    @classmethod
+    def load_or_create(cls, file_path: str) -> "PortDictionary":
+        if os.path.isfile(file_path):
+            return cls.load(file_path)
+        return cls()
+
+
+def get_port_dictionary_path(output_dir: Optional[str] = None) -> str:
+    """The port dictionary lives in the extractor's output directory"""
+    if not output_dir:
+        output_dir = os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    return os.path.join(output_dir, PORT_DICTIONARY_FILE_NAME)
+
+
+def load_port_dictionary(output_dir: Optional[str] = None) -> PortDictionary:
+    """Load the port dictionary written by the route extractor"""
+    file_path = get_port_dictionary_path(output_dir)
+    if not os.path.isfile(file_path):
+        message = (
+            f"There is no port dictionary at {file_path}: it is written by the route extractor, and outputs "
+            f"extracted before it existed do not have one. Re-run 01_extract_routes_with_local_configs.py, "
+            f"or build it from the existing OD extracts with "
+            f"ocean_pta_training.port_dictionary.build_port_dictionary_from_extracts()"
+        )
+        logger.error(message)
+        raise FileNotFoundError(message)
+    logger.info(f"Loading the port dictionary from {file_path}")
+    return PortDictionary.load(file_path)
+
+
+def build_port_dictionary_from_extracts(output_dir: Optional[str] = None) -> PortDictionary:
+    """
+    Add the ODs and ports of the OD extracts in the extractor's output directory (od_extracts/*.feather)
+    to its port dictionary, creating it if needed, and save it
+    """
+    # Imported here: the route extraction package imports this module
+    from .route_extraction.constants import OUTPUT_TRAINING_FILE_SUBDIR
+    output_dir = output_dir or os.environ.get(Environment.Vars.PATH_TO_OUTPUT_DIRECTORY)
+    extracts_dir = os.path.join(output_dir, OUTPUT_TRAINING_FILE_SUBDIR)
+    file_path = get_port_dictionary_path(output_dir)
+    port_dictionary = PortDictionary.load_or_create(file_path)
+    for file_name in sorted(x for x in os.listdir(extracts_dir) if x.endswith(".feather")):
+        table = feather.read_table(os.path.join(extracts_dir, file_name), memory_map=True)
+        port_columns = [c for c in ('stopped_closest_port', 'mapped_stopped_closest_port') if c in table.column_names]
+        extract_df = table.select(['OD'] + port_columns).to_pandas()
+        port_dictionary.add_ods(extract_df['OD'].astype(object).dropna().unique())
+        for column in port_columns:
+            port_dictionary.add_ports(extract_df[column].astype(object).dropna().unique())
+    port_dictionary.save(file_path)
+    logger.info(
+        f"Saved a port dictionary of {len(port_dictionary.ports)} ports and {len(port_dictionary.ods)} ODs, "
+        f"from the OD extracts in {extracts_dir}, to {file_path}"
+    )
+    return port_dictionary
@@ -11,6 +11,16 @@ JOB_ORIGIN: Final = "origin"
 JOB_DESTINATION: Final = "destination"
 OUTPUT_TRAINING_FILE_SUBDIR: Final = "od_extracts"
 OUTPUT_STATS_SUBDIR: Final = "od_stats"
+OUTPUT_STATE_SUBDIR: Final = "extraction_state"
+OUTPUT_JOURNEYS_SUBDIR: Final = "od_journeys"
+
+# Files saved under OUTPUT_STATE_SUBDIR, used to re-run the extraction incrementally
+STATE_PORTS_FILENAME: Final = "ports_snapshot.csv"
+STATE_STOPPED_PORTS_FILENAME: Final = "stopped_closest_port.feather"
+STATE_PORT_SEQUENCES_FILENAME: Final = "digested_port_sequences.pickle"
+
+# Per-OD aggregates (see od_aggregates.py), saved under OUTPUT_STATS_SUBDIR
+OD_AGGREGATES_FILENAME: Final = "od_aggregates.json"
 
 
 # Uncategorized constants
@@ -1,6 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from numpy import array as np_array, ndarray as np_ndarray
-from typing import Dict
+from typing import Dict, Set
 
 @dataclass
 class VesselPortSequence:
@@ -16,3 +16,27 @@ class VesselPortSequence:
         self.port_str = port_str
         self.port_map = port_map
         self.row_pos = row_pos
+
+
+@dataclass
+class PortsTableDiff:
+    """
+    Describes the differences between two versions of the ports reference file.
+    Ports are identified by their (unmapped) locode.
+    """
+    added: Set[str] = field(default_factory=set)
+    removed: Set[str] = field(default_factory=set)
+    moved: Set[str] = field(default_factory=set)      # lat/lon changed
+    remapped: Set[str] = field(default_factory=set)   # mapped_locode changed
+
+    @property
+    def relocated(self) -> Set[str]:
+        """Ports whose position (or existence) changed: stopped_closest_port must be recomputed near them"""
+        return self.added | self.removed | self.moved
+
+    @property
+    def changed(self) -> Set[str]:
+        return self.relocated | self.remapped
+
+    def is_empty(self) -> bool:
+        return len(self.changed) == 0
@@ -10,6 +10,7 @@ import sys
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
 from itertools import chain, count
+from .data_objects import PortsTableDiff
 
 
 def np_runlengths(seq, return_run_numbers=False, as_frame=False):
@@ -186,12 +187,12 @@ def cleanse_port_sequence(od_df):
     """<TODO>"""
     port_sequences = (
         od_df
-        .groupby(['OD', 'IMO', 'route_ID'], group_keys=False)
+        .groupby(['OD', 'IMO', 'route_ID'], group_keys=False, observed=True)
         ['mapped_stopped_closest_port'].apply(get_port_sequence).reset_index()
     )
     journey_times = (
         od_df
-        .groupby(['OD', 'IMO', 'route_ID'], group_keys=False)
+        .groupby(['OD', 'IMO', 'route_ID'], group_keys=False, observed=True)
         .agg(journey_time=('remaining_lead_time', 'max'))
         .reset_index()
     )
@@ -205,7 +206,7 @@ def cleanse_port_sequence(od_df):
     port_sequences = port_sequences.merge(journey_times, how='inner', on=['OD', 'IMO', 'route_ID'])
     od_port_sequence = (
         port_sequences[['OD', 'IMO', 'port_sequence', 'num_intermediate_ports', 'journey_time']]
-        .groupby(['OD', 'port_sequence'])
+        .groupby(['OD', 'port_sequence'], observed=True)
         .agg(
             num_routes=('IMO', 'count'),
             num_intermediate_ports=('num_intermediate_ports', 'mean'),
@@ -229,7 +230,7 @@ def cleanse_port_sequence(od_df):
     port_sequences_valid = port_sequences[port_sequences.port_sequence.isin(od_port_sequence_valid.port_sequence)]
     od_valid_stats = (
         port_sequences_valid[['OD', 'IMO', 'port_sequence', 'num_intermediate_ports', 'journey_time']]
-        .groupby(['OD'])
+        .groupby(['OD'], observed=True)
         .agg(
             num_routes=('OD', 'count'),
             num_intermediate_ports=('num_intermediate_ports', 'mean'),
@@ -284,3 +285,32 @@ def cleanse_port_sequence(od_df):
         .reset_index(drop=True)
     )
     return od_df_valid,valid_port_sequences, od_port_sequence_valid, valid_port_sequences
+
+
+def diff_ports_tables(old_ports_df: pd.DataFrame, new_ports_df: pd.DataFrame) -> PortsTableDiff:
+    """
+    Compare two versions of the ports reference table (columns locode, lat, lon, mapped_locode)
+    and return the set of ports that were added, removed, moved or remapped.
+    """
+    columns = ['locode', 'lat', 'lon', 'mapped_locode']
+    old_df = old_ports_df[columns].drop_duplicates('locode').set_index('locode')
+    new_df = new_ports_df[columns].drop_duplicates('locode').set_index('locode')
+
+    common = old_df.index.intersection(new_df.index)
+    old_common = old_df.loc[common]
+    new_common = new_df.loc[common]
+
+    moved = ~(
+        np.isclose(old_common['lat'], new_common['lat'], rtol=0., atol=1e-9) &
+        np.isclose(old_common['lon'], new_common['lon'], rtol=0., atol=1e-9)
+    )
+    remapped = ~(
+        (old_common['mapped_locode'] == new_common['mapped_locode']) |
+        (old_common['mapped_locode'].isna() & new_common['mapped_locode'].isna())
+    )
+    return PortsTableDiff(
+        added=set(new_df.index.difference(old_df.index)),
+        removed=set(old_df.index.difference(new_df.index)),
+        moved=set(common[moved]),
+        remapped=set(common[remapped.to_numpy()])
+    )
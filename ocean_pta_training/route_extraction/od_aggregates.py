@@ -0,0 +1,242 @@
+"""
+Per-OD aggregates accumulated by the route extractor while it writes each OD's training data, and saved
+next to the per-OD stats (od_stats/od_aggregates.json), so that features such as the share of time a
+vessel is moving, its speed while moving and the number of intermediate ports can be read from a few KB
+instead of the combined OD dataset:
+
+    pings                   number of pings, and of moving pings (as is_moving in 03_build_combined_dataset.py)
+    speed while moving      count and sum, and a KLL sketch for its median
+    intermediate ports      histogram of the number of intermediate ports of each port sequence,
+                            by OD and by (IMO, OD)
+
+Every accumulator is mergeable: aggregates computed for different ODs, or by different runs, are
+combined with merge(), and an incremental extraction replaces the aggregates of the ODs it re-extracts.
+"""
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, Optional
+from ..sketches import KLLSketch
+
+logger = logging.getLogger(f"{__name__}")
+
+# A ping is stopped if its navigational status is one of these and its speed is at most STOPPED_MAXIMUM_SPEED
+STOPPED_NAV_STATUSES = ['aground', 'moored', 'at anchor']
+STOPPED_MAXIMUM_SPEED = 0.5
+
+
+def is_moving(nav_status: pd.Series, speed: pd.Series) -> np.ndarray:
+    """1 where the vessel is moving, 0 where it is stopped (int64)"""
+    is_stopped = nav_status.isin(STOPPED_NAV_STATUSES).to_numpy() & (speed.to_numpy() <= STOPPED_MAXIMUM_SPEED)
+    return 1 - is_stopped.astype(np.int64)
+
+
+def add_to_histogram(histogram: Dict[float, int], values: np.ndarray) -> None:
+    values = np.asarray(values, dtype=np.float64)
+    distinct_values, counts = np.unique(values[~np.isnan(values)], return_counts=True)
+    for value, count in zip(distinct_values.tolist(), counts.tolist()):
+        histogram[value] = histogram.get(value, 0) + count
+
+
+def merge_histograms(histogram: Dict[float, int], other: Dict[float, int]) -> None:
+    for value, count in other.items():
+        histogram[value] = histogram.get(value, 0) + count
+
+
+def summarize_histogram(histogram: Dict[float, int]) -> Dict:
+    """Count, mean and median (the mean of the middle two values for an even count, as in pandas)"""
+    if not histogram:
+        return {"n": 0, "avg_intermediate_ports": np.nan, "median_intermediate_ports": np.nan}
+    values = np.array(sorted(histogram), dtype=np.float64)
+    counts = np.array([histogram[v] for v in values], dtype=np.int64)
+    n = int(counts.sum())
+    cumulative_counts = np.cumsum(counts)
+    lower = values[np.searchsorted(cumulative_counts, (n - 1) // 2, side="right")]
+    upper = values[np.searchsorted(cumulative_counts, n // 2, side="right")]
+    return {
+        "n": n,
+        "avg_intermediate_ports": float(np.dot(values, counts) / n),
+        "median_intermediate_ports": float((lower + upper) / 2)
+    }
+
+
+def histogram_to_list(histogram: Dict[float, int]):
+    return [[value, count] for value, count in sorted(histogram.items())]
+
+
+def histogram_from_list(pairs) -> Dict[float, int]:
+    return {float(value): int(count) for value, count in pairs}
+
+
+class ODAccumulator(object):
+    """
+    Mergeable aggregates of one OD
+    """
+    n_pings: int
+    n_moving: int
+    moving_speed_count: int
+    moving_speed_sum: float
+    moving_speed: KLLSketch
+    intermediate_ports: Dict[float, int]
+    imo_intermediate_ports: Dict[int, Dict[float, int]]
+
+    def __init__(self):
+        self.n_pings = 0
+        self.n_moving = 0
+        self.moving_speed_count = 0
+        self.moving_speed_sum = 0.0
+        self.moving_speed = KLLSketch()
+        self.intermediate_ports = {}
+        self.imo_intermediate_ports = {}
+
+    def add_pings(self, moving: np.ndarray, speed: np.ndarray) -> None:
+        moving_speed = np.asarray(speed, dtype=np.float64)[moving == 1]
+        moving_speed = moving_speed[~np.isnan(moving_speed)]
+        self.n_pings += len(moving)
+        self.n_moving += int(np.sum(moving == 1))
+        self.moving_speed_count += len(moving_speed)
+        self.moving_speed_sum += float(moving_speed.sum())
+        self.moving_speed.update(moving_speed)
+
+    def add_port_sequences(self, imo: np.ndarray, num_intermediate_ports: np.ndarray) -> None:
+        add_to_histogram(self.intermediate_ports, num_intermediate_ports)
+        for vessel_imo in np.unique(imo).tolist():
+            add_to_histogram(
+                self.imo_intermediate_ports.setdefault(int(vessel_imo), {}), num_intermediate_ports[imo == vessel_imo]
+            )
+
+    def merge(self, other: "ODAccumulator") -> None:
+        self.n_pings += other.n_pings
+        self.n_moving += other.n_moving
+        self.moving_speed_count += other.moving_speed_count
+        self.moving_speed_sum += other.moving_speed_sum
+        self.moving_speed.merge(other.moving_speed)
+        merge_histograms(self.intermediate_ports, other.intermediate_ports)
+        for vessel_imo, histogram in other.imo_intermediate_ports.items():
+            merge_histograms(self.imo_intermediate_ports.setdefault(vessel_imo, {}), histogram)
+
+    def features(self) -> Dict:
+        """Same features as the OD summaries of 11_add_additional_features.py (the median speed is approximate)"""
+        return {
+            "moving_portion": self.n_moving / self.n_pings if self.n_pings else np.nan,
+            "avg_speed": self.moving_speed_sum / self.moving_speed_count if self.moving_speed_count else np.nan,
+            "median_speed": self.moving_speed.quantile(0.5),
+            **summarize_histogram(self.intermediate_ports)
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            "n_pings": self.n_pings,
+            "n_moving": self.n_moving,
+            "moving_speed_count": self.moving_speed_count,
+            "moving_speed_sum": self.moving_speed_sum,
+            "moving_speed": self.moving_speed.to_dict(),
+            "intermediate_ports": histogram_to_list(self.intermediate_ports),
+            "imo_intermediate_ports": {
+                str(vessel_imo): histogram_to_list(histogram)
+                for vessel_imo, histogram in self.imo_intermediate_ports.items()
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ODAccumulator":
+        accumulator = cls()
+        accumulator.n_pings = int(data["n_pings"])
+        accumulator.n_moving = int(data["n_moving"])
+        accumulator.moving_speed_count = int(data["moving_speed_count"])
+        accumulator.moving_speed_sum = float(data["moving_speed_sum"])
+        accumulator.moving_speed = KLLSketch.from_dict(data["moving_speed"])
+        accumulator.intermediate_ports = histogram_from_list(data["intermediate_ports"])
+        accumulator.imo_intermediate_ports = {
+            int(vessel_imo): histogram_from_list(pairs) for vessel_imo, pairs in data["imo_intermediate_ports"].items()
+        }
+        return accumulator
+
+
+class ODAggregates(object):
+    """
+    ODAccumulator of each OD (by OD string)
+    """
+    FORMAT_VERSION: int = 1
+
+    accumulators: Dict[str, ODAccumulator]
+
+    def __init__(self, accumulators: Optional[Dict[str, ODAccumulator]] = None):
+        self.accumulators = dict(accumulators or {})
+
+    def __len__(self) -> int:
+        return len(self.accumulators)
+
+    def get(self, od: str) -> ODAccumulator:
+        if od not in self.accumulators:
+            self.accumulators[od] = ODAccumulator()
+        return self.accumulators[od]
+
+    def add_pings(self, od_df: pd.DataFrame) -> None:
+        """Add the pings of a training data frame (with OD, NavStatus and Speed columns)"""
+        moving = is_moving(od_df['NavStatus'], od_df['Speed'])
+        ods = od_df['OD'].astype(str).to_numpy()
+        for od in np.unique(ods).tolist():
+            rows = ods == od
+            self.get(od).add_pings(moving[rows], od_df['Speed'].to_numpy()[rows])
+
+    def add_port_sequences(self, port_sequences_df: pd.DataFrame) -> None:
+        """Add port sequences (with OD, IMO and num_intermediate_ports columns)"""
+        ods = port_sequences_df['OD'].astype(str).to_numpy()
+        imo = port_sequences_df['IMO'].to_numpy()
+        num_intermediate_ports = port_sequences_df['num_intermediate_ports'].to_numpy(dtype=np.float64)
+        for od in np.unique(ods).tolist():
+            rows = ods == od
+            self.get(od).add_port_sequences(imo[rows], num_intermediate_ports[rows])
+
+    def merge(self, other: "ODAggregates") -> None:
+        for od, accumulator in other.accumulators.items():
+            self.get(od).merge(accumulator)
+
+    def drop(self, ods: Iterable[str]) -> None:
+        for od in ods:
+            self.accumulators.pop(od, None)
+
+    def od_features(self) -> pd.DataFrame:
+        """One row per OD: moving_portion, avg_speed, median_speed, n, avg_ and median_intermediate_ports"""
+        return pd.DataFrame.from_dict(
+            {od: accumulator.features() for od, accumulator in self.accumulators.items()}, orient="index"
+        ).rename_axis("OD")
+
+    def imo_od_features(self) -> pd.DataFrame:
+        """One row per (IMO, OD): n, avg_intermediate_ports, median_intermediate_ports"""
+        rows = [
+            {"IMO": vessel_imo, "OD": od, **summarize_histogram(histogram)}
+            for od, accumulator in self.accumulators.items()
+            for vessel_imo, histogram in accumulator.imo_intermediate_ports.items()
+        ]
+        columns = ["IMO", "OD", "n", "avg_intermediate_ports", "median_intermediate_ports"]
+        return pd.DataFrame(rows, columns=columns).set_index(["IMO", "OD"])
+
+    def save(self, file_path: str) -> None:
+        data = {
+            "version": self.FORMAT_VERSION,
+            "ods": {od: accumulator.to_dict() for od, accumulator in self.accumulators.items()}
+        }
+        with open(f"{file_path}.tmp", "w") as json_file:
+            json.dump(data, json_file)
+        os.replace(f"{file_path}.tmp", file_path)
+        logger.info(f"Saved the aggregates of {len(self)} ODs to {file_path}")
+
+    @classmethod
+    def load(cls, file_path: str) -> "ODAggregates":
+        with open(file_path, "r") as json_file:
+            data = json.load(json_file)
+        if data.get("version") != cls.FORMAT_VERSION:
+            message = f"Unsupported OD aggregates version {data.get('version')} in {file_path}"
+            logger.error(message)
+            raise ValueError(message)
+        return cls({od: ODAccumulator.from_dict(accumulator) for od, accumulator in data["ods"].items()})
+
+    @classmethod
+    def load_or_create(cls, file_path: Optional[str]) -> "ODAggregates":
+        if file_path and os.path.isfile(file_path):
+            return cls.load(file_path)
+        return cls()
@@ -7,27 +7,33 @@ import numpy as np
 import logging
 import json
 import pandas as pd
+import pickle
 import re
 import yaml
 from collections import defaultdict
 from itertools import chain
-from haversine import haversine_vector, Unit
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 from .constants import (
     CONFIG_FILE_DEFAULT_FILENAME, DEFAULT_OUTPUT_FILE_DIRECTORY, IMO,
     JOBS, JOB_NAME, JOB_ORIGIN, JOB_DESTINATION,
-    JOURNEY_BREAKER, OUTPUT_TRAINING_FILE_SUBDIR, OUTPUT_STATS_SUBDIR,
-    MAPPED_PORT, PORT, RANGE_START, RANGE_LENGTH, TIME_POSITION
+    JOURNEY_BREAKER, OUTPUT_TRAINING_FILE_SUBDIR, OUTPUT_STATS_SUBDIR, OUTPUT_STATE_SUBDIR, OUTPUT_JOURNEYS_SUBDIR,
+    MAPPED_PORT, PORT, RANGE_START, RANGE_LENGTH, TIME_POSITION,
+    STATE_PORTS_FILENAME, STATE_STOPPED_PORTS_FILENAME, STATE_PORT_SEQUENCES_FILENAME, OD_AGGREGATES_FILENAME
 )
-from .data_objects import VesselPortSequence
+from .data_objects import PortsTableDiff, VesselPortSequence
+from .od_aggregates import ODAggregates
 from .helpers import (
-    add_lead_time_cols, cleanse_port_sequence, expand_iloc_slice_list,
+    add_lead_time_cols, cleanse_port_sequence, diff_ports_tables, expand_iloc_slice_list,
     get_slice_len, np_runlengths, days_between_ts
 )
 from .port_codes import PORT_LETTER_CHARS, JOURNEY_BREAKER_LETTER
 from .regex import intermed_port_chars_admissible
 from .. import configs as package_configs
 from .. import Environment
+from ..geo import GeoPoints, NAUTICAL_MILES, nearest_neighbour
+from ..journey_index import JourneyIndex
+from ..journeys import Journeys
+from ..port_dictionary import PortDictionary, get_port_dictionary_path
 
 
 # Numeric constants that parameterize the algorithm
@@ -36,6 +42,13 @@ DISTANCE_FROM_PORT_THRESHOLD_FOR_ARRIVED: int = 15  # should this be a float?
 MINIMUM_ROUTE_OBSERVATIONS_FOR_INCLUSION: int = 3
 VESSEL_SPEED_THRESHOLD_FOR_STOPPED: float = 0.5
 
+# Columns of the journey-level (ragged) outputs written under OUTPUT_JOURNEYS_SUBDIR
+JOURNEY_KEY_COLUMNS: List[str] = [IMO, 'OD', 'unique_route_ID']
+JOURNEY_ATTRIBUTE_COLUMNS: List[str] = ['route_ID', 'journey_time', 'num_intermediate_ports', 'port_sequence']
+JOURNEY_PING_COLUMNS: List[str] = [
+    TIME_POSITION, 'Latitude', 'Longitude', 'Speed', 'remaining_lead_time', 'journey_percent', 'elapsed_time'
+]
+
 # TODO: Describe this
 VesselPortSequence.EMPTY = VesselPortSequence("", {}, np.array([], dtype=int))
 
@@ -51,6 +64,8 @@ class OriginDestinationRouteExtractor(object):
     output_root_dir: str
     training_file_output_dir: str
     output_stats_dir: str
+    output_state_dir: str
+    output_journeys_dir: str
 
     # DECLARE VARIOUS DATA STRUCTURES NEEDED FOR THIS PROCEDURE
 
@@ -60,7 +75,10 @@ class OriginDestinationRouteExtractor(object):
     od_list_df: pd.DataFrame
 
     # Computed
+    port_dictionary: PortDictionary
     port_to_latlon: Dict
+    port_to_position: Dict
+    port_geo_points: GeoPoints
     port_to_mapped_port: Dict
     hex5_to_possible_ports: Dict
     imo_range_df: pd.DataFrame
@@ -98,6 +116,7 @@ class OriginDestinationRouteExtractor(object):
 
         # Compute calculated data structures
         self.set_port_to_mapped_port()
+        self.set_port_dictionary()
         self.load_od_list_df(path_to_od_file)
 
     def run(self):
@@ -113,6 +132,7 @@ class OriginDestinationRouteExtractor(object):
         self.compute_imo_to_digested_port_sequence()
 
         # Run
+        self.port_dictionary.save(get_port_dictionary_path(self.output_root_dir))
         self.write_all_od_subframes(
             main_df=self.vessel_movements_df,
             name_list=list(map(lambda j: j.get(JOB_NAME), self.jobs)),
@@ -125,6 +145,222 @@ class OriginDestinationRouteExtractor(object):
         self.log_successful_and_failed_jobs()
         self.log_metrics()
         self.write_success_failure_json_files()
+        self.save_extraction_state()
+
+    def run_incremental(self):
+        """
+        Re-run the feature extraction after the ports file was edited. The ports table
+        is compared with the one saved by the previous run, and only the vessels and
+        the origin-destination routes affected by the edit are recomputed.
+
+        Falls back to a full run() if there is no usable state from a previous run.
+        """
+        previous_state = self.load_extraction_state()
+        if previous_state is None:
+            self.logger.info("No saved extraction state was found: running the full extraction instead.")
+            self.run()
+            return
+        previous_ports_df, previous_stopped_ports_df, previous_port_sequences = previous_state
+
+        self.map_destination_port()
+        self.set_port_latlon_dict()
+        self.mark_hexes_near_ports()
+        self.make_imo_range_data()
+
+        if not self.is_extraction_state_aligned(previous_stopped_ports_df):
+            self.logger.warning(
+                "The saved extraction state does not match the vessel movements data: "
+                "running the full extraction instead."
+            )
+            self.run()
+            return
+
+        ports_diff = diff_ports_tables(previous_ports_df, self.edited_ports_df)
+        if ports_diff.is_empty():
+            self.logger.info("The ports file has not changed since the previous run. Nothing to re-extract.")
+            return
+        self.logger.info(
+            f"Ports changed since the previous run: {len(ports_diff.added)} added, "
+            f"{len(ports_diff.removed)} removed, {len(ports_diff.moved)} moved, "
+            f"{len(ports_diff.remapped)} remapped"
+        )
+
+        # Start from the previous results, then recompute the vessels near relocated ports
+        previous_port_to_mapped_port = dict(zip(previous_ports_df['locode'], previous_ports_df['mapped_locode']))
+        self.vessel_movements_df[PORT] = previous_stopped_ports_df[PORT].astype(object).to_numpy()
+        previous_mapped_ports = self.vessel_movements_df[PORT].map(previous_port_to_mapped_port, na_action='ignore')
+
+        affected_imos = self.find_vessels_near_relocated_ports(previous_ports_df, ports_diff)
+        self.logger.info(f"Recomputing {PORT} for {len(affected_imos)} vessels stopped near relocated ports")
+        self.compute_stopped_nearest_port_fields(imos=affected_imos)
+
+        # A remapped port changes the mapped port sequence of every vessel that stopped there
+        mapped_ports = self.vessel_movements_df[MAPPED_PORT].astype(object)
+        is_remapped = ~((mapped_ports == previous_mapped_ports) | (mapped_ports.isna() & previous_mapped_ports.isna()))
+        affected_imos.update(self.vessel_movements_df.loc[is_remapped, IMO].unique())
+
+        self.imo_to_digested_port_sequence = previous_port_sequences
+        changed_sequences = self.update_imo_to_digested_port_sequence(affected_imos)
+        self.logger.info(f"The digested port sequence changed for {len(changed_sequences)} vessels")
+
+        jobs = self.select_jobs_affected_by_ports_change(ports_diff, changed_sequences, previous_port_to_mapped_port)
+        self.logger.info(f"{len(jobs)} of {len(self.jobs)} origin-destination routes will be re-extracted")
+
+        for job in jobs:
+            self.remove_od_outputs(job.get(JOB_ORIGIN), job.get(JOB_DESTINATION))
+        self.load_previous_job_outcomes(exclude_names={job.get(JOB_NAME) for job in jobs})
+
+        self.port_dictionary.save(get_port_dictionary_path(self.output_root_dir))
+        self.write_all_od_subframes(
+            main_df=self.vessel_movements_df,
+            name_list=list(map(lambda j: j.get(JOB_NAME), jobs)),
+            od_list=list(map(
+                lambda j: (j.get(JOB_ORIGIN), j.get(JOB_DESTINATION)),
+                jobs
+            )),
+            route_threshold_od=MINIMUM_ROUTE_OBSERVATIONS_FOR_INCLUSION,
+            merge_with_previous_outputs=True
+        )
+        self.log_successful_and_failed_jobs()
+        self.log_metrics()
+        self.write_success_failure_json_files()
+        self.save_extraction_state()
+
+    def find_vessels_near_relocated_ports(self, previous_ports_df: pd.DataFrame, ports_diff: PortsTableDiff) -> Set:
+        """
+        Return the IMOs of vessels having stopped movements in the hexes near an added,
+        removed or moved port (both its old and its new position).
+        """
+        previous_port_to_latlon = dict(zip(
+            previous_ports_df['locode'],
+            zip(previous_ports_df['lat'], previous_ports_df['lon'])
+        ))
+        affected_hexes = set()
+        for port in ports_diff.relocated:
+            for latlon in (previous_port_to_latlon.get(port), self.port_to_latlon.get(port)):
+                if latlon is not None and not any(pd.isna(value) for value in latlon):
+                    affected_hexes.update(self.hexes_near_port(latlon))
+
+        stopped_df = self.vessel_movements_df[self.is_stopped(self.vessel_movements_df)]
+        return set(stopped_df.loc[stopped_df['h3_5'].isin(affected_hexes), IMO].unique())
+
+    def select_jobs_affected_by_ports_change(self,
+                                             ports_diff: PortsTableDiff,
+                                             changed_sequences: Dict,
+                                             previous_port_to_mapped_port: Dict) -> List[Dict]:
+        """
+        A job must be re-extracted if its origin or destination port changed, or if a vessel
+        whose digested port sequence changed visits both its (mapped) origin and destination,
+        before or after the change.
+        """
+        changed_ports = ports_diff.changed
+        affected_jobs = []
+        for job in self.jobs:
+            orig, dest = job.get(JOB_ORIGIN), job.get(JOB_DESTINATION)
+            if orig in changed_ports or dest in changed_ports:
+                affected_jobs.append(job)
+                continue
+
+            new_od = (self.port_to_mapped_port.get(orig), self.port_to_mapped_port.get(dest))
+            old_od = (previous_port_to_mapped_port.get(orig), previous_port_to_mapped_port.get(dest))
+            if any(
+                all(p in vp.port_map for p in od)
+                for old_vp, new_vp in changed_sequences.values()
+                for vp, od in ((old_vp, old_od), (new_vp, new_od))
+            ):
+                affected_jobs.append(job)
+
+        return affected_jobs
+
+    def update_imo_to_digested_port_sequence(self, imos: Set) -> Dict:
+        """
+        Recompute the digested port sequences of the given vessels only.
+        Returns a dict IMO: (previous sequence, new sequence) for the vessels whose sequence changed.
+        """
+        changed_sequences = {}
+        for imo, start_row, n_rows in zip(self.imo_range_df[IMO],
+                                          self.imo_range_df[RANGE_START],
+                                          self.imo_range_df[RANGE_LENGTH]):
+            if imo not in imos:
+                continue
+            new_vp = self.create_vessel_port_sequence(
+                vessel_df=self.vessel_movements_df.iloc[start_row:start_row + n_rows],
+                port_col=MAPPED_PORT,
+                journey_breaker_col=None
+            )
+            old_vp = self.imo_to_digested_port_sequence.get(imo, VesselPortSequence.EMPTY)
+            if (
+                old_vp.port_str != new_vp.port_str
+                or old_vp.port_map != new_vp.port_map
+                or not np.array_equal(old_vp.row_pos, new_vp.row_pos)
+            ):
+                changed_sequences[imo] = (old_vp, new_vp)
+            self.imo_to_digested_port_sequence[imo] = new_vp
+
+        return changed_sequences
+
+    def remove_od_outputs(self, orig: str, dest: str):
+        """Delete the files previously written for one origin-destination route"""
+        for file_path in (
+            os.path.join(self.training_file_output_dir, f"{orig}{dest}.feather"),
+            os.path.join(self.output_journeys_dir, f"{orig}{dest}.arrow"),
+            os.path.join(self.output_stats_dir, f"routeID_{orig}{dest}.csv"),
+            os.path.join(self.output_stats_dir, f"portsequence_{orig}{dest}.csv")
+        ):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+    def load_previous_job_outcomes(self, exclude_names: Set[str]):
+        """
+        Start the lists of successful/failed jobs from the JSON files of the previous run,
+        leaving out the jobs that are about to be re-extracted.
+        """
+        for file_name, jobs_list in (("successful_jobs.json", self.successful_jobs),
+                                     ("failed_jobs.json", self.failed_jobs)):
+            file_path = os.path.join(self.output_root_dir, file_name)
+            if os.path.isfile(file_path):
+                with open(file_path, "r") as json_file:
+                    jobs_list.extend(j for j in json.load(json_file) if j.get(JOB_NAME) not in exclude_names)
+
+    def save_extraction_state(self):
+        """
+        Save what is needed to re-run the extraction incrementally after an edit to the
+        ports file: the ports table, the stopped_closest_port column (in sorted row order)
+        and the digested port sequence of every vessel.
+        """
+        self.logger.info(f"Saving extraction state to {self.output_state_dir}")
+        self.edited_ports_df.to_csv(os.path.join(self.output_state_dir, STATE_PORTS_FILENAME), index=False)
+        (
+            self.vessel_movements_df[[IMO, TIME_POSITION, PORT]]
+            .reset_index(drop=True)
+            .to_feather(os.path.join(self.output_state_dir, STATE_STOPPED_PORTS_FILENAME))
+        )
+        with open(os.path.join(self.output_state_dir, STATE_PORT_SEQUENCES_FILENAME), "wb") as pickle_file:
+            pickle.dump(self.imo_to_digested_port_sequence, pickle_file)
+
+    def load_extraction_state(self) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, Dict]]:
+        """Load the state saved by save_extraction_state, or return None if it is incomplete"""
+        file_paths = [
+            os.path.join(self.output_state_dir, file_name)
+            for file_name in (STATE_PORTS_FILENAME, STATE_STOPPED_PORTS_FILENAME, STATE_PORT_SEQUENCES_FILENAME)
+        ]
+        if not all(os.path.isfile(file_path) for file_path in file_paths):
+            return None
+
+        ports_file_path, stopped_ports_file_path, port_sequences_file_path = file_paths
+        self.logger.info(f"Loading extraction state from {self.output_state_dir}")
+        with open(port_sequences_file_path, "rb") as pickle_file:
+            port_sequences = pickle.load(pickle_file)
+        return pd.read_csv(ports_file_path), pd.read_feather(stopped_ports_file_path), port_sequences
+
+    def is_extraction_state_aligned(self, stopped_ports_df: pd.DataFrame) -> bool:
+        """True if the saved rows line up with the (sorted) vessel movements data"""
+        return (
+            len(stopped_ports_df.index) == len(self.vessel_movements_df.index)
+            and np.array_equal(stopped_ports_df[IMO].to_numpy(), self.vessel_movements_df[IMO].to_numpy())
+            and np.array_equal(stopped_ports_df[TIME_POSITION].to_numpy(),
+                               self.vessel_movements_df[TIME_POSITION].to_numpy())
+        )
 
     def map_destination_port(self):
         """Apply mapping to incorrect port locodes. TODO: This should be read from a mapping file."""
@@ -182,6 +418,14 @@ class OriginDestinationRouteExtractor(object):
         if not os.path.isdir(self.output_stats_dir):
             os.mkdir(self.output_stats_dir)
 
+        self.output_state_dir = os.path.join(self.output_root_dir, OUTPUT_STATE_SUBDIR)
+        if not os.path.isdir(self.output_state_dir):
+            os.mkdir(self.output_state_dir)
+
+        self.output_journeys_dir = os.path.join(self.output_root_dir, OUTPUT_JOURNEYS_SUBDIR)
+        if not os.path.isdir(self.output_journeys_dir):
+            os.mkdir(self.output_journeys_dir)
+
     def set_jobs(self):
         """
         Read in jobs from configs. This defines the list of routes for
@@ -226,7 +470,8 @@ class OriginDestinationRouteExtractor(object):
                                main_df: pd.DataFrame,
                                name_list: List[str],
                                od_list: List[Tuple[str, str]],
-                               route_threshold_od: int = 3):
+                               route_threshold_od: int = 3,
+                               merge_with_previous_outputs: bool = False):
         """
         We implement this, because get_all_od_subframes was defined
         in the notebook, but never used. This one was used to write output
@@ -234,6 +479,12 @@ class OriginDestinationRouteExtractor(object):
 
         od_list existed in the original notebook; it and name_list could be replaced by simply
         iterating through self.jobs. name_list and od_list are a transformation of the items in jobs.
+
+        With merge_with_previous_outputs, the combined CSV files written by a previous run
+        are kept, and only their rows for the ODs in od_list are replaced.
+
+        While each OD is written, its pings and port sequences are added to mergeable per-OD
+        aggregates (see od_aggregates.py), saved under OUTPUT_STATS_SUBDIR.
         """
         self.logger.info("ATTEMPTING TO EXTRACT TRAINING DATA FOR ALL ORIGIN-DESTINATION PAIRS IN JOBS")
 
@@ -246,6 +497,7 @@ class OriginDestinationRouteExtractor(object):
         success_odlist = []
         failed_odlist = []
         combined_port_sequence_df = pd.DataFrame()
+        od_aggregates = ODAggregates()
         for idx, (orig, dest) in enumerate(od_list):
             name = name_list[idx]
             slicelist = []
@@ -288,7 +540,10 @@ class OriginDestinationRouteExtractor(object):
                 od_df: pd.DataFrame = (
                     self.vessel_movements_df.iloc[expand_iloc_slice_list(slicelist)]
                     .assign(
-                        OD=np.repeat(flattened_odlist, list(map(get_slice_len, slicelist))),
+                        OD=pd.Categorical(
+                            np.repeat(flattened_odlist, list(map(get_slice_len, slicelist))),
+                            dtype=self.port_dictionary.od_dtype
+                        ),
                         route_ID=np.repeat(routeidlist, list(map(get_slice_len, slicelist)))
                     )
                 )
@@ -304,6 +559,7 @@ class OriginDestinationRouteExtractor(object):
                 cleansed_od_df, routeID_stats, portsequence_stats, port_sequences_df = cleanse_port_sequence(od_df)
 
                 combined_port_sequence_df = pd.concat([combined_port_sequence_df, port_sequences_df])
+                od_aggregates.add_port_sequences(port_sequences_df)
 
                 route_rank = (
                     cleansed_od_df
@@ -326,6 +582,7 @@ class OriginDestinationRouteExtractor(object):
                 cleansed_od_df['elapsed_time'] = cleansed_od_df['journey_time'] - cleansed_od_df['remaining_lead_time']
 
                 filename = os.path.join(self.training_file_output_dir, f"{orig}{dest}.feather")
+                journeys_filename = os.path.join(self.output_journeys_dir, f"{orig}{dest}.arrow")
                 routeID_stats_filename = os.path.join(self.output_stats_dir, f"routeID_{orig}{dest}.csv")
                 portsequence_stats_filename = os.path.join(self.output_stats_dir, f"portsequence_{orig}{dest}.csv")
 
@@ -334,7 +591,10 @@ class OriginDestinationRouteExtractor(object):
                     self.logger.info(f"The port sequence cleansing generated training a file for: {orig}-{dest}")
                     self.logger.info(f"The number of cleansed routes for this OD are: {cleansed_od_df.unique_route_ID.max()}")
 
-                    cleansed_od_df.to_feather(filename)
+                    # Uncompressed, so that the journey index can read single journeys from memory-mapped files
+                    cleansed_od_df.to_feather(filename, compression="uncompressed")
+                    self.get_od_journeys(cleansed_od_df).save(journeys_filename)
+                    od_aggregates.add_pings(cleansed_od_df)
                     routeID_stats.to_csv(routeID_stats_filename, index=False)
                     portsequence_stats.to_csv(portsequence_stats_filename, index=False)
                     self.successful_jobs.append({JOB_NAME: name, JOB_ORIGIN: orig, JOB_DESTINATION: dest})
@@ -354,10 +614,54 @@ class OriginDestinationRouteExtractor(object):
         failed_df = pd.DataFrame(failed_odlist, columns=['OD'])
 
         combined_port_sequence_file_path = os.environ.get(Environment.Vars.PATH_TO_COMBINED_PORT_SEQUENCE_DATA)
+        success_file_path = os.path.join(self.output_root_dir, "ods_successfully_processed.csv")
+        failed_file_path = os.path.join(self.output_root_dir, "ods_unsuccessfully_processed.csv")
+        od_aggregates_file_path = os.path.join(self.output_stats_dir, OD_AGGREGATES_FILENAME)
+
+        if merge_with_previous_outputs:
+            processed_ods = [f"{orig}-{dest}" for orig, dest in od_list]
+            combined_port_sequence_df = self.merge_with_previous_od_csv(
+                combined_port_sequence_file_path, combined_port_sequence_df, processed_ods
+            )
+            success_df = self.merge_with_previous_od_csv(success_file_path, success_df, processed_ods)
+            failed_df = self.merge_with_previous_od_csv(failed_file_path, failed_df, processed_ods)
+            previous_od_aggregates = ODAggregates.load_or_create(od_aggregates_file_path)
+            previous_od_aggregates.drop(processed_ods)
+            previous_od_aggregates.merge(od_aggregates)
+            od_aggregates = previous_od_aggregates
+
         combined_port_sequence_df.to_csv(combined_port_sequence_file_path, index=False)
 
-        success_df.to_csv(os.path.join(self.output_root_dir, "ods_successfully_processed.csv"),  index=False)
-        failed_df.to_csv(os.path.join(self.output_root_dir, "ods_unsuccessfully_processed.csv"), index=False)
+        success_df.to_csv(success_file_path,  index=False)
+        failed_df.to_csv(failed_file_path, index=False)
+        od_aggregates.save(od_aggregates_file_path)
+
+        JourneyIndex.build(self.output_root_dir, OUTPUT_TRAINING_FILE_SUBDIR).save()
+
+    @staticmethod
+    def get_od_journeys(cleansed_od_df: pd.DataFrame) -> Journeys:
+        """
+        Journey-level view of one OD's training data: one entry per (IMO, OD, unique_route_ID),
+        with its pings in time order
+        """
+        return Journeys.from_frame(
+            cleansed_od_df,
+            key_columns=JOURNEY_KEY_COLUMNS,
+            columns=JOURNEY_PING_COLUMNS,
+            journey_columns=JOURNEY_ATTRIBUTE_COLUMNS,
+            order_by=TIME_POSITION
+        )
+
+    @staticmethod
+    def merge_with_previous_od_csv(file_path: Optional[str], new_df: pd.DataFrame, replaced_ods: List[str]) -> pd.DataFrame:
+        """Keep the rows of a previously written CSV file (having an OD column), except those of replaced_ods"""
+        if not file_path or not os.path.isfile(file_path):
+            return new_df
+        previous_df = pd.read_csv(file_path)
+        if 'OD' not in previous_df.columns:
+            return new_df
+        previous_df = previous_df[~previous_df['OD'].isin(replaced_ods)]
+        return pd.concat([previous_df, new_df], ignore_index=True)
 
     def get_vessel_od_subframe(self,
                                main_df: Optional[pd.DataFrame],
@@ -580,21 +884,39 @@ class OriginDestinationRouteExtractor(object):
         )
         self.is_movement_data_sorted = True
 
-    def compute_stopped_nearest_port_fields(self) -> None:
+    def compute_stopped_nearest_port_fields(self, imos: Optional[Set] = None) -> None:
         """
         Generates a calculated field on the vessel movements data
         (stopped_nearest_port)
+
+        If imos is given, the field is recomputed only for those vessels; this requires
+        the data to be sorted already (see make_imo_range_data).
         """
         self.logger.info(f"Computing calculated field: {PORT}")
-        self.vessel_movements_df[PORT] = (
-            self.vessel_movements_df
-            .groupby(IMO, group_keys=False)
-            .apply(self.closest_port_ser)
-        )
+        if imos is None:
+            self.vessel_movements_df[PORT] = (
+                self.vessel_movements_df
+                .groupby(IMO, group_keys=False)
+                .apply(self.closest_port_ser)
+            )
+        else:
+            updated_ports = [
+                self.closest_port_ser(self.vessel_movements_df.iloc[start_row:start_row + n_rows])
+                for imo, start_row, n_rows in zip(self.imo_range_df[IMO],
+                                                  self.imo_range_df[RANGE_START],
+                                                  self.imo_range_df[RANGE_LENGTH])
+                if imo in imos
+            ]
+            self.vessel_movements_df.loc[self.vessel_movements_df[IMO].isin(imos), PORT] = np.nan
+            if updated_ports:
+                updated_ports_ser = pd.concat(updated_ports)
+                self.vessel_movements_df.loc[updated_ports_ser.index, PORT] = updated_ports_ser
+        self.vessel_movements_df[PORT] = self.port_dictionary.encode_ports(self.vessel_movements_df[PORT])
 
         self.logger.info(f"Computing calculated field: {MAPPED_PORT}")
-        self.vessel_movements_df[MAPPED_PORT] = (
+        self.vessel_movements_df[MAPPED_PORT] = self.port_dictionary.encode_ports(
             self.vessel_movements_df[PORT]
+            .astype(object)
             .map(self.port_to_mapped_port, na_action='ignore')
         )
 
@@ -605,12 +927,17 @@ class OriginDestinationRouteExtractor(object):
         self.logger.info("Marking hexes near to ports...")
         hex_ports = defaultdict(list)
         for port, latlon in self.port_to_latlon.items():
-            hex1 = h3.geo_to_h3(*latlon, resolution)  # linting error aside, I confirmed this works -ASL
-            for hex2 in h3.k_ring(hex1, rings):       # linting error aside, I confirmed this works -ASL
+            for hex2 in self.hexes_near_port(latlon, resolution, rings):
                 hex_ports[hex2].append(port)
 
         self.hex5_to_possible_ports = dict(hex_ports)
 
+    @staticmethod
+    def hexes_near_port(latlon: Tuple[float, float], resolution: int = 5, rings: int = 2) -> List[int]:
+        """The hexes within a number of rings of the hex containing a port"""
+        hex1 = h3.geo_to_h3(*latlon, resolution)  # linting error aside, I confirmed this works -ASL
+        return list(h3.k_ring(hex1, rings))       # linting error aside, I confirmed this works -ASL
+
     def set_port_latlon_dict(self):
         """Used to look up latitude/longitude of a port based on its code string"""
         self.logger.info("Setting port to latlon dict...")
@@ -619,6 +946,9 @@ class OriginDestinationRouteExtractor(object):
             zip(self.edited_ports_df['lat'],
                 self.edited_ports_df['lon'])
         ))
+        # Radians and cosines are computed once for all ports; see closest_port_ser
+        self.port_to_position = {port: i for i, port in enumerate(self.port_to_latlon)}
+        self.port_geo_points = GeoPoints(list(self.port_to_latlon.values()))
 
     def set_port_to_mapped_port(self):
         """Applies mappings to a port name"""
@@ -627,6 +957,18 @@ class OriginDestinationRouteExtractor(object):
             self.edited_ports_df['mapped_locode']
         ))
 
+    def set_port_dictionary(self):
+        """
+        Load the shared port/OD dictionary written by a previous run (if any) and
+        append the ports of the ports file and the ODs of the jobs to it.
+        """
+        self.port_dictionary = PortDictionary.load_or_create(get_port_dictionary_path(self.output_root_dir))
+        self.port_dictionary.add_ports(self.edited_ports_df['locode'])
+        self.port_dictionary.add_ports(self.edited_ports_df['mapped_locode'])
+        self.port_dictionary.add_ods(
+            f"{job.get(JOB_ORIGIN)}-{job.get(JOB_DESTINATION)}" for job in getattr(self, 'jobs', [])
+        )
+
     def load_od_list_df(self, file_path):
         """Reconstitute origin-destination (OD) data (dataframe) from file"""
         self.logger.info("Loading the od list csv file...")
@@ -645,13 +987,9 @@ class OriginDestinationRouteExtractor(object):
         can be aligned with the original.
         """
         arrived_threshold: int = DISTANCE_FROM_PORT_THRESHOLD_FOR_ARRIVED
-        stopped_threshold: float = VESSEL_SPEED_THRESHOLD_FOR_STOPPED
 
         if stopped_only:
-            sub_df = vessel_df[
-                vessel_df['NavStatus'].isin(['moored', 'at anchor', 'aground'])
-                & (vessel_df['Speed'] < stopped_threshold)
-            ]
+            sub_df = vessel_df[self.is_stopped(vessel_df)]
         else:
             sub_df = vessel_df
 
@@ -661,20 +999,25 @@ class OriginDestinationRouteExtractor(object):
 
         candidate_ports = np.array(list(port_set), dtype=object)
         if len(candidate_ports) > 0 and len(sub_df.index) > 0:
-            distances = haversine_vector(
-                [self.port_to_latlon[p] for p in candidate_ports],
-                list(zip(sub_df['Latitude'], sub_df['Longitude'])),
-                Unit.NAUTICAL_MILES,
-                comb=True
+            closest, closest_dist = nearest_neighbour(
+                sub_df[['Latitude', 'Longitude']].to_numpy(),
+                self.port_geo_points.take([self.port_to_position[p] for p in candidate_ports]),
+                unit=NAUTICAL_MILES
             )
-            # result has one row per movement
-            closest = np.argmin(distances, axis=1)
-            closest_dist = distances[range(len(closest)), closest]
             full_series = pd.Series(candidate_ports[closest], index=sub_df.index)
             return full_series[closest_dist <= arrived_threshold]
         else:
             return pd.Series(np.nan, index=sub_df.index)
 
+    @staticmethod
+    def is_stopped(vessel_df: pd.DataFrame) -> pd.Series:
+        """Boolean mask of the movements where the vessel is stopped"""
+        stopped_threshold: float = VESSEL_SPEED_THRESHOLD_FOR_STOPPED
+        return (
+            vessel_df['NavStatus'].isin(['moored', 'at anchor', 'aground'])
+            & (vessel_df['Speed'] < stopped_threshold)
+        )
+
     def load_vessel_movements_dataframe(self, file_path) -> pd.DataFrame:
         """Reconstitute vessel movements data (dataframe) from file"""
         self.logger.info("Loading the vessel movements feather file...")
@@ -0,0 +1,105 @@
+"""
+Mergeable streaming summaries of large columns, kept in a few KB so that downstream steps do not rescan
+the pings they summarize.
+
+KLLSketch is the quantile sketch of Karnin, Lang and Liberty ("Optimal Quantile Approximation in Streams",
+2016): a stack of compactors, where compactor h holds items of weight 2 ** h. When a compactor is full, its
+items are sorted and every other one (starting at a random offset) is promoted to the next compactor with
+twice the weight. With k items in the top compactor, the rank error of a quantile is about 1.7 / k. Two
+sketches merge by concatenating their compactors, so a sketch can be built by parts and combined later.
+Until its first compaction a sketch holds every item, and its quantiles are exact.
+"""
+import math
+import numpy as np
+from typing import Dict, List
+
+DEFAULT_KLL_K = 200
+KLL_CAPACITY_RATIO = 2 / 3
+
+
+class KLLSketch(object):
+    """
+    KLL quantile sketch of a stream of floats (NaN values are ignored)
+    """
+    k: int
+    n: int
+    compactors: List[np.ndarray]  # float64 items of weight 2 ** h, at level h
+
+    def __init__(self, k: int = DEFAULT_KLL_K):
+        self.k = k
+        self.n = 0
+        self.compactors = [np.zeros(0)]
+
+    def __len__(self) -> int:
+        """Number of items held"""
+        return sum(len(items) for items in self.compactors)
+
+    @property
+    def is_exact(self) -> bool:
+        """True while every item of the stream is held (no compaction yet)"""
+        return len(self.compactors) == 1
+
+    def capacity(self, level: int) -> int:
+        depth = len(self.compactors) - 1 - level
+        return max(2, int(math.ceil(self.k * KLL_CAPACITY_RATIO ** depth)))
+
+    def update(self, values) -> None:
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self.n += len(values)
+        self.compress()
+
+    def merge(self, other: "KLLSketch") -> None:
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.zeros(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+        self.n += other.n
+        self.compress()
+
+    def compress(self) -> None:
+        """Compact the lowest full compactor until the sketch holds no more items than its total capacity"""
+        while len(self) > sum(self.capacity(level) for level in range(len(self.compactors))):
+            for level in range(len(self.compactors)):
+                if len(self.compactors[level]) >= self.capacity(level):
+                    self.compact(level)
+                    break
+
+    def compact(self, level: int) -> None:
+        items = np.sort(self.compactors[level])
+        n_paired = len(items) - len(items) % 2
+        # The offset is random, but reproducible: it depends only on the stream length and the level
+        offset = int(np.random.default_rng([self.n, level]).integers(2))
+        if level + 1 == len(self.compactors):
+            self.compactors.append(np.zeros(0))
+        self.compactors[level + 1] = np.concatenate([self.compactors[level + 1], items[offset:n_paired:2]])
+        self.compactors[level] = items[n_paired:]
+
+    def quantile(self, q: float) -> float:
+        """
+        Approximate q-quantile (NaN if the sketch is empty). While the sketch is exact, the median
+        of an even number of items is the mean of the middle two, as in pandas.
+        """
+        if self.n == 0:
+            return np.nan
+        if self.is_exact:
+            return float(np.quantile(self.compactors[0], q))
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(c), 2 ** level) for level, c in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        cumulative_weights = np.cumsum(weights[order])
+        rank = min(int(np.searchsorted(cumulative_weights, q * cumulative_weights[-1])), len(items) - 1)
+        return float(items[order][rank])
+
+    def to_dict(self) -> Dict:
+        return {"k": self.k, "n": self.n, "compactors": [items.tolist() for items in self.compactors]}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "KLLSketch":
+        sketch = cls(int(data["k"]))
+        sketch.n = int(data["n"])
+        sketch.compactors = [np.asarray(items, dtype=np.float64) for items in data["compactors"]] or [np.zeros(0)]
+        return sketch
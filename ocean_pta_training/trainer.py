@@ -130,7 +130,8 @@ class ModelTrainer(object):
         self.logger.info(f"Training a PTA model for route: {journey_str} using data file at: {data_file}")
         
         self.logger.info(f"Loading the dataset")
-        df = pd.read_feather(data_file)
+        # Only load the columns needed for training (OD extracts also carry port and OD columns)
+        df = pd.read_feather(data_file, columns=list(dict.fromkeys(features + target + ['unique_route_ID'])))
 
         """
         NOTE (ASL): Moved Series' type conversion to make it prior to data slitting. This
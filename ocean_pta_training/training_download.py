@@ -0,0 +1,265 @@
+"""
+Download of the joined training data table (OCEAN_JOURNEY_DATA_TABLE) into a local Parquet dataset,
+without holding the table in memory:
+
+    - the table is split into IMO ranges, each downloaded over its own connection, in parallel threads
+    - within a range, rows are read one page of journeys at a time, by keyset pagination on the journey keys
+      (IMO, OD, unique_route_id): a page holds the next page_journeys journeys after the last one of the
+      previous page, so that no page scans the rows before it and no journey is split across pages
+    - the rows of a page are streamed with cursor.fetchmany into Arrow record batches, written as the row
+      groups of one Parquet file; journey_obs (the 1-based position of a row in its journey by elapsed_time,
+      as ROW_NUMBER() in the query this replaces) is numbered while streaming
+
+Files are named part-<range>-<page>.parquet, so that the dataset, read in file name order, is sorted by
+(IMO, OD, unique_route_id, elapsed_time). It is written to a temporary directory that replaces the previous
+dataset once every range is downloaded, and is removed if the download fails. Column types are those
+declared by the table (as reported in cursor.description, or by PRAGMA table_info for SQLite), so that
+every file has the same schema whatever values its rows hold.
+
+Any DB-API connection with qmark parameters works (pyodbc, sqlite3): the SQL dialect only decides how a
+page size is written ("tsql": SELECT TOP (n), "sqlite": LIMIT n), so the downloader can run against a
+local SQLite copy of the table.
+"""
+import datetime
+import decimal
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Callable, List, Optional, Sequence, Tuple
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(f"{__name__}")
+
+JOURNEY_KEY_COLUMNS = ['IMO', 'OD', 'unique_route_id']
+ORDER_COLUMN = 'elapsed_time'
+JOURNEY_OBS_COLUMN = 'journey_obs'
+SQL_DIALECTS = ('tsql', 'sqlite')
+# Arrow type of the Python type reported by cursor.description (decimals as float64, as pd.read_sql reads them)
+DESCRIPTION_TYPES = {
+    str: pa.string(),
+    int: pa.int64(),
+    float: pa.float64(),
+    decimal.Decimal: pa.float64(),
+    bool: pa.bool_(),
+    datetime.datetime: pa.timestamp('us'),
+    datetime.date: pa.date32(),
+    datetime.time: pa.time64('us'),
+    bytes: pa.binary(),
+    bytearray: pa.binary()
+}
+
+
+def after_key_clause(columns: Sequence[str], inclusive: bool = False, before: bool = False) -> str:
+    """
+    Row-value comparison (columns) > (?, ...) (or < / <= with before / inclusive), written out with AND/OR,
+    as T-SQL has no row-value comparisons. Each column takes two parameters but the last, which takes one.
+    """
+    operator = "<" if before else ">"
+    column = columns[0]
+    if len(columns) == 1:
+        return f"{column} {operator}{'=' if inclusive else ''} ?"
+    return f"({column} {operator} ? OR ({column} = ? AND {after_key_clause(columns[1:], inclusive, before)}))"
+
+
+def after_key_parameters(key: Sequence) -> List:
+    return [value for value in key[:-1] for _ in range(2)] + [key[-1]]
+
+
+def sqlite_declared_type(declared_type: str) -> pa.DataType:
+    """
+    Arrow type of a SQLite declared column type, by the SQLite type affinity rules (numeric as float64);
+    dates and times are stored as text, and read as strings (as pd.read_sql reads them)
+    """
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return pa.int64()
+    if any(name in declared_type for name in ("CHAR", "CLOB", "TEXT", "DATE", "TIME")):
+        return pa.string()
+    if declared_type == "" or "BLOB" in declared_type:
+        return pa.binary()
+    return pa.float64()
+
+
+def replace_directory(new_dir: str, target_dir: str) -> None:
+    """
+    Replace target_dir with new_dir: target_dir is moved aside first, and only removed once new_dir
+    is in its place, so that it is never lost to a failure between the two
+    """
+    previous_dir = f"{target_dir.rstrip(os.sep)}.previous"
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if os.path.exists(target_dir):
+        os.replace(target_dir, previous_dir)
+    os.replace(new_dir, target_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+
+
+def to_arrow_array(values: Sequence, data_type: pa.DataType) -> pa.Array:
+    try:
+        return pa.array(values, type=data_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # e.g. Decimal values of a float64 column, or values of a column of an unmapped type
+        if pa.types.is_string(data_type):
+            return pa.array([None if value is None else str(value) for value in values], type=data_type)
+        return pa.array(values).cast(data_type)
+
+
+class TrainingDataDownloader(object):
+    """
+    Keyset-paginated, parallel download of a table of journeys into a Parquet dataset
+    """
+    connect: Callable
+    table: str
+    dialect: str
+    n_connections: int
+    page_journeys: int
+    fetch_rows: int
+
+    def __init__(self, connect: Callable, table: str, dialect: str = 'tsql', n_connections: int = 4,
+                 page_journeys: int = 5_000, fetch_rows: int = 50_000):
+        if dialect not in SQL_DIALECTS:
+            message = f"Unsupported SQL dialect {dialect}; expected one of {SQL_DIALECTS}"
+            logger.error(message)
+            raise ValueError(message)
+        self.connect = connect
+        self.table = table
+        self.dialect = dialect
+        self.n_connections = max(1, n_connections)
+        self.page_journeys = page_journeys
+        self.fetch_rows = fetch_rows
+
+    def limited_select(self, select: str, n: int, rest: str) -> str:
+        """SELECT <select> <rest> with at most n rows"""
+        if self.dialect == 'tsql':
+            return f"SELECT TOP ({int(n)}) {select} {rest}"
+        return f"SELECT {select} {rest} LIMIT {int(n)}"
+
+    def get_schema(self, connection) -> pa.Schema:
+        """Arrow schema of the table, from its declared column types (strings for types without an Arrow mapping)"""
+        cursor = connection.cursor()
+        cursor.execute(self.limited_select("*", 0, f"FROM {self.table}"))
+        description = cursor.description
+        cursor.fetchall()
+        if self.dialect == 'sqlite':
+            # sqlite3 reports no types in cursor.description
+            schema_name, _, table_name = self.table.rpartition(".")
+            cursor.execute(f"PRAGMA {schema_name + '.' if schema_name else ''}table_info({table_name})")
+            declared_types = {row[1]: row[2] for row in cursor.fetchall()}
+            types = [sqlite_declared_type(declared_types.get(d[0], "")) for d in description]
+        else:
+            types = [DESCRIPTION_TYPES.get(d[1], pa.string()) for d in description]
+        fields = [pa.field(d[0], data_type) for d, data_type in zip(description, types)]
+        fields.append(pa.field(JOURNEY_OBS_COLUMN, pa.int64()))
+        return pa.schema(fields)
+
+    def get_imo_ranges(self, connection) -> List[Tuple]:
+        """(first IMO, last IMO) of n_connections ranges holding about as many vessels each"""
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT DISTINCT IMO FROM {self.table} WHERE IMO IS NOT NULL ORDER BY IMO")
+        imos = [row[0] for row in cursor.fetchall()]
+        return [(part[0], part[-1]) for part in np.array_split(np.array(imos, dtype=object), self.n_connections) if len(part)]
+
+    def download(self, dataset_dir: str) -> int:
+        """Download the table into dataset_dir (replaced once complete); returns the number of rows"""
+        start_time = time.perf_counter()
+        with closing(self.connect()) as connection:
+            schema = self.get_schema(connection)
+            imo_ranges = self.get_imo_ranges(connection)
+            cursor = connection.cursor()
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {self.table} WHERE " + " OR ".join(f"{c} IS NULL" for c in JOURNEY_KEY_COLUMNS)
+            )
+            n_rows_without_keys = cursor.fetchone()[0]
+        if n_rows_without_keys:
+            logger.warning(f"{n_rows_without_keys} rows of {self.table} have no journey key and are not downloaded")
+
+        temp_dir = f"{dataset_dir.rstrip(os.sep)}.partial"
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        logger.info(f"Downloading {self.table} in {len(imo_ranges)} IMO ranges into {temp_dir}")
+        try:
+            with ThreadPoolExecutor(max_workers=len(imo_ranges) or 1) as executor:
+                futures = [
+                    executor.submit(self.download_range, temp_dir, schema, range_index, first_imo, last_imo)
+                    for range_index, (first_imo, last_imo) in enumerate(imo_ranges)
+                ]
+                n_rows = sum(future.result() for future in futures)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        replace_directory(temp_dir, dataset_dir)
+        logger.info(f"Downloaded {n_rows} rows into {dataset_dir} in {time.perf_counter() - start_time:.1f}s")
+        return n_rows
+
+    def download_range(self, dataset_dir: str, schema: pa.Schema, range_index: int, first_imo, last_imo) -> int:
+        """Download the journeys of vessels first_imo to last_imo, one page of journeys per Parquet file"""
+        key_select = ", ".join(JOURNEY_KEY_COLUMNS)
+        # Rows without a journey key are left out, as NULL keys cannot be compared with the last key of a page
+        range_clause = "IMO >= ? AND IMO <= ? AND " + " AND ".join(f"{c} IS NOT NULL" for c in JOURNEY_KEY_COLUMNS)
+        n_rows = 0
+        last_key: Optional[Tuple] = None
+        with closing(self.connect()) as connection:
+            cursor = connection.cursor()
+            page = 0
+            while True:
+                after_clause = f" AND {after_key_clause(JOURNEY_KEY_COLUMNS)}" if last_key else ""
+                after_parameters = after_key_parameters(last_key) if last_key else []
+                # Last journey key of the page
+                cursor.execute(
+                    self.limited_select(
+                        key_select, self.page_journeys,
+                        f"FROM (SELECT DISTINCT {key_select} FROM {self.table} "
+                        f"WHERE {range_clause}{after_clause}) AS journey_keys ORDER BY {key_select}"
+                    ),
+                    [first_imo, last_imo] + after_parameters
+                )
+                page_keys = cursor.fetchall()
+                if not page_keys:
+                    break
+                page_last_key = tuple(page_keys[-1])
+
+                cursor.execute(
+                    f"SELECT * FROM {self.table} WHERE {range_clause}{after_clause} "
+                    f"AND {after_key_clause(JOURNEY_KEY_COLUMNS, inclusive=True, before=True)} "
+                    f"ORDER BY {key_select}, {ORDER_COLUMN}",
+                    [first_imo, last_imo] + after_parameters + after_key_parameters(page_last_key)
+                )
+                file_path = os.path.join(dataset_dir, f"part-{range_index:03d}-{page:06d}.parquet")
+                n_rows += self.write_page(cursor, schema, file_path)
+                last_key = page_last_key
+                page += 1
+        logger.info(f"IMO range {range_index} ({first_imo} to {last_imo}): {n_rows} rows in {page} files")
+        return n_rows
+
+    def write_page(self, cursor, schema: pa.Schema, file_path: str) -> int:
+        """Stream the rows of an executed cursor into a Parquet file, one row group per fetchmany batch"""
+        names = [d[0] for d in cursor.description]
+        key_positions = [names.index(c) for c in JOURNEY_KEY_COLUMNS]
+        previous_key, previous_obs = None, 0
+        n_rows = 0
+        with pq.ParquetWriter(file_path, schema) as writer:
+            while True:
+                rows = cursor.fetchmany(self.fetch_rows)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                # journey_obs continues the numbering of the journey the previous batch ended in
+                keys = list(zip(*(columns[i] for i in key_positions)))
+                is_new_journey = np.array(
+                    [keys[0] != previous_key] + [keys[i] != keys[i - 1] for i in range(1, len(keys))]
+                )
+                positions = np.arange(len(keys))
+                journey_obs = positions - np.maximum.accumulate(np.where(is_new_journey, positions, 0)) + 1
+                journey_obs[np.cumsum(is_new_journey) == 0] += previous_obs
+                previous_key, previous_obs = keys[-1], int(journey_obs[-1])
+
+                arrays = [to_arrow_array(values, schema.field(name).type) for name, values in zip(names, columns)]
+                arrays.append(pa.array(journey_obs, type=pa.int64()))
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                n_rows += len(rows)
+        return n_rows
@@ -0,0 +1,236 @@
+"""
+The local OD-agnostic training dataset, kept as a directory of Parquet files ($PATH_TO_LOCAL_TRAINING_DATASET):
+
+    part-<range>-<page>.parquet             rows downloaded by 09_download_all_training_data.py, in file name order
+    _derived/part-<range>-<page>.parquet    columns derived by later steps, with the same rows and row groups
+                                            as the part of the same name
+
+Rows are identified by their position in the store (file name order, then row order in each file): a frame
+read from the store is indexed by these positions, so that derived columns computed on it, after any sorting
+or filtering, are written back to the rows they were computed from. Reads only decode the columns asked for,
+and with an OD or IMO filter, only the row groups whose statistics may hold those ODs or IMOs. Files are
+memory-mapped.
+
+Derived columns never replace downloaded ones; writing a derived column that exists overwrites it. Removing
+rows (keep_rows) rewrites every part, and its derived columns, into a temporary directory that replaces the
+store once complete (the previous store is moved aside, and removed only once it is replaced); it changes
+the positions of the rows that follow those removed.
+"""
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterable, List, Optional
+from .env import Environment
+from .training_download import replace_directory
+
+logger = logging.getLogger(f"{__name__}")
+
+DERIVED_COLUMNS_SUBDIR = "_derived"
+DEFAULT_ROW_GROUP_ROWS = 50_000
+
+
+def may_contain(statistics, values: Optional[List]) -> bool:
+    """False if the row group statistics show none of the values can be in the column chunk"""
+    if values is None or statistics is None or not statistics.has_min_max:
+        return True
+    return any(statistics.min <= value <= statistics.max for value in values)
+
+
+class TrainingStorePart(object):
+    """
+    One Parquet file of the store: its name, first row position, and row group sizes
+    """
+    file_name: str
+    start: int
+    row_group_rows: List[int]
+
+    def __init__(self, file_name: str, start: int, row_group_rows: List[int]):
+        self.file_name = file_name
+        self.start = start
+        self.row_group_rows = row_group_rows
+
+    @property
+    def num_rows(self) -> int:
+        return sum(self.row_group_rows)
+
+
+class LocalTrainingStore(object):
+    """
+    Columnar local training dataset, with column projection, OD / IMO row group filtering,
+    and derived columns written next to the downloaded ones
+    """
+    dataset_dir: str
+    parts: List[TrainingStorePart]
+
+    def __init__(self, dataset_dir: str):
+        self.dataset_dir = dataset_dir
+        self.parts = []
+        self.refresh()
+
+    @property
+    def derived_dir(self) -> str:
+        return os.path.join(self.dataset_dir, DERIVED_COLUMNS_SUBDIR)
+
+    @property
+    def num_rows(self) -> int:
+        return sum(part.num_rows for part in self.parts)
+
+    def refresh(self) -> None:
+        """List the parts of the store (after it was written by another process)"""
+        self.parts = []
+        if not os.path.isdir(self.dataset_dir):
+            return
+        start = 0
+        for file_name in sorted(x for x in os.listdir(self.dataset_dir) if x.endswith(".parquet")):
+            metadata = pq.read_metadata(os.path.join(self.dataset_dir, file_name))
+            row_group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+            self.parts.append(TrainingStorePart(file_name, start, row_group_rows))
+            start += sum(row_group_rows)
+
+    def open_part(self, part: TrainingStorePart, derived: bool = False) -> Optional[pq.ParquetFile]:
+        file_path = os.path.join(self.derived_dir if derived else self.dataset_dir, part.file_name)
+        if derived and not os.path.isfile(file_path):
+            return None
+        return pq.ParquetFile(file_path, memory_map=True)
+
+    def columns(self, derived: bool = False) -> List[str]:
+        """Names of the downloaded (or derived) columns"""
+        for part in self.parts:
+            parquet_file = self.open_part(part, derived)
+            if parquet_file is not None:
+                return parquet_file.schema_arrow.names
+        return []
+
+    def read(self, columns: Optional[List[str]] = None, ods: Optional[Iterable[str]] = None,
+             imos: Optional[Iterable[int]] = None) -> pd.DataFrame:
+        """
+        The columns (all if None, downloaded then derived) of the rows of the given ODs and IMOs (all if None),
+        indexed by row position in the store
+        """
+        base_columns, derived_columns = self.columns(), self.columns(derived=True)
+        columns = list(columns) if columns is not None else base_columns + derived_columns
+        unknown_columns = [c for c in columns if c not in base_columns and c not in derived_columns]
+        if unknown_columns:
+            message = f"Columns {unknown_columns} are not in the training store at {self.dataset_dir}"
+            logger.error(message)
+            raise ValueError(message)
+        ods = sorted(set(ods)) if ods is not None else None
+        imos = sorted(set(int(imo) for imo in imos)) if imos is not None else None
+        filter_columns = [c for c, values in (('OD', ods), ('IMO', imos)) if values is not None and c not in columns]
+
+        tables, positions = [], []
+        for part in self.parts:
+            base_file = self.open_part(part)
+            row_groups = self.select_row_groups(base_file, ods, imos)
+            if not row_groups:
+                continue
+            table = base_file.read_row_groups(
+                row_groups, columns=[c for c in columns + filter_columns if c in base_columns]
+            )
+            read_derived_columns = [c for c in columns if c in derived_columns and c not in base_columns]
+            if read_derived_columns:
+                derived_file = self.open_part(part, derived=True)
+                derived_table = derived_file.read_row_groups(row_groups, columns=read_derived_columns)
+                for name in read_derived_columns:
+                    table = table.append_column(name, derived_table.column(name))
+            tables.append(table.select(columns + filter_columns))
+            row_group_starts = part.start + np.concatenate([[0], np.cumsum(part.row_group_rows)[:-1]])
+            positions.extend(np.arange(row_group_starts[i], row_group_starts[i] + part.row_group_rows[i]) for i in row_groups)
+
+        if not tables:
+            return pd.DataFrame(columns=columns)
+        df = pa.concat_tables(tables).to_pandas()
+        df.index = pd.Index(np.concatenate(positions), dtype=np.int64)
+        if ods is not None:
+            df = df[df['OD'].isin(ods)]
+        if imos is not None:
+            df = df[df['IMO'].isin(imos)]
+        return df[columns]
+
+    @staticmethod
+    def select_row_groups(parquet_file: pq.ParquetFile, ods: Optional[List], imos: Optional[List]) -> List[int]:
+        names = parquet_file.schema_arrow.names
+        row_groups = []
+        for i in range(parquet_file.num_row_groups):
+            row_group = parquet_file.metadata.row_group(i)
+            if all(
+                may_contain(row_group.column(names.index(column)).statistics, values)
+                for column, values in (('OD', ods), ('IMO', imos)) if values is not None
+            ):
+                row_groups.append(i)
+        return row_groups
+
+    def write_columns(self, df: pd.DataFrame) -> None:
+        """
+        Write the columns of df as derived columns of the rows at its index positions (others are left null),
+        adding new columns and overwriting existing derived ones
+        """
+        clashing_columns = [c for c in df.columns if c in self.columns()]
+        if clashing_columns:
+            message = f"Derived columns {clashing_columns} would replace downloaded columns of the training store"
+            logger.error(message)
+            raise ValueError(message)
+        os.makedirs(self.derived_dir, exist_ok=True)
+        df = df[~df.index.duplicated(keep='last')]
+        # The same column types in every part, whichever rows of the part df covers
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for part in self.parts:
+            part_df = df.reindex(pd.RangeIndex(part.start, part.start + part.num_rows))
+            table = pa.Table.from_pandas(part_df, schema=schema, preserve_index=False)
+            derived_file = self.open_part(part, derived=True)
+            if derived_file is not None:
+                existing = derived_file.read()
+                kept_columns = [c for c in existing.column_names if c not in df.columns]
+                for name in reversed(kept_columns):
+                    table = table.add_column(0, existing.schema.field(name), existing.column(name))
+            self.write_part(table, os.path.join(self.derived_dir, part.file_name), part.row_group_rows)
+        logger.info(f"Wrote derived columns {list(df.columns)} to the training store at {self.dataset_dir}")
+
+    def keep_rows(self, positions: Iterable[int]) -> None:
+        """Remove every row whose position is not in positions (downloaded and derived columns)"""
+        keep = np.zeros(self.num_rows, dtype=bool)
+        keep[np.asarray(list(positions), dtype=np.int64)] = True
+        temp_dir = f"{self.dataset_dir.rstrip(os.sep)}.partial"
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(os.path.join(temp_dir, DERIVED_COLUMNS_SUBDIR))
+        try:
+            for part in self.parts:
+                part_keep = np.flatnonzero(keep[part.start:part.start + part.num_rows])
+                if len(part_keep) == 0:
+                    continue
+                row_group_rows = [len(part_keep)] if len(part_keep) <= DEFAULT_ROW_GROUP_ROWS else []
+                for derived in (False, True):
+                    parquet_file = self.open_part(part, derived)
+                    if parquet_file is not None:
+                        self.write_part(
+                            parquet_file.read().take(part_keep),
+                            os.path.join(temp_dir, DERIVED_COLUMNS_SUBDIR if derived else "", part.file_name),
+                            row_group_rows
+                        )
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        replace_directory(temp_dir, self.dataset_dir)
+        n_rows = self.num_rows
+        self.refresh()
+        logger.info(f"Kept {self.num_rows} of {n_rows} rows of the training store at {self.dataset_dir}")
+
+    @staticmethod
+    def write_part(table: pa.Table, file_path: str, row_group_rows: List[int]) -> None:
+        """Write a table with the given row group sizes (DEFAULT_ROW_GROUP_ROWS rows each if empty)"""
+        with pq.ParquetWriter(f"{file_path}.tmp", table.schema) as writer:
+            if not row_group_rows:
+                writer.write_table(table, row_group_size=DEFAULT_ROW_GROUP_ROWS)
+            offset = 0
+            for n in row_group_rows:
+                writer.write_table(table.slice(offset, n), row_group_size=max(n, 1))
+                offset += n
+        os.replace(f"{file_path}.tmp", file_path)
+
+
+def get_local_training_store(dataset_dir: Optional[str] = None) -> LocalTrainingStore:
+    return LocalTrainingStore(dataset_dir or os.environ.get(Environment.Vars.PATH_TO_LOCAL_TRAINING_DATASET))